@@ -0,0 +1,191 @@
+"""多角色LoRA适配器注册表：在同一个基础模型上加载多个适配器，按请求选择角色"""
+import logging
+import os
+import time
+from typing import Dict, List, Optional
+
+from peft import PeftConfig, PeftModel, get_peft_model
+from peft.utils import load_peft_weights, set_peft_model_state_dict
+
+from scheduler import BatchScheduler
+
+logger = logging.getLogger(__name__)
+
+# 角色名同时用作PEFT中的适配器名
+CHARACTER_NAME_PATTERN = r"^[A-Za-z0-9_\-\u4e00-\u9fff]+$"
+
+
+class UnknownCharacterError(ValueError):
+    """请求的角色没有注册"""
+
+
+class AdapterFrozenError(RuntimeError):
+    """模型结构已固定（如int8量化后），不能再挂载新的适配器"""
+
+
+class AdapterPathError(ValueError):
+    """适配器路径不在允许的目录中，或不是safetensors格式"""
+
+
+class InvalidCharacterNameError(ValueError):
+    """角色名与保留的适配器名冲突"""
+
+
+class Character:
+    """一个可扮演的角色：LoRA适配器（可选）和它的系统提示（可选，缺省用全局提示）"""
+    def __init__(self, name: str, adapter_path: Optional[str] = None, system_prompt: Optional[str] = None):
+        self.name = name
+        self.adapter_path = adapter_path
+        self.system_prompt = system_prompt
+        # 热更新同一路径的适配器后，依赖人设版本的缓存（如回复缓存）随之失效
+        self.loaded_time = time.time()
+
+    @property
+    def adapter(self) -> Optional[str]:
+        """PEFT中的适配器名，没有适配器时使用基础模型"""
+        return self.name if self.adapter_path else None
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "adapter_path": self.adapter_path,
+            "custom_system_prompt": self.system_prompt is not None
+        }
+
+
+class AdapterWeights:
+    """已从磁盘读入内存、尚未挂到模型上的适配器"""
+    def __init__(self, name: str, adapter_path: str, config, weights: dict, system_prompt: Optional[str]):
+        self.name = name
+        self.adapter_path = adapter_path
+        self.config = config
+        self.weights = weights
+        self.system_prompt = system_prompt
+
+
+def resolve_adapter_path(adapter_path: str, adapters_dir: str) -> str:
+    """把接口传入的适配器路径限制在adapters_dir内（可写相对路径），并要求是safetensors格式
+
+    .bin格式的适配器由torch.load（pickle）反序列化，可以执行任意代码，不允许通过接口加载。
+    """
+    if not adapters_dir:
+        raise AdapterPathError("未配置ADAPTERS_DIR，不允许运行时加载适配器")
+    root = os.path.realpath(adapters_dir)
+    path = os.path.realpath(os.path.join(root, adapter_path))
+    if os.path.commonpath([root, path]) != root or path == root:
+        raise AdapterPathError(f"适配器路径必须位于 {adapters_dir} 之内: {adapter_path}")
+    if os.path.isdir(path) and not os.path.exists(os.path.join(path, "adapter_model.safetensors")):
+        raise AdapterPathError(f"只支持safetensors格式的适配器: {adapter_path}")
+    return path
+
+
+def parse_adapter_config(value: str) -> Dict[str, str]:
+    """解析"角色=路径,角色=路径"形式的配置"""
+    adapters = {}
+    for item in value.split(","):
+        if "=" in item:
+            name, path = item.split("=", 1)
+            adapters[name.strip()] = path.strip()
+    return adapters
+
+
+class AdapterRegistry:
+    """同一基础模型上的多个角色适配器
+
+    第一个适配器加载时把基础模型包装为PeftModel，之后的适配器通过add_adapter追加，
+    卸载只删除对应的LoRA权重，基础权重始终只有一份。适配器目录中如果有
+    system_prompt.txt，会作为该角色的系统提示。
+
+    加载分两步：read从磁盘读取配置和权重，不碰模型，可以在任意线程执行；attach把权重
+    挂到模型上，改动模型结构，必须与解码串行。
+    """
+    PROMPT_FILE = "system_prompt.txt"
+
+    def __init__(self, default_character: str):
+        self.default_character = default_character
+        self.characters: Dict[str, Character] = {default_character: Character(default_character)}
+        # 不为None时拒绝加载新适配器，值为原因
+        self.frozen_reason: Optional[str] = None
+
+    def freeze(self, reason: str):
+        """禁止之后再加载适配器（已加载的仍可使用和卸载）"""
+        self.frozen_reason = reason
+
+    def get(self, name: Optional[str]) -> Character:
+        name = name or self.default_character
+        character = self.characters.get(name)
+        if character is None:
+            raise UnknownCharacterError(f"未知角色: {name}")
+        return character
+
+    def list(self) -> List[dict]:
+        return [character.to_dict() for character in self.characters.values()]
+
+    def check_loadable(self, name: str, adapter_path: str):
+        """加载前检查，不满足时抛出异常，此时不会动到已加载的适配器"""
+        if name == BatchScheduler.BASE_ADAPTER:
+            # 调度器用这个名字表示不挂适配器的行，同名角色会悄悄退化为基础模型
+            raise InvalidCharacterNameError(f"角色名 {name} 为保留名称")
+        if self.frozen_reason is not None:
+            raise AdapterFrozenError(f"无法加载角色 {name} 的适配器: {self.frozen_reason}")
+        if not os.path.exists(adapter_path):
+            raise FileNotFoundError(f"适配器路径不存在: {adapter_path}")
+
+    def read(self, name: str, adapter_path: str, system_prompt: Optional[str] = None) -> AdapterWeights:
+        """从磁盘读取适配器配置、权重和系统提示"""
+        self.check_loadable(name, adapter_path)
+
+        prompt_file = os.path.join(adapter_path, self.PROMPT_FILE)
+        if system_prompt is None and os.path.exists(prompt_file):
+            with open(prompt_file, "r", encoding="utf-8") as f:
+                system_prompt = f.read()
+
+        logger.info(f"正在读取角色 {name} 的LoRA权重: {adapter_path}")
+        config = PeftConfig.from_pretrained(adapter_path)
+        config.inference_mode = True
+        weights = load_peft_weights(adapter_path, device="cpu")
+        return AdapterWeights(name, adapter_path, config, weights, system_prompt)
+
+    def attach(self, model, adapter: AdapterWeights):
+        """把读入的适配器挂到模型上并登记角色，返回（可能被包装后的）模型"""
+        self.check_loadable(adapter.name, adapter.adapter_path)
+        name = adapter.name
+        try:
+            if isinstance(model, PeftModel):
+                # 同名适配器视为热更新，先删除旧权重
+                if name in model.peft_config:
+                    model.delete_adapter(name)
+                model.add_adapter(name, adapter.config)
+            else:
+                model = get_peft_model(model, adapter.config, adapter_name=name)
+            set_peft_model_state_dict(model, adapter.weights, adapter_name=name)
+        except Exception:
+            # 旧权重可能已被删除，不再保留指向它的角色
+            self._forget(name)
+            raise
+        model.eval()
+
+        self.characters[name] = Character(name, adapter.adapter_path, adapter.system_prompt)
+        return model
+
+    def load(self, model, name: str, adapter_path: str, system_prompt: Optional[str] = None):
+        """读取适配器并挂到模型上，返回（可能被包装后的）模型"""
+        return self.attach(model, self.read(name, adapter_path, system_prompt))
+
+    def unload(self, model, name: str):
+        """卸载角色的适配器，返回模型；所有适配器都卸载后还原为基础模型"""
+        character = self.get(name)
+        if character.adapter is not None and isinstance(model, PeftModel):
+            model.delete_adapter(character.adapter)
+            if not model.peft_config:
+                model = model.unload()
+        logger.info(f"角色 {name} 已卸载")
+        self._forget(name)
+        return model
+
+    def _forget(self, name: str):
+        if name == self.default_character:
+            # 默认角色始终存在，卸载适配器后由基础模型扮演
+            self.characters[name] = Character(name)
+        else:
+            self.characters.pop(name, None)
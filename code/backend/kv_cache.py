@@ -0,0 +1,152 @@
+"""KV缓存工具：以((key, value), ...)形式在批次维和序列维上操作缓存，以及按会话保存的缓存"""
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+import torch
+from transformers import DynamicCache
+
+logger = logging.getLogger(__name__)
+
+
+def cache_to_legacy(cache) -> tuple:
+    """把Cache对象转换为((key, value), ...)形式，便于按批次维和序列维操作"""
+    if hasattr(cache, "to_legacy_cache"):
+        return cache.to_legacy_cache()
+    if hasattr(cache, "layers"):
+        return tuple((layer.keys, layer.values) for layer in cache.layers)
+    return tuple(cache)
+
+
+def cache_from_legacy(legacy: tuple) -> DynamicCache:
+    """由((key, value), ...)重新构建模型可用的DynamicCache"""
+    if hasattr(DynamicCache, "from_legacy_cache"):
+        return DynamicCache.from_legacy_cache(legacy)
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(legacy):
+        cache.update(key, value, layer_idx)
+    return cache
+
+
+def left_pad_cache(legacy: tuple, length: int) -> tuple:
+    """在序列维左侧补零，使缓存长度达到length"""
+    pad = length - legacy[0][0].shape[2]
+    if pad <= 0:
+        return legacy
+    padded = []
+    for key, value in legacy:
+        key_pad = key.new_zeros(key.shape[0], key.shape[1], pad, key.shape[3])
+        value_pad = value.new_zeros(value.shape[0], value.shape[1], pad, value.shape[3])
+        padded.append((torch.cat([key_pad, key], dim=2), torch.cat([value_pad, value], dim=2)))
+    return tuple(padded)
+
+
+def select_cache(legacy: tuple, indices: torch.Tensor, start: int = 0) -> tuple:
+    """按批次维选取行，并丢弃序列维上start之前的部分"""
+    return tuple(
+        (key.index_select(0, indices)[:, :, start:], value.index_select(0, indices)[:, :, start:])
+        for key, value in legacy
+    )
+
+
+def crop_cache(legacy: tuple, length: int) -> tuple:
+    """只保留序列维的前length个位置（切片视图，不复制数据）"""
+    return tuple((key[:, :, :length], value[:, :, :length]) for key, value in legacy)
+
+
+def longest_common_prefix(a: List[int], b: List[int]) -> int:
+    """两个token序列的最长公共前缀长度"""
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+def cache_nbytes(legacy: tuple) -> int:
+    """缓存占用的字节数"""
+    return sum(
+        key.numel() * key.element_size() + value.numel() * value.element_size()
+        for key, value in legacy
+    )
+
+
+class SessionCache:
+    """按会话id保存上一轮结束时的KV缓存
+
+    新一轮对话只需预填充与缓存token序列不同的部分。条目按LRU淘汰，保证总占用
+    不超过内存预算。
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, session_id: str, tag: Optional[str] = None) -> Optional[tuple]:
+        """返回(token序列, KV缓存)，并标记为最近使用
+
+        tag标记缓存由哪个适配器计算，不同适配器的KV缓存不能互相复用。
+        """
+        with self._lock:
+            entry = self.entries.get(session_id)
+            if entry is None or entry[3] != tag:
+                return None
+            self.entries.move_to_end(session_id)
+            return entry[0], entry[1]
+
+    def put(self, session_id: str, token_ids: List[int], legacy: tuple, tag: Optional[str] = None):
+        """保存会话缓存，超出预算时淘汰最久未使用的会话"""
+        size = cache_nbytes(legacy)
+        with self._lock:
+            self._remove(session_id)
+            if size > self.max_bytes:
+                logger.warning(f"会话 {session_id} 的缓存({size / 2**20:.1f}MB)超过预算，不保存")
+                return
+            while self.entries and self.total_bytes + size > self.max_bytes:
+                _, (_, _, evicted_size, _) = self.entries.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+            self.entries[session_id] = (list(token_ids), legacy, size, tag)
+            self.total_bytes += size
+
+    def pop(self, session_id: str) -> bool:
+        with self._lock:
+            return self._remove(session_id)
+
+    def drop_tag(self, tag: Optional[str]) -> int:
+        """删除某个适配器计算的所有会话缓存（适配器重新加载或卸载后已失效）"""
+        with self._lock:
+            session_ids = [k for k, entry in self.entries.items() if entry[3] == tag]
+            for session_id in session_ids:
+                self._remove(session_id)
+            return len(session_ids)
+
+    def _remove(self, session_id: str) -> bool:
+        entry = self.entries.pop(session_id, None)
+        if entry is None:
+            return False
+        self.total_bytes -= entry[2]
+        return True
+
+    def record(self, hit: bool):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "sessions": len(self.entries),
+                "memory_mb": round(self.total_bytes / 2**20, 2),
+                "budget_mb": round(self.max_bytes / 2**20, 2),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
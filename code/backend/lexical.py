@@ -0,0 +1,131 @@
+"""字符n-gram的BM25倒排索引，以及与向量检索结果的倒数排名融合（RRF）
+
+问题中常出现人名、功法、丹药名（萧战、焚决、丹药品质），精确的字面匹配往往比向量检索更准，
+也便宜得多。中文不分词，直接按字符n-gram建索引；倒排表以CSR形式存放在几个NumPy数组中，
+每个查询只遍历查询中出现的n-gram的倒排表。
+"""
+import logging
+from collections import Counter
+from typing import Iterable, List, Sequence, Tuple
+
+import numpy as np
+
+from response_cache import normalize_message
+
+logger = logging.getLogger(__name__)
+
+
+def char_ngrams(text: str, sizes: Sequence[int] = (2,)) -> List[str]:
+    """规范化（去掉空白和标点）后的字符n-gram；文本比n短时整段作为一个词项"""
+    text = normalize_message(text)
+    grams = []
+    for n in sizes:
+        if len(text) < n:
+            if text:
+                grams.append(text)
+            continue
+        grams.extend(text[i:i + n] for i in range(len(text) - n + 1))
+    return grams
+
+
+def reciprocal_rank_fusion(rankings: Iterable[List[str]], k: int = 60) -> List[str]:
+    """按 Σ 1/(k + 名次) 合并多个排序结果，返回按融合分数从高到低的ID"""
+    scores = {}
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking):
+            scores[id_] = scores.get(id_, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+
+class LexicalIndex:
+    """内存中的BM25倒排索引
+
+    search同时返回置信度：排名第一的段落覆盖了查询中多少n-gram（按IDF加权），专有名词的
+    IDF高，问题中"是什么""怎么"之类的常见词IDF低，置信度高说明查询中的关键词在该段落中
+    都出现了。
+    """
+    def __init__(self, ngram_sizes: Sequence[int] = (2,), k1: float = 1.5, b: float = 0.75):
+        self.ngram_sizes = tuple(ngram_sizes)
+        self.k1 = k1
+        self.b = b
+
+        self.ids: List[str] = []
+        self.documents: List[str] = []
+        self.terms = {}
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.postings = np.zeros(0, dtype=np.int32)
+        self.frequencies = np.zeros(0, dtype=np.float32)
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.length_norm = np.zeros(0, dtype=np.float32)
+
+    def build(self, ids: List[str], documents: List[str]):
+        term_column, doc_column, tf_column = [], [], []
+        lengths = np.zeros(len(documents), dtype=np.float32)
+        for doc, text in enumerate(documents):
+            counts = Counter(char_ngrams(text, self.ngram_sizes))
+            lengths[doc] = sum(counts.values())
+            for term, tf in counts.items():
+                term_column.append(self.terms.setdefault(term, len(self.terms)))
+                doc_column.append(doc)
+                tf_column.append(tf)
+
+        # 按词项排序，每个词项的倒排表是postings中连续的一段，段内按文档编号升序
+        term_column = np.asarray(term_column, dtype=np.int64)
+        order = np.argsort(term_column, kind="stable")
+        self.postings = np.asarray(doc_column, dtype=np.int32)[order]
+        self.frequencies = np.asarray(tf_column, dtype=np.float32)[order]
+        df = np.bincount(term_column, minlength=len(self.terms))
+        self.offsets = np.concatenate([[0], np.cumsum(df)])
+        self.idf = np.log(1 + (len(documents) - df + 0.5) / (df + 0.5)).astype(np.float32)
+        average = lengths.mean() if len(documents) else 1.0
+        self.length_norm = self.k1 * (1 - self.b + self.b * lengths / max(average, 1e-6))
+        self.ids = ids
+        self.documents = documents
+
+    def _unseen_idf(self) -> float:
+        """索引中没有出现过的词项按df=0计算IDF，计入置信度的分母"""
+        n = len(self.documents)
+        return float(np.log(1 + (n + 0.5) / 0.5))
+
+    def search(self, query: str, top_k: int) -> Tuple[List[int], float]:
+        """返回(按BM25分数从高到低的段落编号, 置信度0~1)"""
+        if not self.documents:
+            return [], 0.0
+        query_terms = Counter(char_ngrams(query, self.ngram_sizes))
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        matched = []
+        total_weight = 0.0
+        for term, query_tf in query_terms.items():
+            index = self.terms.get(term)
+            if index is None:
+                total_weight += self._unseen_idf() * query_tf
+                continue
+            start, end = self.offsets[index], self.offsets[index + 1]
+            docs = self.postings[start:end]
+            tf = self.frequencies[start:end]
+            idf = self.idf[index]
+            scores[docs] += idf * query_tf * tf * (self.k1 + 1) / (tf + self.length_norm[docs])
+            total_weight += float(idf) * query_tf
+            matched.append((docs, float(idf) * query_tf))
+
+        if not matched:
+            return [], 0.0
+        top_k = min(top_k, len(self.documents))
+        candidates = np.argpartition(-scores, top_k - 1)[:top_k]
+        ranked = [int(doc) for doc in candidates[np.argsort(-scores[candidates])] if scores[doc] > 0]
+
+        best = ranked[0]
+        covered = 0.0
+        for docs, weight in matched:
+            position = np.searchsorted(docs, best)
+            if position < len(docs) and docs[position] == best:
+                covered += weight
+        return ranked, covered / total_weight
+
+    def stats(self) -> dict:
+        return {
+            "chunks": len(self.documents),
+            "terms": len(self.terms),
+            "postings": int(len(self.postings)),
+            "ngram_sizes": list(self.ngram_sizes)
+        }
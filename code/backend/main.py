@@ -1,18 +1,58 @@
-from fastapi import FastAPI, HTTPException, status
+from fastapi import Depends, FastAPI, Header, HTTPException, Request, Response, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
-from contextlib import asynccontextmanager
-from pydantic import BaseModel, Field
-from typing import List, Optional
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager, contextmanager
+from pydantic import BaseModel, Field, ValidationError
+from typing import AsyncIterator, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
+import time
 import uvicorn
 import os
+import sys
 
 from transformers import AutoTokenizer, AutoModelForCausalLM
-from peft import PeftModel
 import torch
 
+from scheduler import BatchScheduler, GenerationRequest, IncrementalDecoder, QueueFullError
+from kv_cache import SessionCache
+from response_cache import ResponseCache
+from prompt_builder import HistoryPacker, IncrementalEncoder, PromptTooLongError
+from speculative import DraftModel
+import metrics
+from lexical import LexicalIndex
+from retrieval import EmbeddingCache, Retriever, build_context, parse_rewrite_rules
+from vector_store import ChromaStore, MmapStore
+from reranker import Reranker
+from adapters import (
+    AdapterFrozenError,
+    AdapterPathError,
+    AdapterRegistry,
+    CHARACTER_NAME_PATTERN,
+    Character,
+    InvalidCharacterNameError,
+    UnknownCharacterError,
+    parse_adapter_config,
+    resolve_adapter_path
+)
+from precision import (
+    benchmark_decode,
+    configure_threads,
+    parse_cpu_list,
+    pin_cpus,
+    quantize_linear_int8,
+    resolve_device,
+    resolve_precision,
+    torch_dtype,
+)
+
 from datetime import datetime
+import hashlib
+import hmac
 import logging
 import json
+import uuid
 
 fake_users_db = {
     "admin": {
@@ -30,8 +70,85 @@ class Config:
     HOST = os.getenv("HOST", "0.0.0.0")
     PORT = int(os.getenv("PORT", 8000))
     LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    # 推理设备: auto/cpu/cuda
+    DEVICE = os.getenv("DEVICE", "auto")
+    # 推理精度: auto(GPU为fp16，CPU为fp32)/fp32/fp16/bf16/int8(仅CPU，线性层动态量化)
+    PRECISION = os.getenv("PRECISION", "auto")
+    # CPU推理线程数，0表示使用PyTorch默认值
+    NUM_THREADS = int(os.getenv("NUM_THREADS", 0))
+    # 绑定的CPU核，格式如 0-3,8，为空时不绑定
+    CPU_AFFINITY = os.getenv("CPU_AFFINITY", "")
+    # 模型工作进程数；大于1时由router.py启动工作进程并按会话ID转发请求，
+    # 须用 python router.py 或 uvicorn router:app 启动（python main.py会转而运行router.py）
+    NUM_WORKERS = int(os.getenv("NUM_WORKERS", 1))
+    # 工作进程监听的起始端口（仅本机），依次为 WORKER_BASE_PORT, WORKER_BASE_PORT+1, ...
+    WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", PORT + 1))
+    # 启动时用当前精度跑一次预填充+解码，记录吞吐
+    STARTUP_BENCHMARK = os.getenv("STARTUP_BENCHMARK", "true").lower() == "true"
+    # 就绪前先跑一次短生成，预热分词、预填充和批量解码路径
+    WARMUP = os.getenv("WARMUP", "true").lower() == "true"
+    WARMUP_TOKENS = int(os.getenv("WARMUP_TOKENS", 8))
+    # 辅助解码的起草模型（须与主模型同一分词器，如主模型为Qwen3-8B时用Qwen3-0.6B），为空时关闭
+    DRAFT_MODEL_PATH = os.getenv("DRAFT_MODEL_PATH", "")
+    # 每轮起草的token数
+    NUM_DRAFT_TOKENS = int(os.getenv("NUM_DRAFT_TOKENS", 4))
     MAX_INPUT_LENGTH = int(os.getenv("MAX_INPUT_LENGTH", 2048))
-    MAX_HISTORY_MESSAGES = int(os.getenv("MAX_HISTORY_MESSAGES", 6))
+    # 输入与生成共用的上下文长度，输入预算 = min(MAX_INPUT_LENGTH, MAX_CONTEXT_LENGTH - max_tokens)
+    MAX_CONTEXT_LENGTH = int(os.getenv("MAX_CONTEXT_LENGTH", 4096))
+    MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", 16))
+    MAX_QUEUE_SIZE = int(os.getenv("MAX_QUEUE_SIZE", 64))
+    # 非流式请求等待生成期间检查客户端是否断开的间隔（秒）
+    DISCONNECT_POLL_INTERVAL = float(os.getenv("DISCONNECT_POLL_INTERVAL", 0.5))
+    PREPROCESS_WORKERS = int(os.getenv("PREPROCESS_WORKERS", 4))
+    ENABLE_PREFIX_CACHE = os.getenv("ENABLE_PREFIX_CACHE", "true").lower() == "true"
+    SESSION_CACHE_MAX_MB = int(os.getenv("SESSION_CACHE_MAX_MB", 1024))
+    RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "false").lower() == "true"
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", 1024))
+    RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 3600))
+    RESPONSE_CACHE_SIMILARITY = float(os.getenv("RESPONSE_CACHE_SIMILARITY", 0.92))
+    # 为空时只做精确匹配
+    RESPONSE_CACHE_EMBEDDING_MODEL = os.getenv("RESPONSE_CACHE_EMBEDDING_MODEL", "")
+    # 启动时加载的LoRA适配器，格式: 角色=路径,角色=路径，例如 yaolao=lora_Qwen3-8B_yaolao
+    LORA_ADAPTERS = os.getenv("LORA_ADAPTERS", "")
+    # 运行时通过/characters接口加载的适配器必须位于该目录内，为空时不允许运行时加载
+    ADAPTERS_DIR = os.getenv("ADAPTERS_DIR", "")
+    # 角色管理接口（加载/卸载角色）的管理令牌，请求头X-Admin-Token须与之一致；为空时关闭这些接口
+    ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "")
+    # 请求未指定角色时扮演的角色，使用SYSTEM_PROMPT作为系统提示
+    DEFAULT_CHARACTER = os.getenv("DEFAULT_CHARACTER", "yaolao")
+    # 检索增强的嵌入模型（与建库时相同，如Qwen3-Embedding-0.6B），为空时关闭检索增强
+    RAG_EMBEDDING_MODEL = os.getenv("RAG_EMBEDDING_MODEL", "")
+    # 交叉编码器重排模型（如BAAI/bge-reranker-v2-m3），为空时不重排
+    RAG_RERANKER_MODEL = os.getenv("RAG_RERANKER_MODEL", "")
+    RAG_RERANK_BATCH_SIZE = int(os.getenv("RAG_RERANK_BATCH_SIZE", 16))
+    # 缓存的(查询, 段落)分数条数
+    RAG_RERANK_CACHE_SIZE = int(os.getenv("RAG_RERANK_CACHE_SIZE", 100000))
+    # 重排的延迟预算(毫秒)，预计或实际超出时退回向量检索的顺序，0表示不限制
+    RAG_RERANK_BUDGET_MS = float(os.getenv("RAG_RERANK_BUDGET_MS", 0))
+    # 向量检索距离的相对差距达到该值时跳过重排，0表示总是重排；开启字面检索后不适用
+    RAG_RERANK_SKIP_MARGIN = float(os.getenv("RAG_RERANK_SKIP_MARGIN", 0))
+    # 查询向量缓存条数，0表示不缓存；配置了路径时跨重启保留
+    RAG_EMBEDDING_CACHE_SIZE = int(os.getenv("RAG_EMBEDDING_CACHE_SIZE", 10000))
+    RAG_EMBEDDING_CACHE_PATH = os.getenv("RAG_EMBEDDING_CACHE_PATH", "")
+    # 字符n-gram的BM25字面检索，与向量检索结果融合
+    RAG_LEXICAL_ENABLED = os.getenv("RAG_LEXICAL_ENABLED", "false").lower() == "true"
+    RAG_LEXICAL_NGRAMS = os.getenv("RAG_LEXICAL_NGRAMS", "2")
+    # 字面检索置信度（第一名覆盖的查询n-gram的IDF占比）达到该值时直接用字面检索结果，0表示不走快速路径
+    RAG_LEXICAL_FAST_PATH = float(os.getenv("RAG_LEXICAL_FAST_PATH", 0))
+    RAG_RRF_K = int(os.getenv("RAG_RRF_K", 60))
+    # 向量库: chroma 或 mmap（vector_store.py导出的内存映射矩阵，目录为RAG_MMAP_PATH）
+    RAG_VECTOR_STORE = os.getenv("RAG_VECTOR_STORE", "chroma")
+    RAG_MMAP_PATH = os.getenv("RAG_MMAP_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rag", "vectors"))
+    RAG_DB_PATH = os.getenv("RAG_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "rag", "data.db"))
+    RAG_COLLECTION = os.getenv("RAG_COLLECTION", "my_collection")
+    # 向量检索召回的段落数，以及重排后放入提示的段落数
+    RAG_TOP_K = int(os.getenv("RAG_TOP_K", 5))
+    RAG_RERANK_TOP_K = int(os.getenv("RAG_RERANK_TOP_K", 2))
+    # 查询改写规则，格式: 正则=替换,正则=替换；默认把第一/二人称换成萧炎/药老
+    RAG_QUERY_REWRITES = os.getenv("RAG_QUERY_REWRITES", "我=萧炎,你|您=药老")
+    # 背景信息的位置: system追加在系统提示之后；user放在最新的用户消息之前，
+    # 系统提示和历史保持不变，会话KV缓存可以跨轮复用
+    RAG_CONTEXT_POSITION = os.getenv("RAG_CONTEXT_POSITION", "system")
     
     SYSTEM_PROMPT = """
 你是小说《斗破苍穹》中的角色药老，是主角萧炎的老师。
@@ -93,6 +210,19 @@ class ChatRequest(BaseModel):
     temperature: Optional[float] = Field(0.7, ge=0.1, le=2.0, description="温度参数")
     top_p: Optional[float] = Field(0.9, ge=0.1, le=1.0, description="Top-p采样参数")
     repetition_penalty: Optional[float] = Field(1.1, ge=1.0, le=2.0, description="重复惩罚")
+    stream: Optional[bool] = Field(False, description="是否以SSE流式返回")
+    conversation_id: Optional[str] = Field(None, max_length=128, description="会话ID，携带时服务端复用上一轮的KV缓存")
+    character: Optional[str] = Field(None, max_length=64, description="扮演的角色，缺省为默认角色")
+    n: Optional[int] = Field(1, ge=1, le=8, description="候选回复数，多个候选共用一次预填充后各自采样")
+    rag: Optional[bool] = Field(True, description="服务端启用检索增强时，是否为本轮检索背景信息")
+
+class Candidate(BaseModel):
+    index: int = Field(..., description="候选序号")
+    content: str = Field(..., description="回复内容")
+    completion_tokens: int = Field(..., description="生成的token数")
+    finish_reason: Optional[str] = Field(None, description="结束原因: stop, length")
+    logprob: Optional[float] = Field(None, description="回复所有token的对数概率之和（模型原始分布）")
+    avg_logprob: Optional[float] = Field(None, description="每个token的平均对数概率")
 
 class ChatResponse(BaseModel):
     role: str = Field(..., description="回复角色")
@@ -100,16 +230,53 @@ class ChatResponse(BaseModel):
     time: str = Field(..., description="回复时间")
     status: str = Field("success", description="响应状态")
     tokens_used: Optional[int] = Field(None, description="使用的token数量")
+    acceptance_rate: Optional[float] = Field(None, description="辅助解码的草稿接受率")
+    speedup: Optional[float] = Field(None, description="辅助解码相对启动自测单请求解码速度的加速比")
+    candidates: Optional[List[Candidate]] = Field(None, description="n大于1时的全部候选，content为第一个候选")
+    timings: Optional[dict] = Field(None, description="生成前各预处理阶段耗时(秒)")
 
 class SimpleChatRequest(BaseModel):
     message: str = Field(..., description="用户消息")
     max_tokens: Optional[int] = Field(512, ge=1, le=2048, description="最大生成长度")
+    stream: Optional[bool] = Field(False, description="是否以SSE流式返回")
+    use_cache: Optional[bool] = Field(True, description="是否读取回复缓存，为false时强制重新生成")
+    character: Optional[str] = Field(None, max_length=64, description="扮演的角色，缺省为默认角色")
+
+class WebSocketChatMessage(BaseModel):
+    type: str = Field("message", description="message: 发送一条用户消息; history: 重连后用客户端保存的历史恢复会话; reset: 清空历史")
+    content: Optional[str] = Field(None, description="用户消息，type为message时必填")
+    messages: Optional[List[ChatMessage]] = Field(None, description="对话历史，type为history时使用")
+    max_tokens: Optional[int] = Field(512, ge=1, le=2048, description="最大生成长度")
+    temperature: Optional[float] = Field(0.7, ge=0.1, le=2.0, description="温度参数")
+    top_p: Optional[float] = Field(0.9, ge=0.1, le=1.0, description="Top-p采样参数")
+    repetition_penalty: Optional[float] = Field(1.1, ge=1.0, le=2.0, description="重复惩罚")
+    rag: Optional[bool] = Field(True, description="服务端启用检索增强时，是否为本轮检索背景信息")
+
+class CharacterLoadRequest(BaseModel):
+    name: str = Field(
+        ...,
+        min_length=1,
+        max_length=64,
+        pattern=CHARACTER_NAME_PATTERN,
+        description="角色名（字母、数字、下划线、连字符或汉字），已存在时热更新其适配器"
+    )
+    adapter_path: str = Field(..., description="LoRA适配器目录，相对于ADAPTERS_DIR，须为safetensors格式")
+    system_prompt: Optional[str] = Field(None, description="角色的系统提示，缺省读取适配器目录中的system_prompt.txt")
 
 class HealthResponse(BaseModel):
     status: str = Field(..., description="服务状态")
     model_loaded: bool = Field(..., description="模型是否加载")
+    state: str = Field(..., description="启动阶段: starting, loading, warming_up, ready, failed")
+    startup_timings: Optional[dict] = Field(None, description="各启动阶段耗时(秒)")
     timestamp: str = Field(..., description="检查时间")
     device: Optional[str] = Field(None, description="模型运行设备")
+    precision: Optional[str] = Field(None, description="推理精度模式")
+    benchmark: Optional[dict] = Field(None, description="启动自测的吞吐")
+    queue_depth: Optional[int] = Field(None, description="排队等待的生成请求数")
+    running_requests: Optional[int] = Field(None, description="正在生成的请求数")
+    session_cache: Optional[dict] = Field(None, description="会话KV缓存统计")
+    response_cache: Optional[dict] = Field(None, description="回复缓存统计")
+    rag: Optional[dict] = Field(None, description="检索服务统计，未启用时为空")
 
 # 全局模型变量
 class ModelManager:
@@ -117,111 +284,704 @@ class ModelManager:
         self.tokenizer = None
         self.model = None
         self.device = None
+        self.draft_model = None
+        self.retriever = None
+        self.precision = None
+        self.benchmark = None
+        self.scheduler = None
+        self.encoder = None
+        self.packer = None
+        self.registry = AdapterRegistry(Config.DEFAULT_CHARACTER)
+        # 各角色已登记前缀缓存的系统提示，用于发现提示变化
+        self.cached_system_prompts = {}
+        # 分词等预处理放到线程池中，避免阻塞事件循环
+        self.executor = ThreadPoolExecutor(
+            max_workers=Config.PREPROCESS_WORKERS,
+            thread_name_prefix="preprocess"
+        )
         self.is_loaded = False
+        # 启动阶段，就绪探针据此判断能否接收流量
+        self.state = "starting"
+        self.startup_timings = {}
+    
+    @contextmanager
+    def _timed(self, phase: str):
+        """记录一个启动阶段的耗时"""
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.startup_timings[phase] = round(time.perf_counter() - start_time, 3)
+    
+    def _load_causal_lm(self, path: str, device: str):
+        """加载模型权重：目录中有safetensors文件时以内存映射方式按需读取，峰值内存约为一份权重"""
+        use_safetensors = None
+        if os.path.isdir(path) and any(f.endswith(".safetensors") for f in os.listdir(path)):
+            use_safetensors = True
+        return AutoModelForCausalLM.from_pretrained(
+            path,
+            trust_remote_code=True,
+            torch_dtype=torch_dtype(self.precision),
+            device_map="auto" if device == "cuda" else device,
+            low_cpu_mem_usage=True,
+            use_safetensors=use_safetensors
+        )
     
     def load_model(self):
-        """加载模型和分词器"""
+        """加载模型和分词器，预热后进入就绪状态"""
+        self.state = "loading"
+        start_time = time.perf_counter()
         try:
+            # 检索服务与主模型互不依赖，在线程池中并行加载
+            retriever_future = None
+            if Config.RAG_EMBEDDING_MODEL:
+                retriever_future = self.executor.submit(self.load_retriever)
+            
             logger.info("正在加载分词器...")
-            self.tokenizer = AutoTokenizer.from_pretrained(
-                Config.MODEL_NAME,
-                trust_remote_code=True
-            )
+            with self._timed("tokenizer"):
+                self.tokenizer = AutoTokenizer.from_pretrained(
+                    Config.MODEL_NAME,
+                    trust_remote_code=True
+                )
+                
+                if self.tokenizer.pad_token is None:
+                    self.tokenizer.pad_token = self.tokenizer.eos_token
+                self.encoder = IncrementalEncoder(self.tokenizer)
+                self.packer = HistoryPacker(self.encoder)
             
-            if self.tokenizer.pad_token is None:
-                self.tokenizer.pad_token = self.tokenizer.eos_token
+            device = resolve_device(Config.DEVICE)
+            self.precision = resolve_precision(Config.PRECISION, device)
+            if device == "cpu":
+                if Config.CPU_AFFINITY:
+                    pin_cpus(parse_cpu_list(Config.CPU_AFFINITY))
+                configure_threads(Config.NUM_THREADS)
             
-            logger.info("正在加载基础模型...")
-            self.model = AutoModelForCausalLM.from_pretrained(
-                Config.MODEL_NAME,
-                trust_remote_code=True,
-                torch_dtype=torch.float16,
-                device_map="auto",
-                low_cpu_mem_usage=True
-            )
+            logger.info(f"正在加载基础模型... 设备: {device}, 精度: {self.precision}")
+            with self._timed("weights"):
+                self.model = self._load_causal_lm(Config.MODEL_NAME, device)
             
-            # 检查是否有可用的LoRA权重
-            # lora_path = "lora_Qwen3-8B_yaolao"
-            # if os.path.exists(lora_path):
-            #     logger.info("正在加载LoRA权重...")
-            #     self.model = PeftModel.from_pretrained(
-            #         self.model,
-            #         lora_path,
-            #         torch_dtype=torch.float16
-            #     )
+            # 所有角色的LoRA适配器挂载在同一个基础模型上
+            with self._timed("adapters"):
+                for name, adapter_path in parse_adapter_config(Config.LORA_ADAPTERS).items():
+                    try:
+                        self.model = self.registry.load(self.model, name, adapter_path)
+                    except Exception as e:
+                        logger.error(f"角色 {name} 的LoRA权重加载失败: {str(e)}")
+            
+            # 量化在挂载适配器之后进行：LoRA包装的基础层一并量化，lora_A/lora_B保持浮点
+            if self.precision == "int8":
+                with self._timed("quantize"):
+                    count = quantize_linear_int8(self.model)
+                self.registry.freeze("int8量化模式下不支持运行时加载适配器，请通过LORA_ADAPTERS在启动时配置")
+                logger.info(f"已对 {count} 个线性层做int8动态量化")
             
             self.model.eval()
             self.device = self.model.device
+            draft = None
+            if Config.DRAFT_MODEL_PATH:
+                with self._timed("draft"):
+                    draft = self.load_draft_model(device)
+            
+            if Config.STARTUP_BENCHMARK:
+                with self._timed("benchmark"):
+                    self.benchmark = benchmark_decode(self.model, self.device, len(self.tokenizer))
+                logger.info(
+                    f"启动自测({self.precision}): 预填充 {self.benchmark['prefill_tokens_per_second']} tokens/s, "
+                    f"解码 {self.benchmark['decode_tokens_per_second']} tokens/s"
+                )
+            
+            # 启动连续批处理调度器，并发请求共享批量前向计算
+            eos_token_ids = self.model.generation_config.eos_token_id
+            if not isinstance(eos_token_ids, list):
+                eos_token_ids = [eos_token_ids]
+            session_cache = None
+            if Config.SESSION_CACHE_MAX_MB > 0:
+                session_cache = SessionCache(Config.SESSION_CACHE_MAX_MB * 2**20)
+            self.scheduler = BatchScheduler(
+                self.model,
+                self.device,
+                eos_token_ids=[t for t in eos_token_ids + [self.tokenizer.eos_token_id] if t is not None],
+                max_batch_size=Config.MAX_BATCH_SIZE,
+                max_queue_size=Config.MAX_QUEUE_SIZE,
+                session_cache=session_cache,
+                draft=draft
+            )
+            if Config.ENABLE_PREFIX_CACHE:
+                for name in list(self.registry.characters):
+                    self.refresh_system_prefix(name)
+            self.scheduler.start()
+            
+            if Config.WARMUP:
+                self.state = "warming_up"
+                with self._timed("warmup"):
+                    self.warmup()
+            
+            if retriever_future is not None:
+                retriever_future.result()
+            
+            self.startup_timings["total"] = round(time.perf_counter() - start_time, 3)
             self.is_loaded = True
+            self.state = "ready"
             
             logger.info(f"模型加载完成！设备: {self.device}")
+            logger.info("启动耗时: " + ", ".join(f"{k} {v}s" for k, v in self.startup_timings.items()))
             
         except Exception as e:
             logger.error(f"模型加载失败: {str(e)}")
             self.is_loaded = False
+            self.state = "failed"
             raise e
     
-    def generate_response(self, messages: List[dict], generation_config: dict) -> tuple[str, int]:
-        """生成回复内容"""
-        if not self.is_loaded:
-            raise RuntimeError("模型未加载")
+    def warmup(self):
+        """就绪前走一遍完整的生成路径（分词、前缀缓存、预填充、批量解码），避免首个请求承担初始化开销"""
+        messages = [
+            {"role": "system", "content": self.system_prompt_for(self.registry.get(None))},
+            {"role": "user", "content": "你好"}
+        ]
+        input_ids = self._prepare_inputs(messages, Config.WARMUP_TOKENS)
+        request = self._build_request(
+            input_ids,
+            {"max_new_tokens": Config.WARMUP_TOKENS, "do_sample": False},
+            record_metrics=False
+        )
+        self.scheduler.submit(request).wait()
+    
+    def load_draft_model(self, device: str) -> Optional[DraftModel]:
+        """加载辅助解码的起草模型，与主模型使用相同的设备和精度；加载失败时关闭辅助解码"""
+        if not Config.DRAFT_MODEL_PATH:
+            return None
         
-        # 应用聊天模板
-        formatted_prompt = self.tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True
+        try:
+            logger.info(f"正在加载起草模型: {Config.DRAFT_MODEL_PATH}")
+            self.draft_model = self._load_causal_lm(Config.DRAFT_MODEL_PATH, device)
+            if self.draft_model.config.vocab_size != self.model.config.vocab_size:
+                raise ValueError(
+                    f"词表大小不一致（起草模型 {self.draft_model.config.vocab_size}，"
+                    f"主模型 {self.model.config.vocab_size}）"
+                )
+            if self.precision == "int8":
+                quantize_linear_int8(self.draft_model)
+            self.draft_model.eval()
+        except Exception as e:
+            logger.error(f"起草模型加载失败，辅助解码已关闭: {str(e)}")
+            self.draft_model = None
+            return None
+        
+        logger.info(f"辅助解码已启用，每轮起草 {Config.NUM_DRAFT_TOKENS} 个token")
+        return DraftModel(self.draft_model, self.device, Config.NUM_DRAFT_TOKENS)
+    
+    def load_retriever(self):
+        """加载检索服务，失败时关闭检索增强，不影响对话"""
+        try:
+            device = resolve_device(Config.DEVICE)
+            reranker = None
+            if Config.RAG_RERANKER_MODEL:
+                reranker = Reranker(
+                    Config.RAG_RERANKER_MODEL,
+                    device=device,
+                    batch_size=Config.RAG_RERANK_BATCH_SIZE,
+                    max_cache_entries=Config.RAG_RERANK_CACHE_SIZE,
+                    latency_budget=Config.RAG_RERANK_BUDGET_MS / 1000,
+                    skip_margin=Config.RAG_RERANK_SKIP_MARGIN
+                )
+            embedding_cache = None
+            if Config.RAG_EMBEDDING_CACHE_SIZE > 0:
+                embedding_cache = EmbeddingCache(Config.RAG_EMBEDDING_CACHE_SIZE, Config.RAG_EMBEDDING_CACHE_PATH)
+            lexical = None
+            if Config.RAG_LEXICAL_ENABLED:
+                lexical = LexicalIndex([int(n) for n in Config.RAG_LEXICAL_NGRAMS.split(",") if n.strip()])
+            if Config.RAG_VECTOR_STORE == "mmap":
+                store = MmapStore(Config.RAG_MMAP_PATH)
+            elif Config.RAG_VECTOR_STORE == "chroma":
+                store = ChromaStore(Config.RAG_DB_PATH, Config.RAG_COLLECTION)
+            else:
+                raise ValueError(f"不支持的向量库: {Config.RAG_VECTOR_STORE}，可选: chroma, mmap")
+            retriever = Retriever(
+                store,
+                Config.RAG_EMBEDDING_MODEL,
+                reranker=reranker,
+                embedding_cache=embedding_cache,
+                lexical=lexical,
+                lexical_fast_path=Config.RAG_LEXICAL_FAST_PATH,
+                rrf_k=Config.RAG_RRF_K,
+                top_k=Config.RAG_TOP_K,
+                rerank_top_k=Config.RAG_RERANK_TOP_K,
+                rewrite_rules=parse_rewrite_rules(Config.RAG_QUERY_REWRITES),
+                device=device
+            )
+            with self._timed("retriever"):
+                timings = retriever.load()
+            logger.info("检索服务加载耗时: " + ", ".join(f"{k} {v}s" for k, v in timings.items()))
+            self.retriever = retriever
+        except Exception as e:
+            logger.error(f"检索服务加载失败，检索增强已关闭: {str(e)}", exc_info=True)
+    
+    def speculative_stats(self, request: GenerationRequest) -> dict:
+        """请求的草稿接受率，以及相对启动自测（不用辅助解码）的解码加速比"""
+        stats = request.stats()
+        if "acceptance_rate" not in stats:
+            return {}
+        speedup = None
+        if self.benchmark and stats["tokens_per_second"]:
+            speedup = round(stats["tokens_per_second"] / self.benchmark["decode_tokens_per_second"], 2)
+        logger.info(
+            f"辅助解码: 接受率 {stats['acceptance_rate']}, 每步产出 {stats['tokens_per_step']} tokens, "
+            f"加速比 {speedup}"
         )
+        return {"acceptance_rate": stats["acceptance_rate"], "speedup": speedup}
+    
+    def system_prompt_for(self, character: Character) -> str:
+        """角色的系统提示，未单独配置时使用全局提示"""
+        return character.system_prompt or Config.SYSTEM_PROMPT
+    
+    def refresh_system_prefix(self, name: Optional[str] = None):
+        """对模板化后的系统提示分词，交给调度器预先计算KV缓存"""
+        character = self.registry.get(name)
+        system_prompt = self.system_prompt_for(character)
+        prefix_ids = self.encoder.encode(
+            [{"role": "system", "content": system_prompt}],
+            add_generation_prompt=False
+        )
+        self.scheduler.set_system_prefix(prefix_ids, character.name, character.adapter)
+        self.cached_system_prompts[character.name] = system_prompt
+    
+    def persona_version(self, name: Optional[str] = None) -> str:
+        """当前人设版本（模型、角色适配器与系统提示），作为回复缓存键的一部分"""
+        character = self.registry.get(name)
+        persona = "\n".join([
+            Config.MODEL_NAME,
+            character.name,
+            f"{character.adapter_path}@{character.loaded_time}",
+            self.system_prompt_for(character)
+        ])
+        return hashlib.sha1(persona.encode("utf-8")).hexdigest()[:12]
+    
+    async def load_character(self, name: str, adapter_path: str, system_prompt: Optional[str] = None) -> Character:
+        """运行时加载（或热更新）角色适配器，基础权重不重新加载"""
+        # 读取权重在线程池中进行，不阻塞解码
+        loop = asyncio.get_running_loop()
+        adapter = await loop.run_in_executor(self.executor, self.registry.read, name, adapter_path, system_prompt)
         
-        logger.debug(f"格式化后的提示: {formatted_prompt}")
+        def swap():
+            previous = self.registry.characters.get(name)
+            if previous is not None and previous.adapter is not None:
+                self.scheduler.fail_adapter(previous.adapter, RuntimeError(f"角色 {name} 的适配器正在重新加载"))
+            self.scheduler.drop_system_prefix(name)
+            self.model = self.registry.attach(self.model, adapter)
+            self.scheduler.model = self.model
         
-        # Tokenize
-        inputs = self.tokenizer(
-            formatted_prompt,
-            return_tensors="pt",
-            truncation=True,
-            max_length=Config.MAX_INPUT_LENGTH
-        ).to(self.device)
+        # 修改模型结构必须与解码串行，交给调度线程在两步之间执行；这里只挂载已读入内存的权重
+        await asyncio.wrap_future(self.scheduler.call_in_loop(swap))
+        if Config.ENABLE_PREFIX_CACHE:
+            self.refresh_system_prefix(name)
+        return self.registry.get(name)
+    
+    async def unload_character(self, name: str):
+        """卸载角色适配器并释放其LoRA权重；默认角色退回基础模型"""
+        character = self.registry.get(name)
         
-        input_tokens = inputs['input_ids'].shape[1]
-        logger.info(f"输入token数量: {input_tokens}")
+        def swap():
+            if character.adapter is not None:
+                self.scheduler.fail_adapter(character.adapter, RuntimeError(f"角色 {name} 已卸载"))
+            self.scheduler.drop_system_prefix(name)
+            self.model = self.registry.unload(self.model, name)
+            self.scheduler.model = self.model
         
-        # 生成回复
-        with torch.no_grad():
-            outputs = self.model.generate(
-                **inputs,
-                **generation_config
+        await asyncio.wrap_future(self.scheduler.call_in_loop(swap))
+        self.cached_system_prompts.pop(name, None)
+        if Config.ENABLE_PREFIX_CACHE and name in self.registry.characters:
+            self.refresh_system_prefix(name)
+    
+    def _check_system_prefix(self, character: Character):
+        """系统提示被修改后重建前缀缓存"""
+        if (Config.ENABLE_PREFIX_CACHE
+                and self.cached_system_prompts.get(character.name) != self.system_prompt_for(character)):
+            logger.info(f"角色 {character.name} 的系统提示已变化，重建前缀缓存")
+            self.refresh_system_prefix(character.name)
+    
+    def _pretokenize(self, messages: List[dict], character: Character) -> float:
+        """在检索的同时检查系统提示前缀并对历史消息分词（结果进入增量编码器的缓存），返回耗时"""
+        start_time = time.perf_counter()
+        self._check_system_prefix(character)
+        for message in messages:
+            if message["role"] != "system":
+                self.encoder.segment_ids(message)
+        return round(time.perf_counter() - start_time, 4)
+    
+    def _inject_context(self, messages: List[dict], chunks: List[str]) -> List[dict]:
+        """把检索到的背景信息放入系统提示或最新的用户消息"""
+        if not chunks:
+            return messages
+        context = build_context(chunks)
+        messages = list(messages)
+        if Config.RAG_CONTEXT_POSITION == "user":
+            index = max(i for i, m in enumerate(messages) if m["role"] == "user")
+            messages[index] = {**messages[index], "content": f"{context}\n\n{messages[index]['content']}"}
+        else:
+            index = next((i for i, m in enumerate(messages) if m["role"] == "system"), None)
+            if index is None:
+                messages.insert(0, {"role": "system", "content": context})
+            else:
+                # 背景信息追加在原系统提示之后，系统提示前缀的KV缓存仍能复用
+                messages[index] = {**messages[index], "content": f"{messages[index]['content']}\n{context}"}
+        return messages
+    
+    async def _retrieve_and_pretokenize(
+        self,
+        messages: List[dict],
+        character: Character,
+        rag_query: str,
+        timings: dict
+    ) -> List[dict]:
+        """检索与历史分词、前缀检查并行执行，返回放入背景信息后的消息"""
+        loop = asyncio.get_running_loop()
+        start_time = time.perf_counter()
+        try:
+            (chunks, search_timings), pretokenize_time = await asyncio.gather(
+                loop.run_in_executor(self.executor, self.retriever.search, rag_query),
+                loop.run_in_executor(self.executor, self._pretokenize, messages, character)
             )
+        except Exception as e:
+            # 检索失败时不带背景信息继续生成
+            logger.error(f"检索失败: {str(e)}", exc_info=True)
+            return messages
+        timings.update(search_timings)
+        timings["pretokenize"] = pretokenize_time
+        timings["retrieval_stage"] = round(time.perf_counter() - start_time, 4)
+        timings["retrieved_chunks"] = len(chunks)
+        return self._inject_context(messages, chunks)
+    
+    def _prepare_inputs(
+        self,
+        messages: List[dict],
+        max_new_tokens: int = 512,
+        session_id: Optional[str] = None,
+        character: Optional[Character] = None
+    ) -> List[int]:
+        """按token预算打包历史，应用聊天模板并转换为输入token"""
+        character = character or self.registry.get(None)
+        self._check_system_prefix(character)
+        
+        # 为生成预留max_new_tokens，剩余部分留给输入
+        budget = min(Config.MAX_INPUT_LENGTH, Config.MAX_CONTEXT_LENGTH - max_new_tokens)
+        messages = self.packer.pack(messages, budget, session_id)
+        
+        # 应用聊天模板并分词：只有新出现的消息需要分词，其余直接拼接缓存的token
+        # （打包后不再截断，截断会切掉末尾的生成提示）
+        input_ids = self.encoder.encode(messages)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f"格式化后的提示: {self.tokenizer.decode(input_ids)}")
+        
+        if len(input_ids) > budget:
+            raise PromptTooLongError(f"输入长度 {len(input_ids)} 超出预算 {budget} tokens")
+        
+        return input_ids
+    
+    def _build_request(
+        self,
+        input_ids: List[int],
+        generation_config: dict,
+        session_id: Optional[str] = None,
+        character: Optional[Character] = None,
+        record_metrics: bool = True
+    ) -> GenerationRequest:
+        """构建生成请求，采样参数按请求各自保留；预热请求不计入请求数和耗时指标"""
+        character = character or self.registry.get(None)
+        logger.info(f"输入token数量: {len(input_ids)}")
         
-        # 解码回复（只取新生成的部分）
-        response_tokens = outputs[0][input_tokens:]
-        response_text = self.tokenizer.decode(response_tokens, skip_special_tokens=True)
+        eos_token_id = generation_config.get("eos_token_id")
+        num_candidates = generation_config.get("num_return_sequences", 1)
+        request = GenerationRequest(
+            input_ids,
+            max_new_tokens=generation_config.get("max_new_tokens", 512),
+            temperature=generation_config.get("temperature", 1.0),
+            top_p=generation_config.get("top_p", 1.0),
+            top_k=generation_config.get("top_k", self.model.generation_config.top_k or 0),
+            repetition_penalty=generation_config.get("repetition_penalty", 1.0),
+            do_sample=generation_config.get("do_sample", True),
+            eos_token_ids=[eos_token_id] if eos_token_id is not None else None,
+            session_id=session_id,
+            character=character.name,
+            adapter=character.adapter,
+            # 多个候选时返回对数概率，便于比较和挑选
+            logprobs=num_candidates > 1
+        )
+        if record_metrics:
+            request.add_done_callback(metrics.record_generation)
+        for _ in range(num_candidates - 1):
+            request.fork()
+        return request
+    
+    async def asubmit(
+        self,
+        messages: List[dict],
+        generation_config: dict,
+        session_id: Optional[str] = None,
+        character_name: Optional[str] = None,
+        rag_query: Optional[str] = None
+    ) -> GenerationRequest:
+        """异步提交生成请求：先做准入检查，检索和分词在线程池中完成，事件循环只负责等待
+        
+        带rag_query且启用了检索服务时，检索与历史消息的分词并行，背景信息放入提示后再编码。
+        """
+        if not self.is_loaded:
+            raise RuntimeError("模型未加载")
+        
+        # 队列已满或角色不存在时在分词之前就拒绝
+        self.scheduler.check_admission()
+        character = self.registry.get(character_name)
+        
+        timings = {}
+        if rag_query and self.retriever is not None:
+            messages = await self._retrieve_and_pretokenize(messages, character, rag_query, timings)
+        
+        loop = asyncio.get_running_loop()
+        tokenize_start = time.perf_counter()
+        input_ids = await loop.run_in_executor(
+            self.executor,
+            self._prepare_inputs,
+            messages,
+            generation_config.get("max_new_tokens", 512),
+            session_id,
+            character
+        )
+        timings["tokenize"] = round(time.perf_counter() - tokenize_start, 4)
+        for stage, seconds in timings.items():
+            if stage != "retrieved_chunks":
+                metrics.PREPROCESS_SECONDS.labels(stage).observe(seconds)
+        
+        request = self._build_request(input_ids, generation_config, session_id, character)
+        request.timings = timings
+        request.bind_loop(loop)
+        return self.scheduler.submit(request)
+    
+    def _decode_response(self, request: GenerationRequest) -> tuple[str, int]:
+        """解码回复（只取新生成的部分）"""
+        response_text = self.tokenizer.decode(request.output_ids, skip_special_tokens=True)
         
         # 清理可能的重复或格式问题
         response_text = response_text.strip()
-        total_tokens = outputs[0].shape[0]
+        total_tokens = len(request.input_ids) + len(request.output_ids)
         
         return response_text, total_tokens
+    
+    async def wait_response(self, request: GenerationRequest) -> tuple[str, int]:
+        """等待已提交的请求生成完毕"""
+        async for _ in request.aiter_tokens():
+            pass
+        return self._decode_response(request)
+    
+    def logprob_stats(self, request: GenerationRequest) -> dict:
+        """回复的总对数概率和每token平均对数概率，未记录时为空"""
+        if not request.logprobs or not request.output_logprobs:
+            return {}
+        total = sum(request.output_logprobs)
+        return {
+            "logprob": round(total, 4),
+            "avg_logprob": round(total / len(request.output_logprobs), 4)
+        }
+    
+    async def wait_candidates(self, request: GenerationRequest) -> List[dict]:
+        """等待请求的所有候选生成完毕，按序号返回各自的回复、token数和对数概率"""
+        responses = await asyncio.gather(*(self.wait_response(member) for member in request.group))
+        return [
+            {
+                "index": index,
+                "content": content,
+                "completion_tokens": len(member.output_ids),
+                "finish_reason": member.finish_reason,
+                **self.logprob_stats(member)
+            }
+            for index, (member, (content, _)) in enumerate(zip(request.group, responses))
+        ]
+    
+    async def stream_response(self, request: GenerationRequest) -> AsyncIterator[dict]:
+        """流式产出文本增量，最后产出首token时间和生成速度"""
+        decoder = IncrementalDecoder(self.tokenizer)
+        
+        async for token_id in request.aiter_tokens():
+            text = decoder.push(token_id)
+            if text:
+                yield {"type": "delta", "content": text}
+        
+        stats = request.stats()
+        yield {
+            "type": "done",
+            "tokens_used": stats["prompt_tokens"] + stats["completion_tokens"],
+            "completion_tokens": stats["completion_tokens"],
+            "time_to_first_token": stats["time_to_first_token"],
+            "tokens_per_second": stats["tokens_per_second"],
+            **self.speculative_stats(request),
+            **self.logprob_stats(request),
+            **({"timings": request.timings} if request.timings else {}),
+            "time": datetime.now().strftime("%H:%M")
+        }
+    
+    async def stream_candidates(self, request: GenerationRequest) -> AsyncIterator[dict]:
+        """合并多个候选的流式事件，按到达顺序产出，每个事件带候选序号index"""
+        events = asyncio.Queue()
+        
+        async def pump(index: int, member: GenerationRequest):
+            try:
+                async for event in self.stream_response(member):
+                    await events.put({**event, "index": index})
+            except Exception as e:
+                await events.put(e)
+            finally:
+                await events.put(None)
+        
+        tasks = [asyncio.create_task(pump(i, member)) for i, member in enumerate(request.group)]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                event = await events.get()
+                if event is None:
+                    remaining -= 1
+                elif isinstance(event, Exception):
+                    raise event
+                else:
+                    yield event
+        finally:
+            for task in tasks:
+                task.cancel()
+
+async def sse_stream(request: GenerationRequest, on_complete=None) -> AsyncIterator[str]:
+    """将流式生成结果包装为SSE事件，结束后把完整回复交给on_complete"""
+    try:
+        chunks = []
+        if request.forks:
+            events = model_manager.stream_candidates(request)
+        else:
+            events = model_manager.stream_response(request)
+        async for event in events:
+            if event["type"] == "delta":
+                chunks.append(event["content"])
+            elif event["type"] == "done" and on_complete is not None:
+                on_complete("".join(chunks).strip(), event["tokens_used"])
+            yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+    except Exception as e:
+        logger.error(f"流式生成失败: {str(e)}", exc_info=True)
+        error_event = {"type": "error", "detail": f"生成失败: {str(e)}"}
+        yield f"data: {json.dumps(error_event, ensure_ascii=False)}\n\n"
+    finally:
+        # 客户端断开时响应任务被取消，生成随之取消
+        if not all(member.finished for member in request.group):
+            logger.info("客户端已断开，取消流式生成")
+            request.cancel()
+
+def streaming_response(request: GenerationRequest, on_complete=None) -> StreamingResponse:
+    """构建SSE响应"""
+    return StreamingResponse(
+        sse_stream(request, on_complete),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def cached_sse_stream(cached: dict) -> AsyncIterator[str]:
+    """把缓存的回复按流式接口的事件格式一次性返回"""
+    events = [
+        {"type": "delta", "content": cached["response"]},
+        {
+            "type": "done",
+            "tokens_used": cached["tokens_used"],
+            "completion_tokens": None,
+            "time_to_first_token": 0.0,
+            "tokens_per_second": None,
+            "cached": True,
+            "time": datetime.now().strftime("%H:%M")
+        }
+    ]
+    for event in events:
+        yield f"data: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+# 客户端在收到响应前断开（沿用nginx的约定），只用于日志和指标
+CLIENT_CLOSED_REQUEST = 499
+
+@asynccontextmanager
+async def cancel_on_disconnect(http_request: Request, gen_request: GenerationRequest):
+    """非流式请求等待生成期间，客户端断开或等待被取消时取消生成，释放批次位置"""
+    async def watch():
+        while not all(member.finished for member in gen_request.group):
+            if await http_request.is_disconnected():
+                logger.info("客户端已断开，取消生成")
+                gen_request.cancel()
+                return
+            await asyncio.sleep(Config.DISCONNECT_POLL_INTERVAL)
+    
+    watcher = asyncio.create_task(watch())
+    try:
+        yield
+    finally:
+        watcher.cancel()
+        if not all(member.finished for member in gen_request.group):
+            gen_request.cancel()
+
+def queue_full_exception(error: QueueFullError) -> HTTPException:
+    """队列已满时返回429，并告知客户端多久后重试"""
+    logger.warning(str(error))
+    metrics.GENERATION_REJECTED.labels("queue_full").inc()
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=str(error),
+        headers={"Retry-After": str(error.retry_after)}
+    )
 
 # 初始化模型管理器
 model_manager = ModelManager()
+# 常见问题的回复缓存，未启用时为None
+response_cache: Optional[ResponseCache] = None
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    """应用生命周期管理"""
-    # 启动时加载模型
+def init_response_cache():
+    """按配置创建回复缓存，嵌入模型不可用时退化为仅精确匹配"""
+    global response_cache
+    if not Config.RESPONSE_CACHE_ENABLED:
+        return
+    
+    embedder = None
+    if Config.RESPONSE_CACHE_EMBEDDING_MODEL:
+        try:
+            from sentence_transformers import SentenceTransformer
+            embedder = SentenceTransformer(Config.RESPONSE_CACHE_EMBEDDING_MODEL)
+        except Exception as e:
+            logger.warning(f"回复缓存嵌入模型加载失败，仅使用精确匹配: {str(e)}")
+    
+    response_cache = ResponseCache(
+        max_entries=Config.RESPONSE_CACHE_MAX_ENTRIES,
+        ttl=Config.RESPONSE_CACHE_TTL,
+        similarity_threshold=Config.RESPONSE_CACHE_SIMILARITY,
+        embedder=embedder
+    )
+    logger.info(f"回复缓存已启用，语义匹配: {'开启' if embedder is not None else '关闭'}")
+
+def startup():
+    """后台加载模型和回复缓存"""
     try:
         model_manager.load_model()
+        init_response_cache()
         logger.info("应用启动完成")
     except Exception as e:
         logger.error(f"应用启动失败: {str(e)}")
         model_manager.is_loaded = False
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """应用生命周期管理"""
+    if Config.NUM_WORKERS > 1:
+        logger.warning("NUM_WORKERS>1时请用 python router.py 或 uvicorn router:app 启动，本进程按单进程运行")
+    # 模型在后台线程中加载，服务立即开始监听，存活探针可用，就绪探针在预热完成后才通过
+    threading.Thread(target=startup, name="startup", daemon=True).start()
     
     yield
     
     # 关闭时清理资源
+    if model_manager.scheduler is not None:
+        model_manager.scheduler.stop()
+    model_manager.executor.shutdown(wait=False)
+    if model_manager.retriever is not None:
+        model_manager.retriever.save()
     if model_manager.model is not None:
         del model_manager.model
+        model_manager.draft_model = None
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         logger.info("模型资源已释放")
@@ -234,6 +994,9 @@ app = FastAPI(
     lifespan=lifespan
 )
 
+# 记录每个接口的请求数和耗时
+app.add_middleware(metrics.MetricsMiddleware)
+
 # CORS配置
 app.add_middleware(
     CORSMiddleware,
@@ -282,18 +1045,155 @@ async def login(login_request: LoginRequest):
             message="登录过程中发生错误" 
         )
 
+@app.get("/health/live", summary="存活探针")
+async def liveness():
+    """进程和事件循环正常即存活，模型加载期间也返回200"""
+    return {"status": "alive", "state": model_manager.state}
+
+@app.get("/health/ready", summary="就绪探针")
+async def readiness():
+    """模型加载并预热完成后才返回200，此前返回503，负载均衡不会把流量导入"""
+    body = {"state": model_manager.state, "startup_timings": model_manager.startup_timings}
+    if not model_manager.is_loaded:
+        raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, detail=body)
+    return {"status": "ready", **body}
+
+def update_scrape_metrics():
+    """导出指标前刷新队列、模型状态等按需读取的值"""
+    scheduler = model_manager.scheduler
+    metrics.QUEUE_DEPTH.set(scheduler.queue_depth if scheduler else 0)
+    metrics.RUNNING_REQUESTS.set(scheduler.running_count if scheduler else 0)
+    for state in ("starting", "loading", "warming_up", "ready", "failed"):
+        metrics.MODEL_STATE.labels(state).set(1 if model_manager.state == state else 0)
+    for phase, seconds in model_manager.startup_timings.items():
+        metrics.MODEL_STARTUP_SECONDS.labels(phase).set(seconds)
+    if scheduler and scheduler.session_cache:
+        stats = scheduler.session_cache.stats()
+        metrics.SESSION_CACHE_MEMORY.set(scheduler.session_cache.total_bytes)
+        metrics.SESSION_CACHE_LOOKUPS.labels("hit").set(stats["hits"])
+        metrics.SESSION_CACHE_LOOKUPS.labels("miss").set(stats["misses"])
+    if response_cache is not None:
+        stats = response_cache.stats()
+        for result in ("exact_hits", "semantic_hits", "misses"):
+            metrics.RESPONSE_CACHE_LOOKUPS.labels(result).set(stats[result])
+    if model_manager.retriever is not None:
+        metrics.LEXICAL_FAST_PATHS.labels().set(model_manager.retriever.fast_paths)
+    embedding_cache = model_manager.retriever.embedding_cache if model_manager.retriever else None
+    if embedding_cache is not None:
+        stats = embedding_cache.stats()
+        for result in ("hits", "misses"):
+            metrics.QUERY_EMBEDDING_CACHE_LOOKUPS.labels(result).set(stats[result])
+    reranker = model_manager.retriever.reranker if model_manager.retriever else None
+    if reranker is not None:
+        stats = reranker.stats()
+        metrics.RERANK_PAIRS.labels("cached").set(stats["cached_pairs"])
+        metrics.RERANK_PAIRS.labels("scored").set(stats["scored_pairs"])
+        for reason, count in stats["skipped"].items():
+            metrics.RERANK_SKIPPED.labels(reason).set(count)
+
+metrics.REGISTRY.add_collect_hook(update_scrape_metrics)
+
+@app.get("/metrics", summary="Prometheus指标")
+async def metrics_endpoint():
+    """Prometheus文本格式的服务指标"""
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/health", response_model=HealthResponse, summary="健康检查")
 async def health_check():
     """服务健康检查"""
     return HealthResponse(
         status="healthy" if model_manager.is_loaded else "unhealthy",
         model_loaded=model_manager.is_loaded,
+        state=model_manager.state,
+        startup_timings=model_manager.startup_timings,
         timestamp=datetime.now().isoformat(),
-        device=str(model_manager.device) if model_manager.is_loaded else None
+        device=str(model_manager.device) if model_manager.is_loaded else None,
+        precision=model_manager.precision if model_manager.is_loaded else None,
+        benchmark=model_manager.benchmark,
+        queue_depth=model_manager.scheduler.queue_depth if model_manager.scheduler else None,
+        running_requests=model_manager.scheduler.running_count if model_manager.scheduler else None,
+        session_cache=model_manager.scheduler.session_cache.stats()
+            if model_manager.scheduler and model_manager.scheduler.session_cache else None,
+        response_cache=response_cache.stats() if response_cache else None,
+        rag=model_manager.retriever.stats() if model_manager.retriever else None
     )
 
+@app.delete("/sessions/{conversation_id}", summary="清除会话缓存")
+async def delete_session(conversation_id: str):
+    """对话结束后主动释放该会话的KV缓存"""
+    session_cache = model_manager.scheduler.session_cache if model_manager.scheduler else None
+    removed = session_cache.pop(conversation_id) if session_cache else False
+    return {"conversation_id": conversation_id, "removed": removed}
+
+@app.get("/characters", summary="角色列表")
+async def list_characters():
+    """已注册的角色及其适配器"""
+    return {
+        "default": model_manager.registry.default_character,
+        "characters": model_manager.registry.list()
+    }
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """角色管理接口的鉴权：未配置ADMIN_TOKEN时接口关闭，否则校验请求头X-Admin-Token"""
+    if not Config.ADMIN_TOKEN:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="未配置ADMIN_TOKEN，角色管理接口已关闭")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, Config.ADMIN_TOKEN):
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="管理令牌无效")
+
+@app.post("/characters", summary="加载角色", dependencies=[Depends(require_admin)])
+async def load_character(request: CharacterLoadRequest):
+    """运行时加载角色的LoRA适配器，同名角色会被热更新"""
+    if not model_manager.is_loaded:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="模型未加载完成，请稍后重试"
+        )
+    
+    try:
+        adapter_path = resolve_adapter_path(request.adapter_path, Config.ADAPTERS_DIR)
+        character = await model_manager.load_character(request.name, adapter_path, request.system_prompt)
+        return character.to_dict()
+    except AdapterPathError as e:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail=str(e))
+    except (InvalidCharacterNameError, FileNotFoundError) as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except AdapterFrozenError as e:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=str(e))
+    except Exception as e:
+        logger.error(f"角色加载失败: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"角色加载失败: {str(e)}"
+        )
+
+@app.delete("/characters/{name}", summary="卸载角色", dependencies=[Depends(require_admin)])
+async def unload_character(name: str):
+    """卸载角色的LoRA适配器，释放显存；默认角色不能卸载，可通过POST /characters热更新"""
+    if not model_manager.is_loaded:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="模型未加载完成，请稍后重试"
+        )
+    if name == model_manager.registry.default_character:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"默认角色 {name} 不能卸载"
+        )
+    
+    try:
+        await model_manager.unload_character(name)
+        return {"name": name, "removed": True}
+    except UnknownCharacterError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except Exception as e:
+        logger.error(f"角色卸载失败: {str(e)}", exc_info=True)
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"角色卸载失败: {str(e)}"
+        )
+
 @app.post("/chat", response_model=ChatResponse, summary="对话接口")
-async def chat_completion(request: ChatRequest):
+async def chat_completion(request: ChatRequest, http_request: Request):
     """对话生成接口"""
     if not model_manager.is_loaded:
         raise HTTPException(
@@ -302,15 +1202,14 @@ async def chat_completion(request: ChatRequest):
         )
     
     try:
-        # 构建对话历史（限制历史长度）
-        recent_messages = request.messages[-Config.MAX_HISTORY_MESSAGES:] 
-        if len(request.messages) > Config.MAX_HISTORY_MESSAGES:
-            logger.info(f"对话历史截断: {len(request.messages)} -> {len(recent_messages)}")
+        # 对话历史在分词时按token预算打包
+        recent_messages = request.messages
         
         # 确保有系统提示
+        character = model_manager.registry.get(request.character)
         has_system = any(msg.role == "system" for msg in recent_messages)
         if not has_system:
-            system_message = ChatMessage(role="system", content=Config.SYSTEM_PROMPT)
+            system_message = ChatMessage(role="system", content=model_manager.system_prompt_for(character))
             recent_messages = [system_message] + recent_messages
         
         # 转换为字典格式
@@ -326,11 +1225,41 @@ async def chat_completion(request: ChatRequest):
             "do_sample": True,
             "pad_token_id": model_manager.tokenizer.pad_token_id,
             "eos_token_id": model_manager.tokenizer.eos_token_id,
-            "repetition_penalty": request.repetition_penalty
+            "repetition_penalty": request.repetition_penalty,
+            "num_return_sequences": request.n
         }
         
+        # 以最新的用户消息作为检索查询
+        rag_query = None
+        if request.rag:
+            rag_query = next((m["content"] for m in reversed(messages_dict) if m["role"] == "user"), None)
+        gen_request = await model_manager.asubmit(
+            messages_dict, generation_config, request.conversation_id, character.name, rag_query
+        )
+        if request.stream:
+            return streaming_response(gen_request)
+        
+        if gen_request.forks:
+            async with cancel_on_disconnect(http_request, gen_request):
+                candidates = await model_manager.wait_candidates(gen_request)
+            if gen_request.cancelled:
+                return Response(status_code=CLIENT_CLOSED_REQUEST)
+            total_tokens = len(gen_request.input_ids) + sum(c["completion_tokens"] for c in candidates)
+            logger.info(f"生成候选数: {len(candidates)}, 总token数: {total_tokens}")
+            return ChatResponse(
+                role="assistant",
+                content=candidates[0]["content"],
+                time=datetime.now().strftime("%H:%M"),
+                tokens_used=total_tokens,
+                candidates=candidates,
+                timings=gen_request.timings or None
+            )
+        
         # 生成回复
-        response_text, total_tokens = model_manager.generate_response(messages_dict, generation_config)
+        async with cancel_on_disconnect(http_request, gen_request):
+            response_text, total_tokens = await model_manager.wait_response(gen_request)
+        if gen_request.cancelled:
+            return Response(status_code=CLIENT_CLOSED_REQUEST)
         
         logger.info(f"生成回复长度: {len(response_text)}, 总token数: {total_tokens}")
         
@@ -338,9 +1267,17 @@ async def chat_completion(request: ChatRequest):
             role="assistant",
             content=response_text,
             time=datetime.now().strftime("%H:%M"),
-            tokens_used=total_tokens
+            tokens_used=total_tokens,
+            timings=gen_request.timings or None,
+            **model_manager.speculative_stats(gen_request)
         )
         
+    except QueueFullError as e:
+        raise queue_full_exception(e)
+    except UnknownCharacterError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except PromptTooLongError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"生成失败: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -349,7 +1286,7 @@ async def chat_completion(request: ChatRequest):
         )
 
 @app.post("/chat/simple", summary="简化版对话接口")
-async def chat_simple(request: SimpleChatRequest):
+async def chat_simple(request: SimpleChatRequest, http_request: Request):
     """简化版对话接口"""
     if not model_manager.is_loaded:
         raise HTTPException(
@@ -359,8 +1296,9 @@ async def chat_simple(request: SimpleChatRequest):
     
     try:
         # 构建消息
+        character = model_manager.registry.get(request.character)
         messages = [
-            {"role": "system", "content": Config.SYSTEM_PROMPT},
+            {"role": "system", "content": model_manager.system_prompt_for(character)},
             {"role": "user", "content": request.message}
         ]
         
@@ -373,14 +1311,59 @@ async def chat_simple(request: SimpleChatRequest):
             "repetition_penalty": 1.1
         }
         
-        response_text, total_tokens = model_manager.generate_response(messages, generation_config)
+        # 先查回复缓存，命中时完全跳过模型
+        loop = asyncio.get_running_loop()
+        cache_namespace = f"{model_manager.persona_version(character.name)}:{request.max_tokens}"
+        embedding = None
+        if response_cache is not None and request.use_cache:
+            cached, embedding = await loop.run_in_executor(
+                model_manager.executor, response_cache.lookup, request.message, cache_namespace
+            )
+            if cached is not None:
+                if request.stream:
+                    return StreamingResponse(cached_sse_stream(cached), media_type="text/event-stream")
+                return {
+                    "response": cached["response"],
+                    "time": datetime.now().strftime("%H:%M"),
+                    "tokens_used": cached["tokens_used"],
+                    "cached": True
+                }
+        
+        def store_response(response_text: str, total_tokens: int):
+            if response_cache is not None and response_text:
+                loop.run_in_executor(
+                    model_manager.executor,
+                    response_cache.store,
+                    request.message,
+                    cache_namespace,
+                    {"response": response_text, "tokens_used": total_tokens},
+                    embedding
+                )
+        
+        gen_request = await model_manager.asubmit(messages, generation_config, character_name=character.name)
+        if request.stream:
+            return streaming_response(gen_request, on_complete=store_response)
+        
+        async with cancel_on_disconnect(http_request, gen_request):
+            response_text, total_tokens = await model_manager.wait_response(gen_request)
+        # 被取消的回复不完整，不写入缓存
+        if gen_request.cancelled:
+            return Response(status_code=CLIENT_CLOSED_REQUEST)
+        store_response(response_text, total_tokens)
         
         return {
             "response": response_text,
             "time": datetime.now().strftime("%H:%M"),
-            "tokens_used": total_tokens
+            "tokens_used": total_tokens,
+            "cached": False
         }
         
+    except QueueFullError as e:
+        raise queue_full_exception(e)
+    except UnknownCharacterError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+    except PromptTooLongError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
     except Exception as e:
         logger.error(f"简化对话失败: {str(e)}", exc_info=True)
         raise HTTPException(
@@ -388,6 +1371,126 @@ async def chat_simple(request: SimpleChatRequest):
             detail=str(e)
         )
 
+@app.websocket("/ws/chat")
+async def chat_websocket(websocket: WebSocket, conversation_id: Optional[str] = None, character: Optional[str] = None):
+    """WebSocket对话：连接期间由服务端保存对话历史，客户端每轮只发送新的用户消息
+    
+    服务端事件与SSE接口相同（delta/done/error），连接建立后先发送ready事件告知会话ID。
+    连接由单独的任务持续读取，生成期间客户端断开也能立即取消进行中的生成，
+    其间收到的消息按顺序留给下一轮处理。
+    """
+    await websocket.accept()
+    if not model_manager.is_loaded:
+        await websocket.close(code=1013, reason="模型未加载完成，请稍后重试")
+        return
+    try:
+        role = model_manager.registry.get(character)
+    except UnknownCharacterError as e:
+        await websocket.close(code=1008, reason=str(e))
+        return
+    
+    conversation_id = conversation_id or uuid.uuid4().hex
+    history = []
+    await websocket.send_json({"type": "ready", "conversation_id": conversation_id, "character": role.name})
+    
+    inbox = asyncio.Queue()
+    disconnected = asyncio.Event()
+    gen_request = None
+    
+    async def read_messages():
+        while True:
+            received = await websocket.receive()
+            await inbox.put(received)
+            if received["type"] == "websocket.disconnect":
+                disconnected.set()
+                if gen_request is not None and not gen_request.finished:
+                    logger.info("WebSocket客户端已断开，取消生成")
+                    gen_request.cancel()
+                return
+    
+    reader = asyncio.create_task(read_messages())
+    try:
+        while True:
+            received = await inbox.get()
+            if received["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(received.get("code", 1000))
+            try:
+                text = received["text"] if received.get("text") is not None else received["bytes"].decode("utf-8")
+                message = WebSocketChatMessage.model_validate(json.loads(text))
+            except (ValidationError, ValueError) as e:
+                await websocket.send_json({"type": "error", "detail": f"消息格式错误: {str(e)}"})
+                continue
+            
+            if message.type == "reset":
+                history = []
+                session_cache = model_manager.scheduler.session_cache
+                if session_cache is not None:
+                    session_cache.pop(conversation_id)
+                await websocket.send_json({"type": "reset"})
+                continue
+            if message.type == "history":
+                history = [{"role": m.role, "content": m.content} for m in message.messages or [] if m.role != "system"]
+                continue
+            if message.type != "message" or not message.content:
+                await websocket.send_json({"type": "error", "detail": f"不支持的消息: {message.type}"})
+                continue
+            
+            user_message = {"role": "user", "content": message.content}
+            messages = (
+                [{"role": "system", "content": model_manager.system_prompt_for(role)}]
+                + history + [user_message]
+            )
+            generation_config = {
+                "max_new_tokens": message.max_tokens,
+                "temperature": message.temperature,
+                "top_p": message.top_p,
+                "do_sample": True,
+                "eos_token_id": model_manager.tokenizer.eos_token_id,
+                "repetition_penalty": message.repetition_penalty
+            }
+            try:
+                gen_request = await model_manager.asubmit(
+                    messages, generation_config, conversation_id, role.name,
+                    message.content if message.rag else None
+                )
+            except QueueFullError as e:
+                logger.warning(str(e))
+                metrics.GENERATION_REJECTED.labels("queue_full").inc()
+                await websocket.send_json({"type": "error", "detail": str(e), "retry_after": e.retry_after})
+                continue
+            except PromptTooLongError as e:
+                await websocket.send_json({"type": "error", "detail": str(e)})
+                continue
+            if disconnected.is_set():
+                # 检索和分词期间已断开，请求不再预填充
+                gen_request.cancel()
+                raise WebSocketDisconnect()
+            
+            try:
+                async for event in model_manager.stream_response(gen_request):
+                    if disconnected.is_set():
+                        break
+                    await websocket.send_json(event)
+            except Exception as e:
+                if isinstance(e, WebSocketDisconnect):
+                    raise
+                logger.error(f"WebSocket生成失败: {str(e)}", exc_info=True)
+                await websocket.send_json({"type": "error", "detail": f"生成失败: {str(e)}"})
+                continue
+            finally:
+                if not gen_request.finished:
+                    gen_request.cancel()
+            if disconnected.is_set():
+                raise WebSocketDisconnect()
+            
+            # 只有完整生成的一轮才计入历史
+            response_text, _ = model_manager._decode_response(gen_request)
+            history.extend([user_message, {"role": "assistant", "content": response_text}])
+    except WebSocketDisconnect:
+        logger.info(f"WebSocket会话 {conversation_id} 已断开")
+    finally:
+        reader.cancel()
+
 def get_user(db, username: str):
     if username in db:
         user_dict = db[username]
@@ -402,6 +1505,10 @@ def authenticate_user(username: str, password: str, db=fake_users_db):
     return user
 
 if __name__ == "__main__":
+    if Config.NUM_WORKERS > 1:
+        # 路由进程不需要模型相关的依赖，替换为router.py进程运行
+        router_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "router.py")
+        os.execv(sys.executable, [sys.executable, router_path])
     uvicorn.run(
         app,
         host=Config.HOST,
@@ -0,0 +1,315 @@
+"""服务指标：计数器、仪表和直方图，按Prometheus文本格式导出
+
+不依赖prometheus_client。HTTP请求耗时由ASGI中间件记录（流式响应计到最后一个数据块），
+生成相关的指标在每个生成请求结束时记录。
+"""
+import bisect
+import logging
+import threading
+import time
+from typing import Callable, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+SPEED_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: Tuple[str, str] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Registry:
+    """指标注册表；导出前先执行采集钩子，用于刷新队列长度这类按需读取的仪表"""
+    def __init__(self):
+        self.metrics = []
+        self.collect_hooks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+
+    def add_collect_hook(self, hook: Callable[[], None]):
+        with self._lock:
+            self.collect_hooks.append(hook)
+
+    def render(self) -> str:
+        with self._lock:
+            hooks = list(self.collect_hooks)
+            metrics = list(self.metrics)
+        for hook in hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.warning(f"指标采集钩子执行失败: {str(e)}")
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Registry = REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            # 无标签的指标从0开始导出
+            self.labels()
+        registry.register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        """取某组标签值对应的序列，不存在时创建"""
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}")
+        values = tuple(str(v) for v in values)
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_child()
+            return child
+
+    def collect(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = list(self._children.items())
+        for values, child in children:
+            lines.extend(self._samples(values, child))
+        return lines
+
+    def _samples(self, values: tuple, child) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.get())}"]
+
+
+class _Value:
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1):
+        with self._lock:
+            self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.inc(-amount)
+
+    def set(self, value: float):
+        with self._lock:
+            self.value = float(value)
+
+    def get(self) -> float:
+        with self._lock:
+            return self.value
+
+
+class Counter(_Metric):
+    """只增不减的计数"""
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount: float = 1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    """可增可减的瞬时值"""
+    kind = "gauge"
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value: float):
+        self.labels().set(value)
+
+
+class _HistogramValue:
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def snapshot(self) -> tuple:
+        with self._lock:
+            return list(self.counts), self.sum
+
+
+class Histogram(_Metric):
+    """按桶统计分布，导出累计桶计数、总和和总数"""
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+        registry: Registry = REGISTRY
+    ):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self.labels().observe(value)
+
+    def _samples(self, values: tuple, child) -> List[str]:
+        counts, total = child.snapshot()
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, ("le", _format_value(bound)))
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+# HTTP
+HTTP_REQUESTS = Counter("http_requests_total", "HTTP请求数", ("method", "path", "status"))
+HTTP_REQUEST_SECONDS = Histogram(
+    "http_request_duration_seconds", "HTTP请求耗时（流式响应计到最后一个数据块）", ("method", "path")
+)
+
+# 生成
+GENERATION_REQUESTS = Counter(
+    "generation_requests_total", "结束的生成请求数（客户端断开而取消的记为cancelled）", ("finish_reason",)
+)
+GENERATION_REJECTED = Counter("generation_rejected_total", "被拒绝的生成请求数", ("reason",))
+PREPROCESS_SECONDS = Histogram("generation_preprocess_seconds", "提交前各预处理阶段（检索、重排、分词）耗时", ("stage",))
+QUEUE_SECONDS = Histogram("generation_queue_seconds", "生成请求排队时间")
+TIME_TO_FIRST_TOKEN = Histogram("generation_time_to_first_token_seconds", "从提交到首个token的时间")
+PREFILL_SECONDS = Histogram("generation_prefill_seconds", "预填充（到首个token）耗时")
+DECODE_SECONDS = Histogram("generation_decode_seconds", "首个token之后的解码耗时")
+TOKENS_PER_SECOND = Histogram("generation_tokens_per_second", "单请求解码速度", buckets=SPEED_BUCKETS)
+INPUT_TOKENS = Histogram("generation_input_tokens", "输入token数分布", buckets=TOKEN_BUCKETS)
+OUTPUT_TOKENS = Histogram("generation_output_tokens", "生成token数分布", buckets=TOKEN_BUCKETS)
+PROMPT_TOKENS = Counter("generation_prompt_tokens_total", "输入token总数")
+CACHED_PROMPT_TOKENS = Counter("generation_cached_prompt_tokens_total", "复用前缀/会话缓存、未重新计算的输入token总数")
+COMPLETION_TOKENS = Counter("generation_completion_tokens_total", "生成token总数")
+DRAFT_TOKENS = Counter("speculative_draft_tokens_total", "辅助解码起草的token总数")
+ACCEPTED_TOKENS = Counter("speculative_accepted_tokens_total", "辅助解码被接受的草稿token总数")
+
+# 调度器与模型状态（导出时由采集钩子刷新）
+QUEUE_DEPTH = Gauge("scheduler_queue_depth", "排队等待的生成请求数")
+RUNNING_REQUESTS = Gauge("scheduler_running_requests", "正在生成的请求数")
+MODEL_STATE = Gauge("model_state", "模型启动阶段，当前阶段为1", ("state",))
+MODEL_STARTUP_SECONDS = Gauge("model_startup_seconds", "各启动阶段耗时", ("phase",))
+SESSION_CACHE_MEMORY = Gauge("session_cache_memory_bytes", "会话KV缓存占用")
+# 以下计数由各组件自己累计，导出前在采集钩子中把累计值同步过来
+SESSION_CACHE_LOOKUPS = Counter("session_cache_lookups_total", "会话KV缓存查找次数", ("result",))
+RESPONSE_CACHE_LOOKUPS = Counter("response_cache_lookups_total", "回复缓存查找次数", ("result",))
+LEXICAL_FAST_PATHS = Counter("retrieval_lexical_fast_paths_total", "字面检索置信度高、跳过向量检索和重排的次数")
+QUERY_EMBEDDING_CACHE_LOOKUPS = Counter("query_embedding_cache_lookups_total", "检索查询向量缓存查找次数", ("result",))
+RERANK_PAIRS = Counter("rerank_pairs_total", "重排的(查询, 段落)对数：命中分数缓存/重新打分", ("result",))
+RERANK_SKIPPED = Counter("rerank_skipped_total", "跳过重排的次数：距离已拉开/预计超出预算/打分超时", ("reason",))
+
+
+def record_generation(request):
+    """生成请求结束时记录耗时、token数和辅助解码统计"""
+    GENERATION_REQUESTS.labels(request.finish_reason).inc()
+    # 出错或在排队中就被取消的请求没有耗时可记
+    if request.error is not None or request.prefill_start_time is None:
+        return
+
+    stats = request.stats()
+    QUEUE_SECONDS.observe(stats["queue_time"])
+    INPUT_TOKENS.observe(stats["prompt_tokens"])
+    OUTPUT_TOKENS.observe(stats["completion_tokens"])
+    PROMPT_TOKENS.inc(stats["prompt_tokens"])
+    CACHED_PROMPT_TOKENS.inc(stats["cached_tokens"])
+    COMPLETION_TOKENS.inc(stats["completion_tokens"])
+    if request.first_token_time is not None:
+        TIME_TO_FIRST_TOKEN.observe(stats["time_to_first_token"])
+        PREFILL_SECONDS.observe(request.first_token_time - request.prefill_start_time)
+        DECODE_SECONDS.observe(request.finished_time - request.first_token_time)
+    if stats["tokens_per_second"] is not None:
+        TOKENS_PER_SECOND.observe(stats["tokens_per_second"])
+    if request.draft_tokens:
+        DRAFT_TOKENS.inc(request.draft_tokens)
+        ACCEPTED_TOKENS.inc(request.accepted_tokens)
+
+
+class MetricsMiddleware:
+    """记录每个HTTP请求的状态码和耗时
+
+    路径标签使用路由模板（如/sessions/{conversation_id}），未匹配路由的请求
+    记为unmatched，避免标签数量随URL无限增长。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        status_code = 500
+        finished = False
+
+        async def send_wrapper(message):
+            nonlocal status_code, finished
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            elif message["type"] == "http.response.body" and not message.get("more_body", False):
+                finished = True
+                self._record(scope, status_code, start_time)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # 客户端中途断开或处理出错时没有最后一个数据块，在这里补记
+            if not finished:
+                self._record(scope, status_code, start_time)
+
+    def _record(self, scope, status_code: int, start_time: float):
+        route = scope.get("route")
+        path = getattr(route, "path", "unmatched")
+        method = scope["method"]
+        HTTP_REQUESTS.labels(method, path, status_code).inc()
+        HTTP_REQUEST_SECONDS.labels(method, path).observe(time.perf_counter() - start_time)
@@ -0,0 +1,134 @@
+"""推理设备与精度：CPU线程数、fp32/fp16/bf16/int8精度模式以及启动自测"""
+import logging
+import os
+import time
+from typing import List
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+PRECISIONS = ("auto", "fp32", "fp16", "bf16", "int8")
+
+_DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+    # int8以fp32加载后再对线性层做动态量化
+    "int8": torch.float32,
+}
+
+
+def resolve_device(device: str) -> str:
+    """auto时有GPU用cuda，否则用cpu"""
+    if device == "auto":
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+
+def resolve_precision(precision: str, device: str) -> str:
+    """校验精度模式；auto时GPU用fp16，CPU用fp32
+
+    CPU上fp16矩阵乘没有硬件支持，会非常慢；bf16只在支持AVX512-BF16/AMX的CPU上
+    比fp32快，因此CPU默认fp32，是否用bf16/int8由部署方按机器选择。
+    """
+    precision = precision.lower()
+    if precision not in PRECISIONS:
+        raise ValueError(f"不支持的精度模式: {precision}，可选: {', '.join(PRECISIONS)}")
+    if precision == "auto":
+        return "fp16" if device.startswith("cuda") else "fp32"
+    if precision == "int8" and not device.startswith("cpu"):
+        raise ValueError("int8动态量化只支持CPU推理")
+    if precision == "fp16" and device.startswith("cpu"):
+        logger.warning("CPU上fp16推理非常慢，建议使用fp32、bf16或int8")
+    return precision
+
+
+def torch_dtype(precision: str) -> torch.dtype:
+    return _DTYPES[precision]
+
+
+def parse_cpu_list(value: str) -> List[int]:
+    """解析"0-3,8,10-11"形式的CPU编号列表"""
+    cpus = []
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            start, end = part.split("-", 1)
+            cpus.extend(range(int(start), int(end) + 1))
+        elif part:
+            cpus.append(int(part))
+    return cpus
+
+
+def pin_cpus(cpus: List[int]):
+    """把当前进程绑定到指定的CPU核（仅Linux支持），多个工作进程互不争抢核心
+
+    Linux上亲和性按线程设置，需要逐个绑定已有线程；之后创建的线程继承创建者的设置。
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        logger.warning("当前平台不支持绑定CPU核，忽略CPU_AFFINITY")
+        return
+    threads = [0]
+    if os.path.isdir("/proc/self/task"):
+        threads = [int(tid) for tid in os.listdir("/proc/self/task")]
+    for tid in threads:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except ProcessLookupError:
+            # 线程已退出
+            pass
+    logger.info(f"进程已绑定到CPU核: {cpus}")
+
+
+def configure_threads(num_threads: int):
+    """设置CPU矩阵运算的线程数，0表示使用PyTorch默认值（物理核数）"""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    logger.info(
+        f"CPU推理线程数: {torch.get_num_threads()}, "
+        f"指令集: {torch.backends.cpu.get_cpu_capability()}"
+    )
+
+
+def quantize_linear_int8(model) -> int:
+    """对线性层做int8动态量化（权重int8，激活在运行时按批量化），返回量化的层数
+
+    挂载了LoRA的层只量化其中包装的基础层（base_layer），适配器的lora_A/lora_B保持浮点，
+    已挂载的适配器照常生效；但量化后的模块不支持再挂载新的适配器。
+    """
+    names = [
+        name for name, module in model.named_modules()
+        if type(module) is torch.nn.Linear
+        and not any(part.startswith("lora_") for part in name.split("."))
+    ]
+    qconfig = torch.ao.quantization.default_dynamic_qconfig
+    torch.ao.quantization.quantize_dynamic(model, {name: qconfig for name in names}, inplace=True)
+    return len(names)
+
+
+@torch.no_grad()
+def benchmark_decode(model, device, vocab_size: int, prompt_tokens: int = 128, new_tokens: int = 32) -> dict:
+    """用随机token做一次预填充和若干步贪心解码，测量当前精度下的吞吐"""
+    input_ids = torch.randint(0, vocab_size, (1, prompt_tokens), device=device)
+
+    start_time = time.perf_counter()
+    outputs = model(input_ids=input_ids, use_cache=True, logits_to_keep=1)
+    prefill_time = time.perf_counter() - start_time
+
+    cache = outputs.past_key_values
+    token = outputs.logits[:, -1].argmax(dim=-1, keepdim=True)
+    start_time = time.perf_counter()
+    for _ in range(new_tokens):
+        outputs = model(input_ids=token, past_key_values=cache, use_cache=True)
+        cache = outputs.past_key_values
+        token = outputs.logits[:, -1].argmax(dim=-1, keepdim=True)
+    decode_time = time.perf_counter() - start_time
+
+    return {
+        "prompt_tokens": prompt_tokens,
+        "new_tokens": new_tokens,
+        "prefill_tokens_per_second": round(prompt_tokens / prefill_time, 1),
+        "decode_tokens_per_second": round(new_tokens / decode_time, 1),
+        "time": round(prefill_time + decode_time, 3)
+    }
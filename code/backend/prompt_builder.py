@@ -0,0 +1,170 @@
+"""提示构建：按消息增量编码聊天模板，并按token预算打包对话历史"""
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
+
+
+class PromptTooLongError(ValueError):
+    """系统提示加最新一条消息已经超出输入预算"""
+
+
+def content_key(message: dict) -> tuple:
+    """消息的缓存键：(角色, 内容哈希)"""
+    digest = hashlib.sha1(message["content"].encode("utf-8")).hexdigest()
+    return message["role"], digest
+
+
+class IncrementalEncoder:
+    """增量编码聊天提示
+
+    把模板化后的提示看作"每条消息的片段 + 生成提示"的拼接，按(角色, 内容哈希)缓存
+    每个片段的token序列，新请求直接拼接token，只有新出现的消息需要分词。
+
+    并非所有模板都能这样拆分（例如会自动插入默认系统提示的模板），初始化时用一段
+    示例对话校验拼接结果与完整渲染后分词一致，不一致则退回完整渲染。
+    """
+    PROBE_MESSAGES = [
+        {"role": "system", "content": "你是药老"},
+        {"role": "user", "content": "老师，您在吗？"},
+        {"role": "assistant", "content": "嘿嘿，小家伙，老夫一直都在。"},
+        {"role": "user", "content": "斗气大陆将功法分为几个等级？"}
+    ]
+
+    def __init__(self, tokenizer, max_cached_segments: int = 8192):
+        self.tokenizer = tokenizer
+        self.max_cached_segments = max_cached_segments
+        self.segments = OrderedDict()
+        self._lock = threading.Lock()
+
+        probe_text = self._render(self.PROBE_MESSAGES, add_generation_prompt=False)
+        self.generation_ids = self._tokenize(
+            self._render(self.PROBE_MESSAGES, add_generation_prompt=True)[len(probe_text):]
+        )
+        self.enabled = self._verify()
+        if not self.enabled:
+            logger.warning("聊天模板无法按消息拆分，增量编码已关闭，每次完整渲染后分词")
+
+    def _render(self, messages: List[dict], add_generation_prompt: bool) -> str:
+        return self.tokenizer.apply_chat_template(
+            messages,
+            tokenize=False,
+            add_generation_prompt=add_generation_prompt
+        )
+
+    def _tokenize(self, text: str) -> List[int]:
+        return self.tokenizer(text, add_special_tokens=False)["input_ids"]
+
+    def _verify(self) -> bool:
+        full_ids = self._tokenize(self._render(self.PROBE_MESSAGES, add_generation_prompt=True))
+        joined_ids = []
+        for message in self.PROBE_MESSAGES:
+            joined_ids.extend(self._tokenize(self._render([message], add_generation_prompt=False)))
+        return joined_ids + self.generation_ids == full_ids
+
+    def segment_ids(self, message: dict) -> List[int]:
+        """单条消息渲染后的token序列（带缓存）"""
+        key = content_key(message)
+        with self._lock:
+            ids = self.segments.get(key)
+            if ids is not None:
+                self.segments.move_to_end(key)
+                return ids
+
+        ids = self._tokenize(self._render([message], add_generation_prompt=False))
+        with self._lock:
+            self.segments[key] = ids
+            while len(self.segments) > self.max_cached_segments:
+                self.segments.popitem(last=False)
+        return ids
+
+    def count(self, message: dict) -> int:
+        """消息在模板中占用的token数"""
+        return len(self.segment_ids(message))
+
+    def encode(self, messages: List[dict], add_generation_prompt: bool = True) -> List[int]:
+        """编码整段对话，可拆分时直接拼接各条消息缓存的token"""
+        if not self.enabled:
+            return self._tokenize(self._render(messages, add_generation_prompt=add_generation_prompt))
+
+        input_ids = []
+        for message in messages:
+            input_ids.extend(self.segment_ids(message))
+        if add_generation_prompt:
+            input_ids.extend(self.generation_ids)
+        return input_ids
+
+
+class HistoryPacker:
+    """按token预算打包对话历史
+
+    始终保留系统提示和最新的消息，从新到旧尽量填满预算。每条消息的token数来自
+    增量编码器的片段缓存，判断能否放下时不需要重新对整段历史分词。
+
+    携带会话ID时会记住上次的窗口起点：只要从该起点开始的历史仍在预算内就保持
+    不变，超出时一次性收缩到预算的LOW_WATERMARK，使连续多轮的提示前缀保持稳定，
+    会话KV缓存才能命中。
+    """
+    LOW_WATERMARK = 0.75
+
+    def __init__(self, encoder: IncrementalEncoder, max_sessions: int = 10000):
+        self.encoder = encoder
+        self.max_sessions = max_sessions
+        self.window_starts = OrderedDict()
+        self._lock = threading.Lock()
+
+    def count(self, message: dict) -> int:
+        return self.encoder.count(message)
+
+    def _fill(self, counts: List[int], budget: int) -> int:
+        """从最新的消息往前放，返回能放下的最早位置"""
+        start = len(counts)
+        used = 0
+        while start > 0 and used + counts[start - 1] <= budget:
+            start -= 1
+            used += counts[start]
+        return start
+
+    def pack(self, messages: List[dict], budget: int, session_id: Optional[str] = None) -> List[dict]:
+        """返回放得进budget个token的消息列表（系统提示 + 最新的若干消息）"""
+        system_messages = [m for m in messages if m["role"] == "system"]
+        history = [m for m in messages if m["role"] != "system"]
+        if not history:
+            return system_messages
+
+        budget -= len(self.encoder.generation_ids)
+        budget -= sum(self.count(m) for m in system_messages)
+        counts = [self.count(m) for m in history]
+        if counts[-1] > budget:
+            raise PromptTooLongError(f"消息过长，超出输入长度限制（剩余预算 {max(budget, 0)} tokens）")
+
+        start = None
+        if session_id is not None:
+            with self._lock:
+                previous = self.window_starts.get(session_id)
+            if previous is not None and previous < len(history) and sum(counts[previous:]) <= budget:
+                start = previous
+
+        if start is None:
+            if session_id is not None and sum(counts) > budget:
+                start = self._fill(counts, int(budget * self.LOW_WATERMARK))
+            else:
+                start = self._fill(counts, budget)
+            start = min(start, len(history) - 1)
+            # 不以助手回复开头
+            if history[start]["role"] == "assistant" and start < len(history) - 1:
+                start += 1
+
+        if session_id is not None:
+            with self._lock:
+                self.window_starts[session_id] = start
+                self.window_starts.move_to_end(session_id)
+                while len(self.window_starts) > self.max_sessions:
+                    self.window_starts.popitem(last=False)
+
+        if start > 0:
+            logger.info(f"对话历史截断: {len(history)} -> {len(history) - start}")
+        return system_messages + history[start:]
@@ -0,0 +1,152 @@
+"""交叉编码器重排：模型常驻，按段落长度分批打分，缓存(查询, 段落)分数，并受延迟预算约束"""
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def query_key(query: str) -> str:
+    return hashlib.sha1(query.encode("utf-8")).hexdigest()
+
+
+class Reranker:
+    """常驻的交叉编码器重排器
+
+    - 待打分的(查询, 段落)按段落长度排序后分批，同一批内填充少；
+    - 分数按(查询哈希, 段落ID)缓存，同一问题再次检索时不必重新计算；
+    - 向量检索的距离已经明显拉开（第top_k个与第top_k+1个的相对差距不小于skip_margin）时跳过重排；
+    - 设置了latency_budget（秒）时，按历史单对耗时预估超出预算则不重排，打分途中超出预算则
+      停止并退回向量检索的顺序（已算出的分数仍写入缓存）。
+    """
+    def __init__(
+        self,
+        model_path: str,
+        device: str = "cpu",
+        batch_size: int = 16,
+        max_cache_entries: int = 100000,
+        latency_budget: float = 0.0,
+        skip_margin: float = 0.0
+    ):
+        self.model_path = model_path
+        self.device = device
+        self.batch_size = batch_size
+        self.max_cache_entries = max_cache_entries
+        self.latency_budget = latency_budget
+        self.skip_margin = skip_margin
+
+        self.model = None
+        self.scores = OrderedDict()
+        # 单个(查询, 段落)打分耗时的滑动估计
+        self.pair_seconds: Optional[float] = None
+        self.cached_pairs = 0
+        self.scored_pairs = 0
+        self.skipped = {"margin": 0, "budget": 0, "timeout": 0}
+        self._lock = threading.Lock()
+
+    def load(self):
+        from sentence_transformers import CrossEncoder
+        self.model = CrossEncoder(self.model_path, device=self.device)
+
+    def _separated(self, distances: List[float], top_k: int) -> bool:
+        """保留的最后一个段落与第一个被舍弃段落的距离相对差距是否达到skip_margin"""
+        if self.skip_margin <= 0 or len(distances) <= top_k:
+            return False
+        kept, dropped = distances[top_k - 1], distances[top_k]
+        return dropped - kept >= self.skip_margin * max(abs(dropped), 1e-6)
+
+    def _cached(self, keys: List[tuple]) -> dict:
+        found = {}
+        with self._lock:
+            for key in keys:
+                score = self.scores.get(key)
+                if score is not None:
+                    self.scores.move_to_end(key)
+                    found[key] = score
+            self.cached_pairs += len(found)
+        return found
+
+    def _store(self, items: List[Tuple[tuple, float]]):
+        with self._lock:
+            for key, score in items:
+                self.scores[key] = score
+            while len(self.scores) > self.max_cache_entries:
+                self.scores.popitem(last=False)
+            self.scored_pairs += len(items)
+
+    def _skip(self, reason: str, chunks: List[str], top_k: int) -> Tuple[List[str], str]:
+        with self._lock:
+            self.skipped[reason] += 1
+        return chunks[:top_k], reason
+
+    def rerank(
+        self,
+        query: str,
+        ids: List[str],
+        chunks: List[str],
+        distances: List[float],
+        top_k: int,
+        use_cache: bool = True
+    ) -> Tuple[List[str], Optional[str]]:
+        """按交叉编码器分数取前top_k个段落，返回(段落, 跳过重排的原因或None)
+
+        chunks须按向量检索的顺序（距离从小到大）传入，跳过重排时直接取前top_k个。
+        use_cache为False时（预热）不读写分数缓存。
+        """
+        if len(chunks) <= top_k:
+            return chunks, None
+        if self._separated(distances, top_k):
+            return self._skip("margin", chunks, top_k)
+
+        start_time = time.perf_counter()
+        qkey = query_key(query)
+        keys = [(qkey, chunk_id) for chunk_id in ids]
+        scores = self._cached(keys) if use_cache else {}
+        pending = [i for i, key in enumerate(keys) if key not in scores]
+
+        if (pending and self.latency_budget > 0 and self.pair_seconds is not None
+                and self.pair_seconds * len(pending) > self.latency_budget):
+            return self._skip("budget", chunks, top_k)
+
+        # 按长度排序后分批，减少同一批内的填充
+        pending.sort(key=lambda i: len(chunks[i]))
+        for offset in range(0, len(pending), self.batch_size):
+            # 第一批总会打分，以便估计单对耗时
+            if offset and self.latency_budget > 0 and time.perf_counter() - start_time > self.latency_budget:
+                return self._skip("timeout", chunks, top_k)
+            batch = pending[offset:offset + self.batch_size]
+            batch_start = time.perf_counter()
+            batch_scores = self.model.predict(
+                [(query, chunks[i]) for i in batch],
+                batch_size=len(batch),
+                show_progress_bar=False
+            )
+            elapsed = (time.perf_counter() - batch_start) / len(batch)
+            self.pair_seconds = elapsed if self.pair_seconds is None else 0.8 * self.pair_seconds + 0.2 * elapsed
+            items = [(keys[i], float(score)) for i, score in zip(batch, batch_scores)]
+            if use_cache:
+                self._store(items)
+            scores.update(items)
+
+        ranked = sorted(range(len(chunks)), key=lambda i: scores[keys[i]], reverse=True)
+        return [chunks[i] for i in ranked[:top_k]], None
+
+    def reset_stats(self):
+        with self._lock:
+            self.cached_pairs = 0
+            self.scored_pairs = 0
+            self.skipped = dict.fromkeys(self.skipped, 0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "model": self.model_path,
+                "cache_entries": len(self.scores),
+                "cached_pairs": self.cached_pairs,
+                "scored_pairs": self.scored_pairs,
+                "skipped": dict(self.skipped),
+                "pair_ms": round(self.pair_seconds * 1000, 2) if self.pair_seconds is not None else None
+            }
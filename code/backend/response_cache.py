@@ -0,0 +1,118 @@
+"""常见问题的回复缓存：先按规范化后的消息精确匹配，再按向量相似度匹配"""
+import logging
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 中英文标点和空白，规范化时全部去掉
+_IGNORED_CHARS = re.compile(r"[\s\u2000-\u206f\u3000-\u303f\uff00-\uff0f\uff1a-\uff20\uff3b-\uff40\uff5b-\uff65!-/:-@\[-`{-~]+")
+
+
+def normalize_message(message: str) -> str:
+    """全角转半角、转小写并去掉空白和标点，使措辞略有差别的同一问题得到相同的键"""
+    message = unicodedata.normalize("NFKC", message).lower()
+    return _IGNORED_CHARS.sub("", message)
+
+
+class ResponseCache:
+    """带TTL的LRU回复缓存
+
+    键由命名空间（人设/适配器版本和生成参数）和规范化后的消息组成。配置了嵌入模型时，
+    精确匹配未命中的问题还会与同一命名空间下已缓存问题做余弦相似度比较。
+    """
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        ttl: float = 3600,
+        similarity_threshold: float = 0.92,
+        embedder=None
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.embedder = embedder
+        # (命名空间, 规范化消息) -> (回复, 写入时间, 归一化后的问题向量)
+        self.entries = OrderedDict()
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _encode(self, text: str) -> Optional[np.ndarray]:
+        if self.embedder is None:
+            return None
+        embedding = np.asarray(self.embedder.encode(text), dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) + 1e-12)
+
+    def _expired(self, created_time: float, now: float) -> bool:
+        return self.ttl > 0 and now - created_time > self.ttl
+
+    def lookup(self, message: str, namespace: str) -> Tuple[Optional[dict], Optional[np.ndarray]]:
+        """查找缓存的回复，返回(回复, 问题向量)；问题向量在写入时复用，避免重复编码"""
+        key = (namespace, normalize_message(message))
+        now = time.time()
+
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if not self._expired(entry[1], now):
+                    self.entries.move_to_end(key)
+                    self.exact_hits += 1
+                    return entry[0], entry[2]
+                del self.entries[key]
+
+        # 编码较慢，不持有锁
+        embedding = self._encode(key[1])
+        if embedding is None:
+            with self._lock:
+                self.misses += 1
+            return None, None
+
+        with self._lock:
+            candidates = [
+                (k, e) for k, e in self.entries.items()
+                if k[0] == namespace and e[2] is not None and not self._expired(e[1], now)
+            ]
+            if candidates:
+                matrix = np.stack([e[2] for _, e in candidates])
+                scores = matrix @ embedding
+                best = int(scores.argmax())
+                if scores[best] >= self.similarity_threshold:
+                    best_key, best_entry = candidates[best]
+                    self.entries.move_to_end(best_key)
+                    self.semantic_hits += 1
+                    logger.info(f"回复缓存语义命中，相似度: {scores[best]:.3f}")
+                    return best_entry[0], embedding
+            self.misses += 1
+        return None, embedding
+
+    def store(self, message: str, namespace: str, response: dict, embedding: Optional[np.ndarray] = None):
+        """写入回复，超过容量时淘汰最久未使用的条目"""
+        key = (namespace, normalize_message(message))
+        if embedding is None:
+            embedding = self._encode(key[1])
+        with self._lock:
+            self.entries[key] = (response, time.time(), embedding)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self.entries),
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses
+            }
@@ -0,0 +1,274 @@
+"""检索增强：查询改写、向量检索（Chroma或内存映射矩阵）+ 字面检索（BM25）和交叉编码器重排
+
+对应code/rag/RAG.ipynb中的retrieve和rerank。服务启动时加载嵌入模型、向量库集合和
+重排模型并各跑一次预热，请求时只做前向计算。
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from lexical import LexicalIndex, reciprocal_rank_fusion
+from reranker import Reranker
+from response_cache import normalize_message
+from vector_store import VectorStore
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_HEADER = "根据以下相关知识来回答问题："
+
+
+def parse_rewrite_rules(value: str) -> List[Tuple[str, str]]:
+    """解析"正则=替换,正则=替换"形式的查询改写规则，按顺序应用"""
+    rules = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if "=" not in item:
+            raise ValueError(f"查询改写规则格式错误: {item}，应为 正则=替换")
+        pattern, replacement = item.split("=", 1)
+        rules.append((pattern.strip(), replacement.strip()))
+    return rules
+
+
+def build_context(chunks: List[str]) -> str:
+    """把检索到的段落拼成追加在系统提示之后的背景信息"""
+    return CONTEXT_HEADER + "\n" + "\n\n".join(chunk.strip() for chunk in chunks)
+
+
+class EmbeddingCache:
+    """查询向量的LRU缓存，键为改写并规范化后的查询
+
+    配置了path时启动时从文件加载、关闭时写回，重启后热门问题仍不必重新编码。文件中记录了
+    嵌入模型，换模型后旧缓存作废。
+    """
+    def __init__(self, max_entries: int = 10000, path: str = ""):
+        self.max_entries = max_entries
+        self.path = path
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, query: str) -> Optional[np.ndarray]:
+        with self._lock:
+            embedding = self.entries.get(query)
+            if embedding is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(query)
+            self.hits += 1
+            return embedding
+
+    def put(self, query: str, embedding: np.ndarray):
+        with self._lock:
+            self.entries[query] = embedding
+            self.entries.move_to_end(query)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def load(self, model: str) -> int:
+        """从文件加载缓存，返回加载的条数；文件不存在或嵌入模型不一致时不加载"""
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        try:
+            with np.load(self.path) as data:
+                if str(data["model"]) != model:
+                    logger.info(f"查询向量缓存的嵌入模型已变更，忽略: {self.path}")
+                    return 0
+                queries, embeddings = data["queries"], data["embeddings"]
+        except Exception as e:
+            logger.warning(f"查询向量缓存加载失败: {str(e)}")
+            return 0
+        with self._lock:
+            for query, embedding in zip(queries[-self.max_entries:], embeddings[-self.max_entries:]):
+                self.entries[str(query)] = embedding
+        return len(self.entries)
+
+    def save(self, model: str):
+        """按最近使用顺序写入文件，先写临时文件再替换，多个进程同时写也不会损坏"""
+        if not self.path:
+            return
+        with self._lock:
+            queries = list(self.entries.keys())
+            embeddings = list(self.entries.values())
+        if not queries:
+            return
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                np.savez(f, model=np.array(model), queries=np.array(queries), embeddings=np.stack(embeddings))
+            os.replace(tmp_path, self.path)
+            logger.info(f"查询向量缓存已保存: {len(queries)} 条")
+        except Exception as e:
+            logger.warning(f"查询向量缓存保存失败: {str(e)}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class Retriever:
+    """检索服务：改写并规范化查询 → 向量检索召回 → 交叉编码器重排
+
+    未配置重排器时直接取向量检索的前rerank_top_k个段落。配置了字面索引时，向量检索与字面
+    检索的结果按RRF融合后再重排；字面检索的置信度不低于lexical_fast_path时直接取字面检索的
+    结果，不做向量检索和重排。
+    """
+    def __init__(
+        self,
+        store: VectorStore,
+        embedding_model: str,
+        reranker: Optional[Reranker] = None,
+        embedding_cache: Optional[EmbeddingCache] = None,
+        lexical: Optional[LexicalIndex] = None,
+        lexical_fast_path: float = 0.0,
+        rrf_k: int = 60,
+        top_k: int = 5,
+        rerank_top_k: int = 2,
+        rewrite_rules: Optional[List[Tuple[str, str]]] = None,
+        device: str = "cpu"
+    ):
+        self.store = store
+        self.embedding_model = embedding_model
+        self.reranker = reranker
+        self.embedding_cache = embedding_cache
+        self.lexical = lexical
+        self.lexical_fast_path = lexical_fast_path
+        self.rrf_k = rrf_k
+        self.top_k = top_k
+        self.rerank_top_k = rerank_top_k
+        self.rewrite_rules = [(re.compile(p), r) for p, r in rewrite_rules or []]
+        self.device = device
+
+        self.embedder = None
+        self.searches = 0
+        self.fast_paths = 0
+
+    def load(self) -> Dict[str, float]:
+        """加载嵌入模型、向量库和重排模型，返回各自耗时"""
+        from sentence_transformers import SentenceTransformer
+
+        timings = {}
+        start_time = time.perf_counter()
+        self.embedder = SentenceTransformer(self.embedding_model, device=self.device)
+        timings["embedder"] = round(time.perf_counter() - start_time, 3)
+
+        if self.embedding_cache is not None:
+            start_time = time.perf_counter()
+            loaded = self.embedding_cache.load(self.embedding_model)
+            timings["embedding_cache"] = round(time.perf_counter() - start_time, 3)
+            logger.info(f"已加载 {loaded} 条查询向量缓存")
+
+        start_time = time.perf_counter()
+        self.store.load()
+        timings["store"] = round(time.perf_counter() - start_time, 3)
+
+        if self.lexical is not None:
+            start_time = time.perf_counter()
+            self.lexical.build(*self.store.all_documents())
+            timings["lexical"] = round(time.perf_counter() - start_time, 3)
+
+        if self.reranker is not None:
+            start_time = time.perf_counter()
+            self.reranker.load()
+            timings["reranker"] = round(time.perf_counter() - start_time, 3)
+
+        # 预热：第一次前向计算和向量库查询会触发各种延迟初始化；预热查询不进缓存，也不计入统计
+        start_time = time.perf_counter()
+        self.search("你好", use_cache=False)
+        self.searches = 0
+        self.fast_paths = 0
+        if self.reranker is not None:
+            self.reranker.reset_stats()
+        timings["warmup"] = round(time.perf_counter() - start_time, 3)
+
+        logger.info(
+            f"检索服务已加载: 向量库 {self.store.name} ({self.store.count()} 个段落), "
+            f"重排: {'开启' if self.reranker is not None else '关闭'}, "
+            f"字面检索: {'开启' if self.lexical is not None else '关闭'}"
+        )
+        return timings
+
+    def rewrite_query(self, query: str) -> str:
+        """按规则改写查询，例如把第一/二人称换成角色名，使查询与小说原文的叙述视角一致；
+        再去掉空白和标点，措辞略有差别的同一问题得到相同的查询，可以命中向量和重排分数缓存
+        """
+        for pattern, replacement in self.rewrite_rules:
+            query = pattern.sub(replacement, query)
+        return normalize_message(query) or query
+
+    def embed(self, query: str, use_cache: bool = True) -> np.ndarray:
+        if self.embedding_cache is None or not use_cache:
+            return self.embedder.encode(query, show_progress_bar=False)
+        embedding = self.embedding_cache.get(query)
+        if embedding is None:
+            embedding = self.embedder.encode(query, show_progress_bar=False)
+            self.embedding_cache.put(query, embedding)
+        return embedding
+
+    def save(self):
+        if self.embedding_cache is not None:
+            self.embedding_cache.save(self.embedding_model)
+
+    def retrieve(self, query: str, top_k: int, use_cache: bool = True) -> Tuple[List[str], List[str], List[float]]:
+        """向量检索，返回按距离从小到大排列的(段落ID, 段落, 距离)"""
+        return self.store.query(self.embed(query, use_cache), top_k)
+
+    def search(self, query: str, use_cache: bool = True) -> Tuple[List[str], Dict[str, float]]:
+        """检索与查询相关的段落，返回(段落, 各阶段耗时)；use_cache为False时不读写查询向量和重排分数缓存"""
+        timings = {}
+        start_time = time.perf_counter()
+        query = self.rewrite_query(query)
+
+        if self.lexical is not None:
+            hits, confidence = self.lexical.search(query, self.top_k)
+            timings["lexical"] = round(time.perf_counter() - start_time, 4)
+            if hits and self.lexical_fast_path > 0 and confidence >= self.lexical_fast_path:
+                self.searches += 1
+                self.fast_paths += 1
+                return [self.lexical.documents[i] for i in hits[:self.rerank_top_k]], timings
+
+        retrieve_start = time.perf_counter()
+        ids, chunks, distances = self.retrieve(query, self.top_k, use_cache)
+        timings["retrieve"] = round(time.perf_counter() - retrieve_start, 4)
+
+        if self.lexical is not None:
+            texts = dict(zip(ids, chunks))
+            texts.update((self.lexical.ids[i], self.lexical.documents[i]) for i in hits)
+            ids = reciprocal_rank_fusion([ids, [self.lexical.ids[i] for i in hits]], self.rrf_k)[:self.top_k]
+            chunks = [texts[id_] for id_ in ids]
+            # 融合后的顺序不再对应向量检索的距离，不做距离差跳过判断
+            distances = []
+
+        if self.reranker is None:
+            chunks = chunks[:self.rerank_top_k]
+        else:
+            rerank_start = time.perf_counter()
+            chunks, skipped = self.reranker.rerank(query, ids, chunks, distances, self.rerank_top_k, use_cache)
+            timings["rerank"] = round(time.perf_counter() - rerank_start, 4)
+            if skipped:
+                logger.debug(f"跳过重排: {skipped}")
+
+        self.searches += 1
+        return chunks, timings
+
+    def stats(self) -> dict:
+        return {
+            "store": type(self.store).__name__,
+            "collection": self.store.name,
+            "chunks": self.store.count(),
+            "top_k": self.top_k,
+            "rerank_top_k": self.rerank_top_k,
+            "reranker": self.reranker.stats() if self.reranker is not None else None,
+            "embedding_cache": self.embedding_cache.stats() if self.embedding_cache is not None else None,
+            "lexical": self.lexical.stats() if self.lexical is not None else None,
+            "lexical_fast_paths": self.fast_paths,
+            "searches": self.searches
+        }
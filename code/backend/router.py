@@ -0,0 +1,427 @@
+"""多进程模式的请求路由
+
+启动N个模型工作进程（各自运行main.py、监听本机不同端口、绑定一组CPU核并使用对应的
+线程数），前端的轻量FastAPI应用把请求转发给它们：带会话ID的请求按ID哈希固定到同一
+个工作进程，使会话KV缓存等状态留在该进程；其余请求发给在途请求最少的进程。
+角色的加载/卸载会广播到所有工作进程，指标汇总后加上worker标签导出。
+
+路由进程不导入main.py，不加载torch/transformers。多进程模式的启动方式:
+    NUM_WORKERS=4 python router.py
+    NUM_WORKERS=4 uvicorn router:app --host 0.0.0.0 --port 8000
+（python main.py在NUM_WORKERS>1时也会转而运行本文件）
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import subprocess
+import sys
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+import httpx
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect, status
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+
+
+class Config:
+    """路由进程的配置，环境变量与main.py中的同名配置含义相同"""
+    HOST = os.getenv("HOST", "0.0.0.0")
+    PORT = int(os.getenv("PORT", 8000))
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+    NUM_WORKERS = int(os.getenv("NUM_WORKERS", 1))
+    WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", PORT + 1))
+
+
+logging.basicConfig(
+    level=getattr(logging, Config.LOG_LEVEL),
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# 逐跳头部，不转发
+HOP_HEADERS = {
+    "host", "connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+    "te", "trailers", "transfer-encoding", "upgrade", "content-length",
+}
+
+
+def partition_cpus(num_workers: int) -> List[List[int]]:
+    """把当前进程可用的CPU核按编号连续地平均分给各工作进程"""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+    if len(cpus) < num_workers:
+        logger.warning(f"CPU核数({len(cpus)})少于工作进程数({num_workers})，部分进程将共用核心")
+        return [[cpus[i % len(cpus)]] for i in range(num_workers)]
+    size, extra = divmod(len(cpus), num_workers)
+    groups, start = [], 0
+    for i in range(num_workers):
+        end = start + size + (1 if i < extra else 0)
+        groups.append(cpus[start:end])
+        start = end
+    return groups
+
+
+class Worker:
+    """一个模型工作进程"""
+    def __init__(self, index: int, port: int, cpus: List[int]):
+        self.index = index
+        self.port = port
+        self.cpus = cpus
+        self.url = f"http://127.0.0.1:{port}"
+        self.process: Optional[subprocess.Popen] = None
+        self.in_flight = 0
+        self.restarts = 0
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def start(self, extra_env: dict):
+        env = dict(os.environ)
+        env.update(extra_env)
+        env.update({
+            # 工作进程本身不再派生子进程
+            "NUM_WORKERS": "1",
+            "HOST": "127.0.0.1",
+            "PORT": str(self.port),
+            "CPU_AFFINITY": ",".join(str(cpu) for cpu in self.cpus),
+            "NUM_THREADS": str(len(self.cpus)),
+        })
+        self.process = subprocess.Popen([sys.executable, "main.py"], cwd=BACKEND_DIR, env=env)
+        logger.info(f"工作进程 {self.index} 已启动: pid={self.process.pid}, 端口={self.port}, CPU核={self.cpus}")
+
+    def stop(self, timeout: float = 30):
+        if not self.alive:
+            return
+        self.process.terminate()
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+class UpstreamResponse(StreamingResponse):
+    """工作进程的流式响应
+
+    正文没有被读完（HEAD请求、客户端提前断开）时生成器的finally不会执行，所以在响应
+    结束时统一释放：关闭上游连接并减少在途计数，只执行一次。
+    """
+    def __init__(self, upstream: httpx.Response, release, headers: dict):
+        super().__init__(upstream.aiter_raw(), status_code=upstream.status_code, headers=headers)
+        self._release = release
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            release, self._release = self._release, None
+            if release is not None:
+                await release()
+
+
+class WorkerPool:
+    """管理工作进程并负责选择转发目标"""
+    MONITOR_INTERVAL = 2.0
+
+    def __init__(self, num_workers: int, base_port: int, extra_env: Optional[dict] = None):
+        self.extra_env = extra_env or {}
+        self.workers = [
+            Worker(i, base_port + i, cpus)
+            for i, cpus in enumerate(partition_cpus(num_workers))
+        ]
+        self.client: Optional[httpx.AsyncClient] = None
+        self._monitor_task = None
+
+    async def start(self):
+        # 生成可能持续很久，读超时不设上限
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(5.0, read=None, write=None, pool=None))
+        for worker in self.workers:
+            worker.start(self.extra_env)
+        self._monitor_task = asyncio.create_task(self._monitor())
+
+    async def stop(self):
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+        await asyncio.gather(*(asyncio.to_thread(worker.stop) for worker in self.workers))
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def _monitor(self):
+        """工作进程意外退出时自动重启"""
+        while True:
+            await asyncio.sleep(self.MONITOR_INTERVAL)
+            for worker in self.workers:
+                if not worker.alive:
+                    logger.error(f"工作进程 {worker.index} 已退出(退出码 {worker.process.returncode})，正在重启")
+                    worker.restarts += 1
+                    # 不清零在途计数：转发到旧进程的请求会各自在连接断开时释放
+                    worker.start(self.extra_env)
+
+    def for_session(self, session_id: str) -> Worker:
+        """按会话ID固定选择工作进程；该进程不可用时顺延到下一个"""
+        digest = hashlib.md5(session_id.encode("utf-8")).digest()
+        start = int.from_bytes(digest[:8], "big") % len(self.workers)
+        for offset in range(len(self.workers)):
+            worker = self.workers[(start + offset) % len(self.workers)]
+            if worker.alive:
+                return worker
+        return self.workers[start]
+
+    def least_loaded(self) -> Worker:
+        alive = [w for w in self.workers if w.alive] or self.workers
+        return min(alive, key=lambda w: w.in_flight)
+
+    def _build_request(self, worker: Worker, request: Request, body: bytes) -> httpx.Request:
+        url = worker.url + request.url.path
+        if request.url.query:
+            url += "?" + request.url.query
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_HEADERS}
+        return self.client.build_request(request.method, url, headers=headers, content=body)
+
+    async def forward(self, worker: Worker, request: Request, body: bytes) -> Response:
+        """把请求转发给工作进程，响应以流的形式原样返回（兼容SSE）"""
+        worker.in_flight += 1
+        try:
+            upstream = await self.client.send(self._build_request(worker, request, body), stream=True)
+        except httpx.HTTPError as e:
+            worker.in_flight -= 1
+            logger.error(f"转发到工作进程 {worker.index} 失败: {str(e)}")
+            return JSONResponse(
+                status_code=status.HTTP_502_BAD_GATEWAY,
+                content={"detail": f"工作进程 {worker.index} 不可用"}
+            )
+
+        async def release():
+            # 关闭上游连接使工作进程感知到客户端断开
+            await upstream.aclose()
+            worker.in_flight -= 1
+
+        response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_HEADERS}
+        return UpstreamResponse(upstream, release, headers=response_headers)
+
+    async def request(self, worker: Worker, request: Request, body: bytes) -> tuple:
+        """转发请求并读完响应，返回(状态码, 内容)；工作进程不可达时为502和错误说明"""
+        worker.in_flight += 1
+        try:
+            response = await self.client.send(self._build_request(worker, request, body))
+            return response.status_code, response.content
+        except httpx.HTTPError as e:
+            logger.error(f"转发到工作进程 {worker.index} 失败: {str(e)}")
+            content = json.dumps({"detail": f"工作进程 {worker.index} 不可用"}, ensure_ascii=False)
+            return status.HTTP_502_BAD_GATEWAY, content.encode("utf-8")
+        finally:
+            worker.in_flight -= 1
+
+    async def forward_websocket(self, worker: Worker, websocket: WebSocket):
+        """在客户端与工作进程之间双向转发WebSocket消息，任一端关闭时关闭另一端"""
+        # 只有多进程模式转发WebSocket时才需要客户端库（uvicorn[standard]已自带）
+        import websockets
+
+        url = worker.url.replace("http://", "ws://", 1) + websocket.url.path
+        if websocket.url.query:
+            url += "?" + websocket.url.query
+        await websocket.accept()
+        worker.in_flight += 1
+        close_code, close_reason = 1000, ""
+        try:
+            async with websockets.connect(url, max_size=None) as upstream:
+                async def client_to_worker():
+                    while True:
+                        await upstream.send(await websocket.receive_text())
+
+                async def worker_to_client():
+                    async for message in upstream:
+                        await websocket.send_text(message)
+
+                tasks = [asyncio.create_task(client_to_worker()), asyncio.create_task(worker_to_client())]
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in pending:
+                    task.cancel()
+                close_code = upstream.close_code or 1000
+                close_reason = upstream.close_reason or ""
+                for task in done:
+                    if isinstance(task.exception(), WebSocketDisconnect):
+                        # 客户端先断开，退出上下文时关闭上游连接，工作进程随之取消生成
+                        return
+        except Exception as e:
+            logger.error(f"WebSocket转发到工作进程 {worker.index} 失败: {str(e)}")
+            close_code, close_reason = 1011, f"工作进程 {worker.index} 不可用"
+        finally:
+            worker.in_flight -= 1
+        await websocket.close(code=close_code, reason=close_reason)
+
+    async def get_json(self, worker: Worker, path: str) -> tuple:
+        """请求工作进程的JSON接口，返回(状态码, 内容)，不可达时状态码为None"""
+        try:
+            response = await self.client.get(worker.url + path, timeout=5.0)
+            return response.status_code, response.json()
+        except Exception as e:
+            return None, {"detail": str(e)}
+
+
+def session_id_of(path: str, body: bytes) -> Optional[str]:
+    """从请求中取出会话ID：DELETE /sessions/{id}的路径参数，或JSON请求体中的conversation_id"""
+    if path.startswith("/sessions/"):
+        return path[len("/sessions/"):]
+    if not body:
+        return None
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    if isinstance(payload, dict) and payload.get("conversation_id"):
+        return str(payload["conversation_id"])
+    return None
+
+
+def add_worker_label(text: str, index: int, seen_meta: set) -> List[str]:
+    """给工作进程导出的每个样本加上worker标签，HELP/TYPE行只保留一次"""
+    lines = []
+    label = f'worker="{index}"'
+    for line in text.splitlines():
+        if not line:
+            continue
+        if line.startswith("#"):
+            if line not in seen_meta:
+                seen_meta.add(line)
+                lines.append(line)
+            continue
+        name, _, value = line.rpartition(" ")
+        if name.endswith("}"):
+            name = f"{name[:-1]},{label}}}"
+        else:
+            name = f"{name}{{{label}}}"
+        lines.append(f"{name} {value}")
+    return lines
+
+
+def create_app(num_workers: int, base_port: int, extra_env: Optional[dict] = None) -> FastAPI:
+    """创建路由应用"""
+    pool = WorkerPool(num_workers, base_port, extra_env)
+
+    @asynccontextmanager
+    async def lifespan(app: FastAPI):
+        await pool.start()
+        yield
+        await pool.stop()
+
+    app = FastAPI(title="角色扮演AI聊天API（路由）", lifespan=lifespan)
+    app.state.pool = pool
+    # 与main.py相同的CORS配置，浏览器的预检请求由路由应用直接应答
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],  # 生产环境建议设置具体的前端地址
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+
+    @app.get("/health/live", summary="存活探针")
+    async def liveness():
+        return {"status": "alive", "workers_alive": sum(w.alive for w in pool.workers)}
+
+    @app.get("/health/ready", summary="就绪探针")
+    async def readiness():
+        """所有工作进程就绪后才就绪，避免会话被路由到仍在加载的进程"""
+        results = await asyncio.gather(*(pool.get_json(w, "/health/ready") for w in pool.workers))
+        workers = [{"worker": w.index, "ready": code == 200} for w, (code, _) in zip(pool.workers, results)]
+        if not all(item["ready"] for item in workers):
+            return JSONResponse(status_code=status.HTTP_503_SERVICE_UNAVAILABLE, content={"workers": workers})
+        return {"status": "ready", "workers": workers}
+
+    @app.get("/health", summary="健康检查")
+    async def health():
+        results = await asyncio.gather(*(pool.get_json(w, "/health") for w in pool.workers))
+        workers = []
+        for worker, (code, body) in zip(pool.workers, results):
+            workers.append({
+                "worker": worker.index,
+                "pid": worker.process.pid if worker.process else None,
+                "cpus": worker.cpus,
+                "in_flight": worker.in_flight,
+                "restarts": worker.restarts,
+                "health": body if code is not None else None,
+            })
+        healthy = all(item["health"] and item["health"].get("model_loaded") for item in workers)
+        return {"status": "healthy" if healthy else "unhealthy", "workers": workers}
+
+    @app.get("/metrics", summary="Prometheus指标")
+    async def metrics():
+        results = await asyncio.gather(
+            *(pool.client.get(w.url + "/metrics", timeout=5.0) for w in pool.workers),
+            return_exceptions=True
+        )
+        seen_meta = set()
+        lines = []
+        for worker, result in zip(pool.workers, results):
+            if isinstance(result, Exception) or result.status_code != 200:
+                continue
+            lines.extend(add_worker_label(result.text, worker.index, seen_meta))
+        lines.append("# TYPE router_worker_in_flight gauge")
+        lines.extend(f'router_worker_in_flight{{worker="{w.index}"}} {w.in_flight}' for w in pool.workers)
+        return PlainTextResponse("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4; charset=utf-8")
+
+    @app.api_route("/characters", methods=["POST"], summary="加载角色（广播）")
+    @app.api_route("/characters/{name}", methods=["DELETE"], summary="卸载角色（广播）")
+    async def broadcast(request: Request):
+        """角色适配器在每个工作进程中各有一份，加载/卸载需要同时发给所有进程
+
+        全部成功或全部失败时原样返回第一个进程的响应（例如鉴权失败的401）；部分失败时
+        各进程的角色已不一致，返回502并列出成功和失败的进程，由调用方重试或卸载。
+        """
+        body = await request.body()
+        results = await asyncio.gather(*(pool.request(w, request, body) for w in pool.workers))
+        failed = [(w, code, content) for w, (code, content) in zip(pool.workers, results) if code >= 400]
+        if not failed or len(failed) == len(results):
+            code, content = results[0]
+            return Response(content=content, status_code=code, media_type="application/json")
+
+        def detail_of(content: bytes):
+            try:
+                return json.loads(content).get("detail")
+            except (ValueError, AttributeError):
+                return content.decode("utf-8", errors="replace")
+
+        failed_indices = {w.index for w, _, _ in failed}
+        logger.error(f"角色变更只在部分工作进程上成功，失败的进程: {sorted(failed_indices)}")
+        return JSONResponse(
+            status_code=status.HTTP_502_BAD_GATEWAY,
+            content={
+                "detail": "角色变更只在部分工作进程上成功",
+                "succeeded": [w.index for w in pool.workers if w.index not in failed_indices],
+                "failed": [
+                    {"worker": w.index, "status_code": code, "detail": detail_of(content)}
+                    for w, code, content in failed
+                ]
+            }
+        )
+
+    @app.websocket("/{path:path}")
+    async def route_websocket(websocket: WebSocket, path: str):
+        """WebSocket连接整个会话固定在一个工作进程上，服务端保存的历史和会话缓存都在该进程"""
+        session_id = websocket.query_params.get("conversation_id")
+        worker = pool.for_session(session_id) if session_id else pool.least_loaded()
+        await pool.forward_websocket(worker, websocket)
+
+    @app.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE"])
+    async def route(path: str, request: Request):
+        body = await request.body()
+        session_id = session_id_of(request.url.path, body)
+        worker = pool.for_session(session_id) if session_id else pool.least_loaded()
+        return await pool.forward(worker, request, body)
+
+    return app
+
+
+app = create_app(Config.NUM_WORKERS, Config.WORKER_BASE_PORT)
+
+if __name__ == "__main__":
+    import uvicorn
+    uvicorn.run(app, host=Config.HOST, port=Config.PORT, log_level=Config.LOG_LEVEL.lower())
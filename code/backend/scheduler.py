@@ -0,0 +1,837 @@
+"""连续批处理调度器
+
+把并发到来的生成请求合并到共享的批量前向计算中：新请求单独预填充后左侧补齐
+并入正在运行的批次，每一步对整个批次解码一个token，完成的序列立即移出批次。
+"""
+import asyncio
+import concurrent.futures
+import logging
+import math
+import queue
+import threading
+import time
+from typing import AsyncIterator, Callable, List, Optional
+
+import torch
+
+from kv_cache import (
+    SessionCache,
+    cache_from_legacy,
+    cache_to_legacy,
+    crop_cache,
+    left_pad_cache,
+    longest_common_prefix,
+    select_cache,
+)
+from speculative import DraftModel, accept_draft_tokens, token_probs
+
+logger = logging.getLogger(__name__)
+
+
+def sample_next_tokens(logits: torch.Tensor, requests: List["GenerationRequest"]) -> List[int]:
+    """按每个请求各自的采样参数(重复惩罚、温度、top-k、top-p)选出下一个token"""
+    logits = logits.float()
+
+    # 重复惩罚：与transformers一致，作用于提示和已生成的所有token
+    for i, request in enumerate(requests):
+        if request.repetition_penalty != 1.0 and request.penalty_ids is not None:
+            score = logits[i].index_select(0, request.penalty_ids)
+            score = torch.where(score < 0, score * request.repetition_penalty, score / request.repetition_penalty)
+            logits[i].index_copy_(0, request.penalty_ids, score)
+
+    device = logits.device
+    temperatures = torch.tensor([max(r.temperature, 1e-5) for r in requests], device=device).unsqueeze(1)
+    top_ps = torch.tensor([r.top_p for r in requests], device=device).unsqueeze(1)
+    top_ks = torch.tensor([r.top_k if r.top_k > 0 else logits.shape[-1] for r in requests], device=device).unsqueeze(1)
+
+    sorted_logits, sorted_indices = (logits / temperatures).sort(dim=-1, descending=True)
+    sorted_probs = sorted_logits.softmax(dim=-1)
+    ranks = torch.arange(logits.shape[-1], device=device).unsqueeze(0)
+    # 排在前面的概率和已超过top_p，或名次超过top_k的token被剔除（首个token总会保留）
+    remove = ((sorted_probs.cumsum(dim=-1) - sorted_probs) > top_ps) | (ranks >= top_ks)
+    sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+    sampled = torch.multinomial(sorted_logits.softmax(dim=-1), num_samples=1)
+    tokens = sorted_indices.gather(1, sampled).squeeze(1)
+
+    greedy = torch.tensor([not r.do_sample for r in requests], device=device)
+    if greedy.any():
+        tokens = torch.where(greedy, logits.argmax(dim=-1), tokens)
+
+    return tokens.tolist()
+
+
+def token_logprobs(logits: torch.Tensor, tokens: List[int]) -> List[float]:
+    """各行所选token在模型原始分布（不含温度、惩罚等采样处理）下的对数概率
+
+    sample_next_tokens会原地施加重复惩罚，需要在采样之前传入logits（或其副本）。
+    """
+    index = torch.tensor(tokens, device=logits.device).unsqueeze(1)
+    return logits.float().log_softmax(dim=-1).gather(1, index).squeeze(1).tolist()
+
+
+class QueueFullError(Exception):
+    """等待队列已满，请求被拒绝"""
+    def __init__(self, queue_depth: int, retry_after: int):
+        super().__init__(f"生成队列已满（排队请求数: {queue_depth}），请{retry_after}秒后重试")
+        self.queue_depth = queue_depth
+        self.retry_after = retry_after
+
+
+class IncrementalDecoder:
+    """增量解码token，避免把一个汉字的多个字节拆开输出"""
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.token_ids = []
+        self.prefix_offset = 0
+        self.read_offset = 0
+
+    def push(self, token_id: int) -> str:
+        """加入一个token，返回可以安全输出的新增文本"""
+        self.token_ids.append(token_id)
+        prefix_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:self.read_offset],
+            skip_special_tokens=True
+        )
+        new_text = self.tokenizer.decode(
+            self.token_ids[self.prefix_offset:],
+            skip_special_tokens=True
+        )
+        if len(new_text) > len(prefix_text) and not new_text.endswith("\ufffd"):
+            self.prefix_offset = self.read_offset
+            self.read_offset = len(self.token_ids)
+            return new_text[len(prefix_text):]
+        return ""
+
+
+class GenerationRequest:
+    """单个生成请求：保存输入、各自的采样参数以及生成状态"""
+    def __init__(
+        self,
+        input_ids: List[int],
+        max_new_tokens: int = 512,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        top_k: int = 0,
+        repetition_penalty: float = 1.0,
+        do_sample: bool = True,
+        eos_token_ids: Optional[List[int]] = None,
+        session_id: Optional[str] = None,
+        character: Optional[str] = None,
+        adapter: Optional[str] = None,
+        logprobs: bool = False
+    ):
+        self.input_ids = list(input_ids)
+        self.session_id = session_id
+        # 扮演的角色（决定复用哪个系统提示前缀）和它使用的LoRA适配器，None表示基础模型
+        self.character = character
+        self.adapter = adapter
+        self.max_new_tokens = max_new_tokens
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k
+        self.repetition_penalty = repetition_penalty
+        self.do_sample = do_sample
+        self.eos_token_ids = set(eos_token_ids or [])
+        # 是否记录每个生成token的对数概率
+        self.logprobs = logprobs
+        # 与本请求共用一次预填充的其他候选，见fork
+        self.forks: List["GenerationRequest"] = []
+
+        self.output_ids: List[int] = []
+        self.output_logprobs: List[float] = []
+        self.position = 0
+        # 预填充时直接复用缓存、无需重新计算的提示token数
+        self.cached_tokens = 0
+        self.penalty_ids: Optional[torch.Tensor] = None
+        self._seen_ids = set()
+
+        # 辅助解码：小模型的KV缓存及其覆盖的token数，以及起草/接受统计
+        self.draft_cache = None
+        self.draft_length = 0
+        self.draft_tokens = 0
+        self.accepted_tokens = 0
+        self.speculative_steps = 0
+        self.speculative_output_tokens = 0
+
+        self.finished = False
+        self.finish_reason = None
+        # 由请求方设置（如客户端已断开），调度线程在两步解码之间检查
+        self.cancelled = False
+        self.error: Optional[Exception] = None
+        self._done = threading.Event()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._async_events: Optional[asyncio.Queue] = None
+        self._done_callbacks: List[Callable[["GenerationRequest"], None]] = []
+
+        # 提交前各预处理阶段（检索、分词等）的耗时，由请求方填写
+        self.timings = {}
+
+        self.created_time = time.perf_counter()
+        self.prefill_start_time = None
+        self.first_token_time = None
+        self.finished_time = None
+
+    @property
+    def group(self) -> List["GenerationRequest"]:
+        """本请求及其所有候选，在批次中各占一行"""
+        return [self] + self.forks
+
+    def fork(self) -> "GenerationRequest":
+        """派生一个采样参数相同的候选：与本请求共用预填充，之后各自采样解码
+
+        候选不参与会话缓存（下一轮只会延续其中一个回复，按公共前缀复用即可）。
+        """
+        candidate = GenerationRequest(
+            self.input_ids,
+            max_new_tokens=self.max_new_tokens,
+            temperature=self.temperature,
+            top_p=self.top_p,
+            top_k=self.top_k,
+            repetition_penalty=self.repetition_penalty,
+            do_sample=self.do_sample,
+            eos_token_ids=list(self.eos_token_ids),
+            character=self.character,
+            adapter=self.adapter,
+            logprobs=self.logprobs
+        )
+        candidate._done_callbacks = list(self._done_callbacks)
+        if self._loop is not None:
+            candidate.bind_loop(self._loop)
+        self.forks.append(candidate)
+        return candidate
+
+    def bind_loop(self, loop: asyncio.AbstractEventLoop):
+        """绑定事件循环，之后的事件直接投递到该循环中，供协程等待"""
+        self._loop = loop
+        self._async_events = asyncio.Queue()
+        for candidate in self.forks:
+            candidate.bind_loop(loop)
+
+    def _emit(self, event: tuple):
+        # 未绑定事件循环的请求（如预热）只通过wait()等待结束，不需要逐个事件
+        if self._loop is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._async_events.put_nowait, event)
+        except RuntimeError:
+            # 事件循环已关闭（服务正在退出），丢弃事件即可
+            pass
+
+    def add_done_callback(self, fn: Callable[["GenerationRequest"], None]):
+        """请求结束（完成或失败）时在调度线程中调用fn(request)"""
+        self._done_callbacks.append(fn)
+
+    def _run_done_callbacks(self):
+        for fn in self._done_callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                logger.warning(f"请求结束回调执行失败: {str(e)}")
+
+    def add_token(self, token_id: int, logprob: Optional[float] = None):
+        """记录一个新生成的token并通知消费方"""
+        if self.first_token_time is None:
+            self.first_token_time = time.perf_counter()
+        self.output_ids.append(token_id)
+        if logprob is not None:
+            self.output_logprobs.append(logprob)
+        self._emit(("token", token_id))
+
+        if token_id not in self._seen_ids and self.penalty_ids is not None:
+            self._seen_ids.add(token_id)
+            self.penalty_ids = torch.cat([self.penalty_ids, self.penalty_ids.new_tensor([token_id])])
+
+        if token_id in self.eos_token_ids:
+            self.finish("stop")
+        elif len(self.output_ids) >= self.max_new_tokens:
+            self.finish("length")
+
+    def cancel(self):
+        """取消生成（含所有候选）：排队中的请求不再预填充，运行中的序列在下一步解码前移出批次"""
+        for member in self.group:
+            member.cancelled = True
+
+    def finish(self, reason: str):
+        if self.finished:
+            return
+        self.finished = True
+        self.finish_reason = reason
+        self.finished_time = time.perf_counter()
+        self._emit(("done", reason))
+        self._done.set()
+        self._run_done_callbacks()
+
+    def fail(self, error: Exception):
+        if self.finished:
+            return
+        self.error = error
+        self.finished = True
+        self.finish_reason = "error"
+        self.finished_time = time.perf_counter()
+        self._emit(("error", error))
+        self._done.set()
+        self._run_done_callbacks()
+
+    def wait(self, timeout: Optional[float] = None) -> "GenerationRequest":
+        """阻塞等待生成结束"""
+        self._done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self
+
+    async def aiter_tokens(self) -> AsyncIterator[int]:
+        """逐个产出新生成的token，生成出错时抛出异常；需要先调用bind_loop"""
+        while True:
+            kind, value = await self._async_events.get()
+            if kind == "token":
+                yield value
+            elif kind == "error":
+                raise value
+            else:
+                return
+
+    def stats(self) -> dict:
+        """本次请求的耗时统计"""
+        end_time = self.finished_time or time.perf_counter()
+        first_token_time = self.first_token_time or end_time
+        decode_time = end_time - first_token_time
+        completion_tokens = len(self.output_ids)
+        stats = {
+            "prompt_tokens": len(self.input_ids),
+            "cached_tokens": self.cached_tokens,
+            "completion_tokens": completion_tokens,
+            "queue_time": round((self.prefill_start_time or end_time) - self.created_time, 4),
+            "time_to_first_token": round(first_token_time - self.created_time, 4),
+            "tokens_per_second": round((completion_tokens - 1) / decode_time, 2) if decode_time > 0 else None,
+            "finish_reason": self.finish_reason
+        }
+        if self.speculative_steps:
+            stats["draft_tokens"] = self.draft_tokens
+            stats["accepted_tokens"] = self.accepted_tokens
+            stats["acceptance_rate"] = round(self.accepted_tokens / self.draft_tokens, 4)
+            # 每次大模型前向计算产出的token数，即辅助解码在前向次数上的加速比
+            stats["tokens_per_step"] = round(self.speculative_output_tokens / self.speculative_steps, 2)
+        return stats
+
+
+class BatchScheduler:
+    """连续批处理调度器
+
+    后台线程循环执行：把等待队列中的请求逐个预填充后并入运行批次，再对运行批次
+    做一步批量解码，并把已完成的序列移出批次。
+    """
+    # 公共前缀短于该长度时直接完整预填充，不值得复用
+    MIN_PREFIX_TOKENS = 16
+    # 混合适配器批次中表示"不使用适配器"的名字（PEFT约定）
+    BASE_ADAPTER = "__base__"
+
+    def __init__(
+        self,
+        model,
+        device,
+        eos_token_ids: List[int],
+        max_batch_size: int = 16,
+        max_queue_size: int = 64,
+        session_cache: Optional[SessionCache] = None,
+        draft: Optional[DraftModel] = None
+    ):
+        self.model = model
+        self.device = device
+        self.eos_token_ids = list(eos_token_ids)
+        self.max_batch_size = max_batch_size
+        self.max_queue_size = max_queue_size
+        # 请求平均耗时的滑动估计，用于计算Retry-After
+        self.avg_latency = 5.0
+
+        self.waiting = queue.Queue()
+        self.running: List[GenerationRequest] = []
+        # 候选数超过批次空位而暂缓并入的请求，批次腾出位置后优先处理
+        self._held: Optional[GenerationRequest] = None
+
+        # 运行批次的共享状态，所有行在序列维上左侧对齐
+        self.cache = None
+        self.attention_mask = None
+        self.positions = None
+        self.next_tokens = None
+
+        # 各角色系统提示前缀的(适配器, token序列, KV缓存)，在调度线程中计算
+        self.system_prefixes = {}
+        self._pending_prefixes = {}
+        self._prefix_lock = threading.Lock()
+        # 需要在两步解码之间执行的操作（如加载/卸载适配器）
+        self._tasks = queue.Queue()
+        # 按会话保存的上一轮KV缓存
+        self.session_cache = session_cache
+        # 辅助解码的小模型；只在批次中仅有一个序列（受单token延迟限制）时使用
+        self.draft = draft
+
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self.waiting.qsize() + (self._held is not None)
+
+    @property
+    def running_count(self) -> int:
+        return len(self.running)
+
+    def start(self):
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._loop, name="batch-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"批处理调度器已启动，最大批大小: {self.max_batch_size}")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+        error = RuntimeError("服务正在关闭")
+        self._fail_running(error)
+        if self._held is not None:
+            self._held, held = None, self._held
+            for member in held.group:
+                member.fail(error)
+        while True:
+            try:
+                request = self.waiting.get_nowait()
+            except queue.Empty:
+                break
+            for member in request.group:
+                member.fail(error)
+
+    def set_system_prefix(self, token_ids: List[int], character: Optional[str] = None, adapter: Optional[str] = None):
+        """登记角色固定的系统提示前缀，调度线程会在处理下一个请求前计算它的KV缓存"""
+        with self._prefix_lock:
+            self._pending_prefixes[character] = (adapter, list(token_ids))
+
+    def drop_system_prefix(self, character: Optional[str]):
+        """删除角色的系统提示前缀缓存，只能在调度线程中调用（见call_in_loop）"""
+        with self._prefix_lock:
+            self._pending_prefixes.pop(character, None)
+        self.system_prefixes.pop(character, None)
+
+    def call_in_loop(self, fn: Callable) -> concurrent.futures.Future:
+        """在调度线程的两步解码之间执行fn，返回可等待的Future
+
+        加载/卸载适配器会修改模型结构，必须与前向计算串行。
+        """
+        future = concurrent.futures.Future()
+        self._tasks.put((fn, future))
+        return future
+
+    def fail_adapter(self, adapter: str, error: Exception):
+        """让正在使用某个适配器的序列失败并移出批次，只能在调度线程中调用"""
+        affected = [r for r in self.running if r.adapter == adapter]
+        for request in affected:
+            request.fail(error)
+        if affected:
+            self._evict_finished()
+        if self.session_cache is not None:
+            self.session_cache.drop_tag(adapter)
+
+    def check_admission(self):
+        """等待队列已满时立即拒绝，而不是让请求无限排队"""
+        queue_depth = self.queue_depth
+        if queue_depth >= self.max_queue_size:
+            retry_after = math.ceil(self.avg_latency * (queue_depth / self.max_batch_size + 1))
+            raise QueueFullError(queue_depth, max(1, retry_after))
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        """提交请求，由后台线程择机并入批次"""
+        self.check_admission()
+        request.eos_token_ids.update(self.eos_token_ids)
+        self.waiting.put(request)
+        return request
+
+    def _loop(self):
+        while not self._stop_event.is_set():
+            try:
+                self._run_tasks()
+                self._drop_cancelled()
+                self._admit()
+                if self.running:
+                    self._decode()
+            except Exception as e:
+                logger.error(f"批量解码失败: {str(e)}", exc_info=True)
+                self._fail_running(e)
+
+    def _run_tasks(self):
+        while True:
+            try:
+                fn, future = self._tasks.get_nowait()
+            except queue.Empty:
+                return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+
+    def _adapter_kwargs(self, adapters: List[Optional[str]]) -> dict:
+        """模型挂载了LoRA适配器时，按行指定每个序列使用的适配器"""
+        if not hasattr(self.model, "peft_config"):
+            return {}
+        return {"adapter_names": [adapter or self.BASE_ADAPTER for adapter in adapters]}
+
+    @torch.no_grad()
+    def _build_system_prefixes(self):
+        """计算各角色系统提示前缀的KV缓存，之后该角色的所有请求共享"""
+        with self._prefix_lock:
+            pending, self._pending_prefixes = self._pending_prefixes, {}
+
+        for character, (adapter, token_ids) in pending.items():
+            start_time = time.perf_counter()
+            input_ids = torch.tensor([token_ids], device=self.device)
+            try:
+                outputs = self.model(
+                    input_ids=input_ids,
+                    attention_mask=torch.ones_like(input_ids),
+                    use_cache=True,
+                    logits_to_keep=1,
+                    **self._adapter_kwargs([adapter])
+                )
+            except Exception as e:
+                logger.error(f"角色 {character} 的系统提示前缀计算失败: {str(e)}", exc_info=True)
+                self.system_prefixes.pop(character, None)
+                continue
+            self.system_prefixes[character] = (adapter, token_ids, cache_to_legacy(outputs.past_key_values))
+            logger.info(
+                f"角色 {character} 的系统提示前缀缓存已更新: {len(token_ids)} tokens, "
+                f"耗时 {time.perf_counter() - start_time:.2f}s"
+            )
+
+    def _lookup_prefix(self, request: GenerationRequest) -> tuple:
+        """在系统提示前缀和会话缓存中找出与请求公共前缀最长的一个，返回(复用长度, KV缓存)"""
+        # 候选项为(是否来自会话缓存, token序列, KV缓存)
+        candidates = []
+        system_prefix = self.system_prefixes.get(request.character)
+        if system_prefix is not None and system_prefix[0] == request.adapter:
+            candidates.append((False,) + system_prefix[1:])
+        if request.session_id and self.session_cache is not None:
+            session_entry = self.session_cache.get(request.session_id, request.adapter)
+            if session_entry is not None:
+                candidates.append((True,) + session_entry)
+
+        # 至少留一个token做前向计算，才能得到下一个token的logits
+        limit = len(request.input_ids) - 1
+        best_length, best_cache, from_session = 0, None, False
+        for is_session, prefix_ids, legacy in candidates:
+            length = min(longest_common_prefix(prefix_ids, request.input_ids), limit)
+            if length > best_length:
+                best_length, best_cache, from_session = length, legacy, is_session
+
+        if request.session_id and self.session_cache is not None:
+            self.session_cache.record(from_session and best_length >= self.MIN_PREFIX_TOKENS)
+
+        if best_length < self.MIN_PREFIX_TOKENS:
+            return 0, None
+        return best_length, best_cache
+
+    def _admit(self):
+        """从等待队列取出请求预填充，并入运行批次"""
+        if self._pending_prefixes:
+            self._build_system_prefixes()
+
+        admitted = []
+        while True:
+            free = self.max_batch_size - len(self.running) - len(admitted)
+            if free <= 0:
+                break
+            if self._held is not None:
+                request, self._held = self._held, None
+            else:
+                try:
+                    # 没有正在运行的序列时阻塞等待，避免空转
+                    if not self.running and not admitted:
+                        request = self.waiting.get(timeout=0.1)
+                    else:
+                        request = self.waiting.get_nowait()
+                except queue.Empty:
+                    break
+
+            if request.cancelled:
+                for member in request.group:
+                    member.finish("cancelled")
+                continue
+
+            # 多个候选一起并入批次；空位不够时先等运行中的序列结束
+            if len(request.group) > free and (self.running or admitted):
+                self._held = request
+                break
+
+            try:
+                legacy = self._prefill(request)
+            except Exception as e:
+                logger.error(f"预填充失败: {str(e)}", exc_info=True)
+                for member in request.group:
+                    member.fail(e)
+                continue
+
+            # 首个token就结束的请求不需要进入批次
+            for member in request.group:
+                if not member.finished:
+                    admitted.append((member, legacy))
+            if request.finished and request.session_id and self.session_cache is not None:
+                self.session_cache.put(request.session_id, request.input_ids, legacy, request.adapter)
+
+        if admitted:
+            try:
+                self._merge(admitted)
+            except Exception as e:
+                # 新请求还不在运行批次中，_fail_running不会通知到它们；_merge失败时不改动运行批次
+                logger.error(f"并入批次失败: {str(e)}", exc_info=True)
+                for member, _ in admitted:
+                    member.fail(e)
+
+    @torch.no_grad()
+    def _prefill(self, request: GenerationRequest) -> tuple:
+        """单独对一个请求做预填充，采样出首个token，返回它的KV缓存
+
+        若请求以已缓存的前缀开头，只对剩余部分做前向计算。共享的前缀缓存以切片
+        视图传入，DynamicCache追加时会生成新张量，因此不会被改写，也无需复制。
+        请求带有多个候选时，各候选从同一份logits各自采样首个token并共用这份缓存。
+        """
+        request.prefill_start_time = time.perf_counter()
+        if request.adapter is not None and request.adapter not in getattr(self.model, "peft_config", {}):
+            raise RuntimeError(f"适配器 {request.adapter} 已卸载")
+        total_length = len(request.input_ids)
+        cached_tokens, prefix = self._lookup_prefix(request)
+
+        kwargs = {}
+        if prefix is not None:
+            kwargs["past_key_values"] = cache_from_legacy(crop_cache(prefix, cached_tokens))
+            kwargs["position_ids"] = torch.arange(cached_tokens, total_length, device=self.device).unsqueeze(0)
+
+        outputs = self.model(
+            input_ids=torch.tensor([request.input_ids[cached_tokens:]], device=self.device),
+            attention_mask=torch.ones(1, total_length, dtype=torch.long, device=self.device),
+            use_cache=True,
+            logits_to_keep=1,
+            **kwargs,
+            **self._adapter_kwargs([request.adapter])
+        )
+
+        group = request.group
+        penalty_ids = None
+        if request.repetition_penalty != 1.0:
+            penalty_ids = torch.unique(torch.tensor(request.input_ids, device=self.device))
+        for member in group:
+            member.prefill_start_time = request.prefill_start_time
+            # 候选直接复用本次预填充的整个提示
+            member.cached_tokens = cached_tokens if member is request else total_length
+            member.position = total_length
+            if penalty_ids is not None:
+                member.penalty_ids = penalty_ids
+                member._seen_ids = set(penalty_ids.tolist())
+
+        # 惩罚会原地修改logits，每个候选一行独立的副本
+        logits = outputs.logits[:, -1, :].repeat(len(group), 1)
+        tokens = sample_next_tokens(logits, group)
+        logprobs = self._logprobs(outputs.logits[:, -1, :].expand(len(group), -1), group, tokens)
+        for member, token_id, logprob in zip(group, tokens, logprobs):
+            member.add_token(token_id, logprob)
+        return cache_to_legacy(outputs.past_key_values)
+
+    def _logprobs(self, logits: torch.Tensor, requests: List[GenerationRequest], tokens: List[int]) -> list:
+        """有请求需要时计算所选token的对数概率，不需要的行为None"""
+        if not any(request.logprobs for request in requests):
+            return [None] * len(requests)
+        logprobs = token_logprobs(logits, tokens)
+        return [logprob if request.logprobs else None for request, logprob in zip(requests, logprobs)]
+
+    def _merge(self, admitted: List[tuple]):
+        """把预填充好的请求左侧补齐后与运行批次拼接
+
+        先算出全部新状态再一次性替换，中途出错（如显存不足）时运行批次保持原样。
+        """
+        caches = []
+        masks = []
+        if self.running:
+            caches.append(cache_to_legacy(self.cache))
+            masks.append(self.attention_mask)
+        for request, legacy in admitted:
+            caches.append(legacy)
+            masks.append(torch.ones(1, legacy[0][0].shape[2], dtype=torch.long, device=self.device))
+
+        length = max(mask.shape[1] for mask in masks)
+        caches = [left_pad_cache(legacy, length) for legacy in caches]
+        masks = [torch.nn.functional.pad(mask, (length - mask.shape[1], 0)) for mask in masks]
+
+        merged = tuple(
+            (torch.cat([c[i][0] for c in caches]), torch.cat([c[i][1] for c in caches]))
+            for i in range(len(caches[0]))
+        )
+
+        requests = [request for request, _ in admitted]
+        new_positions = torch.tensor([r.position for r in requests], device=self.device)
+        new_tokens = torch.tensor([r.output_ids[-1] for r in requests], device=self.device)
+
+        attention_mask = torch.cat(masks)
+        if self.running:
+            new_positions = torch.cat([self.positions, new_positions])
+            new_tokens = torch.cat([self.next_tokens, new_tokens])
+        cache = cache_from_legacy(merged)
+
+        self.cache = cache
+        self.attention_mask = attention_mask
+        self.positions = new_positions
+        self.next_tokens = new_tokens
+        self.running.extend(requests)
+
+    def _decode(self):
+        """批次中只有一个序列时用辅助解码，否则批量解码一步"""
+        if self.draft is not None and len(self.running) == 1:
+            request = self.running[0]
+            # 最后一个token由大模型给出，草稿数不超过剩余长度减一
+            num_tokens = min(self.draft.num_draft_tokens, request.max_new_tokens - len(request.output_ids) - 1)
+            if num_tokens > 0:
+                self._speculative_step(request, num_tokens)
+                return
+        self._step()
+
+    @torch.no_grad()
+    def _speculative_step(self, request: GenerationRequest, num_tokens: int):
+        """小模型起草num_tokens个token，大模型一次前向计算验证，产出1到num_tokens+1个token"""
+        draft_tokens, draft_probs = self.draft.propose(request, num_tokens)
+        cache_length = self.attention_mask.shape[1]
+        sequence_length = len(request.input_ids) + len(request.output_ids)
+
+        input_ids = torch.tensor([[request.output_ids[-1]] + draft_tokens], device=self.device)
+        attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones(1, num_tokens + 1)], dim=1
+        )
+        outputs = self.model(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            position_ids=self.positions.unsqueeze(1) + torch.arange(num_tokens + 1, device=self.device),
+            past_key_values=self.cache,
+            use_cache=True,
+            **self._adapter_kwargs([request.adapter])
+        )
+
+        target_probs = token_probs(outputs.logits[0], request, draft_tokens)
+        tokens = accept_draft_tokens(target_probs, draft_probs.to(target_probs.device), draft_tokens)
+        # 第i个产出的token由第i个位置的logits验证或采样得到
+        logprobs = [None] * len(tokens)
+        if request.logprobs:
+            logprobs = token_logprobs(outputs.logits[0, :len(tokens)], tokens)
+        emitted = 0
+        for token_id, logprob in zip(tokens, logprobs):
+            request.position += 1
+            request.add_token(token_id, logprob)
+            emitted += 1
+            if request.finished:
+                break
+
+        request.draft_tokens += num_tokens
+        request.accepted_tokens += len(tokens) - 1
+        request.speculative_steps += 1
+        request.speculative_output_tokens += emitted
+
+        # 缓存中有效的是上一个token和产出前被接受的草稿token，最后产出的token还未计算
+        self.cache = cache_from_legacy(crop_cache(cache_to_legacy(outputs.past_key_values), cache_length + emitted))
+        self.attention_mask = attention_mask[:, :cache_length + emitted]
+        self.positions = self.positions + emitted
+        self.next_tokens = self.next_tokens.new_tensor([request.output_ids[-1]])
+        self.draft.rollback(request, sequence_length + emitted - 1)
+
+        if request.finished:
+            self._evict_finished()
+
+    @torch.no_grad()
+    def _step(self):
+        """对运行批次解码一步"""
+        batch_size = len(self.running)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones(batch_size, 1)], dim=1
+        )
+        outputs = self.model(
+            input_ids=self.next_tokens.unsqueeze(1),
+            attention_mask=self.attention_mask,
+            position_ids=self.positions.unsqueeze(1),
+            past_key_values=self.cache,
+            use_cache=True,
+            **self._adapter_kwargs([request.adapter for request in self.running])
+        )
+        self.cache = outputs.past_key_values
+        self.positions = self.positions + 1
+
+        logits = outputs.logits[:, -1, :]
+        # 重复惩罚会原地修改logits，需要对数概率时用副本采样
+        if any(request.logprobs for request in self.running):
+            tokens = sample_next_tokens(logits.clone(), self.running)
+        else:
+            tokens = sample_next_tokens(logits, self.running)
+        logprobs = self._logprobs(logits, self.running, tokens)
+        for request, token_id, logprob in zip(self.running, tokens, logprobs):
+            request.position += 1
+            request.add_token(token_id, logprob)
+        self.next_tokens = torch.tensor(tokens, device=self.device)
+
+        if any(request.finished for request in self.running):
+            self._evict_finished()
+
+    def _drop_cancelled(self):
+        """结束已取消的运行中序列，立即释放它们在批次中的位置"""
+        cancelled = [request for request in self.running if request.cancelled and not request.finished]
+        if not cancelled:
+            return
+        for request in cancelled:
+            request.finish("cancelled")
+        logger.info(f"已取消 {len(cancelled)} 个生成中的序列")
+        self._evict_finished()
+
+    def _evict_finished(self):
+        """移除已完成的序列，并裁掉所有行都是填充的左侧列"""
+        legacy = cache_to_legacy(self.cache)
+        keep = []
+        for i, request in enumerate(self.running):
+            if not request.finished:
+                keep.append(i)
+                continue
+            request.draft_cache = None
+            # 中途取消的请求不计入平均耗时，以免低估Retry-After
+            if request.finish_reason != "cancelled":
+                latency = request.finished_time - request.created_time
+                self.avg_latency = 0.9 * self.avg_latency + 0.1 * latency
+            if request.session_id and self.session_cache is not None and request.error is None:
+                self._save_session(request, legacy, i)
+        if not keep:
+            self._reset()
+            return
+
+        indices = torch.tensor(keep, device=self.device)
+        attention_mask = self.attention_mask.index_select(0, indices)
+        start = int((attention_mask.sum(dim=0) > 0).nonzero()[0])
+
+        self.cache = cache_from_legacy(select_cache(legacy, indices, start))
+        self.attention_mask = attention_mask[:, start:]
+        self.positions = self.positions.index_select(0, indices)
+        self.next_tokens = self.next_tokens.index_select(0, indices)
+        self.running = [self.running[i] for i in keep]
+
+    def _save_session(self, request: GenerationRequest, legacy: tuple, row: int):
+        """保存已完成序列的KV缓存（去掉左侧填充），供同一会话的下一轮复用"""
+        start = int(self.attention_mask[row].nonzero()[0])
+        row_cache = tuple(
+            (key[row:row + 1, :, start:].contiguous(), value[row:row + 1, :, start:].contiguous())
+            for key, value in legacy
+        )
+        # 最后采样出的token还没有经过前向计算，不在缓存中
+        self.session_cache.put(
+            request.session_id, request.input_ids + request.output_ids[:-1], row_cache, request.adapter
+        )
+
+    def _fail_running(self, error: Exception):
+        for request in self.running:
+            request.fail(error)
+        self._reset()
+
+    def _reset(self):
+        self.running = []
+        self.cache = None
+        self.attention_mask = None
+        self.positions = None
+        self.next_tokens = None
@@ -0,0 +1,112 @@
+"""辅助（投机）解码：小模型起草若干token，大模型一次前向计算验证
+
+验证采用标准的投机采样规则：草稿token以 min(1, p/q) 的概率被接受，被拒绝时从
+max(0, p - q) 归一化后的分布重新采样，因此输出分布与只用大模型逐个采样一致；
+贪心请求下退化为逐个比较argmax。
+"""
+import logging
+from typing import List, Tuple
+
+import torch
+
+from kv_cache import cache_from_legacy, cache_to_legacy, crop_cache
+
+logger = logging.getLogger(__name__)
+
+
+def token_probs(logits: torch.Tensor, request, drafted: List[int]) -> torch.Tensor:
+    """把一个请求连续若干位置的logits转换为采样分布
+
+    与sample_next_tokens的处理一致（重复惩罚、温度、top-k、top-p），第i行的重复
+    惩罚还包含前i个草稿token。贪心请求返回argmax处为1的分布。
+    """
+    logits = logits.float().clone()
+    if request.repetition_penalty != 1.0 and request.penalty_ids is not None:
+        for i in range(logits.shape[0]):
+            penalty_ids = request.penalty_ids
+            extra = [t for t in set(drafted[:i]) if t not in request._seen_ids]
+            if extra:
+                penalty_ids = torch.cat([penalty_ids, penalty_ids.new_tensor(extra)])
+            score = logits[i].index_select(0, penalty_ids)
+            score = torch.where(score < 0, score * request.repetition_penalty, score / request.repetition_penalty)
+            logits[i].index_copy_(0, penalty_ids, score)
+
+    if not request.do_sample:
+        return torch.nn.functional.one_hot(logits.argmax(dim=-1), logits.shape[-1]).float()
+
+    logits = logits / max(request.temperature, 1e-5)
+    sorted_logits, sorted_indices = logits.sort(dim=-1, descending=True)
+    sorted_probs = sorted_logits.softmax(dim=-1)
+    ranks = torch.arange(logits.shape[-1], device=logits.device).unsqueeze(0)
+    top_k = request.top_k if request.top_k > 0 else logits.shape[-1]
+    remove = ((sorted_probs.cumsum(dim=-1) - sorted_probs) > request.top_p) | (ranks >= top_k)
+    sorted_logits = sorted_logits.masked_fill(remove, float("-inf"))
+    return torch.zeros_like(logits).scatter_(1, sorted_indices, sorted_logits.softmax(dim=-1))
+
+
+def accept_draft_tokens(target_probs: torch.Tensor, draft_probs: torch.Tensor, draft_tokens: List[int]) -> List[int]:
+    """按投机采样规则验证草稿，返回被接受的草稿token加上一个由大模型决定的token
+
+    target_probs比draft_probs多一行：草稿全部被接受时，用最后一行额外采样一个token。
+    """
+    for i, token in enumerate(draft_tokens):
+        p = target_probs[i, token]
+        q = draft_probs[i, token]
+        if torch.rand(()) * q < p:
+            continue
+        residual = (target_probs[i] - draft_probs[i]).clamp(min=0)
+        if residual.sum() <= 0:
+            residual = target_probs[i]
+        return draft_tokens[:i] + [int(torch.multinomial(residual, num_samples=1))]
+    return draft_tokens + [int(torch.multinomial(target_probs[-1], num_samples=1))]
+
+
+class DraftModel:
+    """起草用的小模型
+
+    必须与大模型共用分词器。每个请求在自己身上保存小模型的KV缓存（draft_cache），
+    请求在批量解码期间新增的token会在下一次起草时一次性补上。
+    """
+    def __init__(self, model, device, num_draft_tokens: int = 4):
+        self.model = model
+        self.device = device
+        self.num_draft_tokens = num_draft_tokens
+
+    @torch.no_grad()
+    def propose(self, request, num_tokens: int) -> Tuple[List[int], torch.Tensor]:
+        """为请求起草num_tokens个token，返回(草稿token, 每个位置的草稿分布)"""
+        sequence = request.input_ids + request.output_ids
+        kwargs = {}
+        if request.draft_cache is not None:
+            kwargs["past_key_values"] = cache_from_legacy(request.draft_cache)
+
+        outputs = self.model(
+            input_ids=torch.tensor([sequence[request.draft_length:]], device=self.device),
+            use_cache=True,
+            logits_to_keep=1,
+            **kwargs
+        )
+
+        tokens, probs = [], []
+        for i in range(num_tokens):
+            q = token_probs(outputs.logits[0, -1:], request, tokens)[0]
+            tokens.append(int(torch.multinomial(q, num_samples=1)))
+            probs.append(q)
+            if i == num_tokens - 1:
+                break
+            outputs = self.model(
+                input_ids=torch.tensor([[tokens[-1]]], device=self.device),
+                past_key_values=outputs.past_key_values,
+                use_cache=True
+            )
+
+        # 最后一个草稿token没有经过前向计算，不在缓存中
+        request.draft_cache = cache_to_legacy(outputs.past_key_values)
+        request.draft_length = len(sequence) + num_tokens - 1
+        return tokens, torch.stack(probs)
+
+    def rollback(self, request, length: int):
+        """丢弃缓存中未被接受的草稿token，只保留前length个"""
+        if request.draft_cache is not None and length < request.draft_length:
+            request.draft_cache = crop_cache(request.draft_cache, length)
+            request.draft_length = length
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARK_DIR = os.path.join(os.path.dirname(BACKEND_DIR), "benchmark")
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+
+@pytest.fixture(scope="session")
+def tiny_model_path(tmp_path_factory):
+    """用benchmark/make_tiny_model.py生成随机初始化的Qwen3小模型"""
+    from make_tiny_model import build_model
+
+    path = str(tmp_path_factory.mktemp("tiny_qwen"))
+    build_model(path, hidden_size=64, layers=2, vocab_size=1000)
+    return path
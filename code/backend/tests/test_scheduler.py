@@ -0,0 +1,81 @@
+"""连续批处理与逐条生成的一致性：左填充并入、逐行采样、移出已结束的行都不应改变贪心输出
+
+随机初始化的小模型输出分布接近均匀，argmax对注意力的微小偏差不敏感，因此同时比较每个
+token的对数概率。
+"""
+import time
+
+import pytest
+import torch
+from transformers import AutoModelForCausalLM
+
+from scheduler import BatchScheduler, GenerationRequest
+
+PROMPT_LENGTHS = (5, 17, 41)
+MAX_NEW_TOKENS = (12, 20, 7)
+
+
+@pytest.fixture(scope="module")
+def model(tiny_model_path):
+    return AutoModelForCausalLM.from_pretrained(tiny_model_path, torch_dtype=torch.float32).eval()
+
+
+@pytest.fixture
+def scheduler(model):
+    scheduler = BatchScheduler(model, torch.device("cpu"), eos_token_ids=[], max_batch_size=4)
+    yield scheduler
+    scheduler.stop()
+
+
+def prompts(vocab_size: int):
+    generator = torch.Generator().manual_seed(0)
+    return [torch.randint(10, vocab_size, (length,), generator=generator).tolist() for length in PROMPT_LENGTHS]
+
+
+@torch.no_grad()
+def generate_alone(model, input_ids, max_new_tokens):
+    """不经调度器，单条序列逐步贪心解码，返回(token, 对数概率)"""
+    ids = list(input_ids)
+    logprobs = []
+    for _ in range(max_new_tokens):
+        scores = model(torch.tensor([ids])).logits[0, -1].float().log_softmax(dim=-1)
+        ids.append(int(scores.argmax()))
+        logprobs.append(float(scores[ids[-1]]))
+    return ids[len(input_ids):], logprobs
+
+
+def assert_matches_alone(model, request):
+    output_ids, logprobs = generate_alone(model, request.input_ids, request.max_new_tokens)
+    assert request.output_ids == output_ids
+    assert request.output_logprobs == pytest.approx(logprobs, abs=1e-4)
+
+
+def test_concurrent_admission_matches_single(model, scheduler):
+    """同一次准入的多个不同长度的请求"""
+    requests = [
+        scheduler.submit(GenerationRequest(ids, max_new_tokens=n, do_sample=False, logprobs=True))
+        for ids, n in zip(prompts(model.config.vocab_size), MAX_NEW_TOKENS)
+    ]
+    # 调度线程启动前全部提交，保证在同一次准入中并入批次
+    scheduler.start()
+    for request in requests:
+        request.wait(timeout=60)
+        assert request.finish_reason == "length"
+        assert_matches_alone(model, request)
+
+
+def test_merge_into_running_batch_matches_single(model, scheduler):
+    """其余请求在第一个请求解码途中并入批次"""
+    first_ids, *rest_ids = prompts(model.config.vocab_size)
+    scheduler.start()
+    first = scheduler.submit(GenerationRequest(first_ids, max_new_tokens=30, do_sample=False, logprobs=True))
+    deadline = time.monotonic() + 60
+    while len(first.output_ids) < 3 and time.monotonic() < deadline:
+        time.sleep(0.001)
+    rest = [
+        scheduler.submit(GenerationRequest(ids, max_new_tokens=n, do_sample=False, logprobs=True))
+        for ids, n in zip(rest_ids, MAX_NEW_TOKENS)
+    ]
+    for request in [first] + rest:
+        request.wait(timeout=60)
+        assert_matches_alone(model, request)
@@ -0,0 +1,220 @@
+"""检索用的向量库：Chroma，或内存映射的NumPy矩阵
+
+小说只有一部，段落最多几十万个，在这个规模上对归一化向量做暴力点积比HNSW的查询往返更快，
+也不需要打开SQLite。MmapStore的目录结构：
+
+    meta.json       维度、数据类型、段落数
+    embeddings.npy  归一化后的向量，float16或int8（int8时另有scales.npy，每行一个缩放系数）
+    ids.json        段落ID
+    chunks.bin      所有段落的UTF-8文本首尾相接
+    offsets.npy     每个段落在chunks.bin中的字节偏移（段落数+1个）
+
+向量和文本都以内存映射方式打开，启动几乎不花时间，只有被访问到的页才会读入内存。
+
+从Chroma集合导出:
+    python vector_store.py --db-path ../rag/data.db --collection my_collection --output ../rag/vectors --dtype int8
+"""
+import argparse
+import json
+import logging
+import os
+from typing import List, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DTYPES = ("float16", "int8")
+
+
+class VectorStore:
+    """向量库接口，query返回按距离从小到大排列的(段落ID, 段落, 距离)"""
+    name = ""
+
+    def load(self):
+        raise NotImplementedError
+
+    def count(self) -> int:
+        raise NotImplementedError
+
+    def query(self, embedding: np.ndarray, top_k: int) -> Tuple[List[str], List[str], List[float]]:
+        raise NotImplementedError
+
+    def all_documents(self) -> Tuple[List[str], List[str]]:
+        """全部(段落ID, 段落)，用于建立字面索引"""
+        raise NotImplementedError
+
+
+class ChromaStore(VectorStore):
+    def __init__(self, db_path: str, collection_name: str):
+        self.db_path = db_path
+        self.name = collection_name
+        self.collection = None
+
+    def load(self):
+        import chromadb
+        client = chromadb.PersistentClient(path=self.db_path)
+        self.collection = client.get_collection(name=self.name)
+
+    def count(self) -> int:
+        return self.collection.count() if self.collection is not None else 0
+
+    def query(self, embedding: np.ndarray, top_k: int) -> Tuple[List[str], List[str], List[float]]:
+        results = self.collection.query(
+            query_embeddings=[np.asarray(embedding).tolist()],
+            n_results=top_k,
+            include=["documents", "distances"]
+        )
+        return results["ids"][0], results["documents"][0], results["distances"][0]
+
+    def all_documents(self, page_size: int = 10000) -> Tuple[List[str], List[str]]:
+        ids, documents = [], []
+        offset = 0
+        while True:
+            page = self.collection.get(include=["documents"], limit=page_size, offset=offset)
+            ids.extend(page["ids"])
+            documents.extend(page["documents"])
+            if len(page["ids"]) < page_size:
+                return ids, documents
+            offset += page_size
+
+
+class MmapStore(VectorStore):
+    """内存映射的向量矩阵，分块计算点积并取top_k
+
+    距离按平方欧氏距离报告（2 - 2·cos），与Chroma默认的l2空间一致。每块转成fp32后
+    再做点积，块不宜过大：1024维时4096行的临时缓冲约16MiB，每个查询复用同一块缓冲。
+    """
+    def __init__(self, path: str, block_size: int = 4096):
+        self.path = path
+        self.name = os.path.basename(os.path.normpath(path))
+        self.block_size = block_size
+        self.embeddings = None
+        self.scales = None
+        self.ids: List[str] = []
+        self.offsets = None
+        self.chunks = None
+
+    def load(self):
+        with open(os.path.join(self.path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        self.embeddings = np.load(os.path.join(self.path, "embeddings.npy"), mmap_mode="r")
+        if meta["dtype"] == "int8":
+            self.scales = np.load(os.path.join(self.path, "scales.npy"), mmap_mode="r")
+        with open(os.path.join(self.path, "ids.json"), "r", encoding="utf-8") as f:
+            self.ids = json.load(f)
+        self.offsets = np.load(os.path.join(self.path, "offsets.npy"), mmap_mode="r")
+        chunks_path = os.path.join(self.path, "chunks.bin")
+        if os.path.getsize(chunks_path) > 0:
+            self.chunks = np.memmap(chunks_path, dtype=np.uint8, mode="r")
+        else:
+            self.chunks = np.zeros(0, dtype=np.uint8)
+        if len(self.ids) != len(self.embeddings) or len(self.offsets) != len(self.ids) + 1:
+            raise ValueError(f"向量库文件不完整: {self.path}")
+
+    def count(self) -> int:
+        return len(self.ids)
+
+    def document(self, index: int) -> str:
+        return bytes(self.chunks[self.offsets[index]:self.offsets[index + 1]]).decode("utf-8")
+
+    def query(self, embedding: np.ndarray, top_k: int) -> Tuple[List[str], List[str], List[float]]:
+        query = np.asarray(embedding, dtype=np.float32)
+        query = query / (np.linalg.norm(query) + 1e-12)
+        top_k = min(top_k, len(self.ids))
+        if top_k == 0:
+            return [], [], []
+
+        best_indices = np.zeros(0, dtype=np.int64)
+        best_scores = np.zeros(0, dtype=np.float32)
+        buffer = np.empty((min(self.block_size, len(self.ids)), self.embeddings.shape[1]), dtype=np.float32)
+        for start in range(0, len(self.ids), self.block_size):
+            block = self.embeddings[start:start + self.block_size]
+            converted = buffer[:len(block)]
+            np.copyto(converted, block, casting="unsafe")
+            scores = converted @ query
+            if self.scales is not None:
+                scores *= self.scales[start:start + self.block_size]
+            k = min(top_k, len(scores))
+            candidates = np.argpartition(-scores, k - 1)[:k]
+            best_indices = np.concatenate([best_indices, candidates + start])
+            best_scores = np.concatenate([best_scores, scores[candidates]])
+            if len(best_scores) > top_k:
+                keep = np.argpartition(-best_scores, top_k - 1)[:top_k]
+                best_indices, best_scores = best_indices[keep], best_scores[keep]
+
+        order = np.argsort(-best_scores)
+        indices = [int(i) for i in best_indices[order]]
+        distances = [float(2 - 2 * score) for score in best_scores[order]]
+        return [self.ids[i] for i in indices], [self.document(i) for i in indices], distances
+
+    def all_documents(self) -> Tuple[List[str], List[str]]:
+        return list(self.ids), [self.document(i) for i in range(len(self.ids))]
+
+    @staticmethod
+    def write(path: str, ids: List[str], documents: List[str], embeddings: np.ndarray, dtype: str = "float16"):
+        """把段落和向量写成MmapStore的目录结构，向量先按行归一化"""
+        if dtype not in DTYPES:
+            raise ValueError(f"不支持的数据类型: {dtype}，可选: {', '.join(DTYPES)}")
+        if not ids:
+            raise ValueError("没有可写入的段落")
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, "meta.json")
+        if os.path.exists(meta_path):
+            os.remove(meta_path)
+        embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(ids), -1)
+        embeddings = embeddings / (np.linalg.norm(embeddings, axis=1, keepdims=True) + 1e-12)
+        if dtype == "int8":
+            # 每行对称量化，点积时乘回缩放系数
+            scales = np.abs(embeddings).max(axis=1) / 127
+            scales[scales == 0] = 1.0
+            np.save(os.path.join(path, "scales.npy"), scales.astype(np.float32))
+            np.save(os.path.join(path, "embeddings.npy"), np.round(embeddings / scales[:, None]).astype(np.int8))
+        else:
+            np.save(os.path.join(path, "embeddings.npy"), embeddings.astype(np.float16))
+
+        offsets = [0]
+        with open(os.path.join(path, "chunks.bin"), "wb") as f:
+            for document in documents:
+                data = document.encode("utf-8")
+                f.write(data)
+                offsets.append(offsets[-1] + len(data))
+        np.save(os.path.join(path, "offsets.npy"), np.asarray(offsets, dtype=np.int64))
+        with open(os.path.join(path, "ids.json"), "w", encoding="utf-8") as f:
+            json.dump(ids, f, ensure_ascii=False)
+        # meta.json最后写，加载时以它的存在为准
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"dim": int(embeddings.shape[1]), "dtype": dtype, "count": len(ids)}, f)
+
+
+def export_collection(db_path: str, collection_name: str, output: str, dtype: str, page_size: int = 10000) -> int:
+    """把Chroma集合中的段落和向量导出为MmapStore，返回段落数"""
+    import chromadb
+    collection = chromadb.PersistentClient(path=db_path).get_collection(name=collection_name)
+    ids, documents, embeddings = [], [], []
+    offset = 0
+    while True:
+        page = collection.get(include=["documents", "embeddings"], limit=page_size, offset=offset)
+        ids.extend(page["ids"])
+        documents.extend(page["documents"])
+        embeddings.extend(page["embeddings"])
+        if len(page["ids"]) < page_size:
+            break
+        offset += page_size
+    MmapStore.write(output, ids, documents, np.asarray(embeddings), dtype)
+    return len(ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="把Chroma集合导出为内存映射向量库")
+    parser.add_argument("--db-path", required=True)
+    parser.add_argument("--collection", default="my_collection")
+    parser.add_argument("--output", required=True)
+    parser.add_argument("--dtype", default="float16", choices=DTYPES)
+    args = parser.parse_args()
+    count = export_collection(args.db_path, args.collection, args.output, args.dtype)
+    print(f"已导出 {count} 个段落到 {args.output}")
+
+
+if __name__ == "__main__":
+    main()
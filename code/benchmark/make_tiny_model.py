@@ -0,0 +1,91 @@
+"""生成离线压测用的小模型：随机初始化的Qwen3结构 + 在本仓库文本上训练的小词表分词器
+
+不需要联网和下载权重，CPU上几秒即可生成。模型输出没有意义，只用于测量服务端的
+调度、缓存、分词等开销随版本的变化。
+
+用法: python make_tiny_model.py [输出目录] [--hidden-size 256] [--layers 4]
+"""
+import argparse
+import glob
+import os
+
+import torch
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, trainers
+from transformers import PreTrainedTokenizerFast, Qwen3Config, Qwen3ForCausalLM
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_CODE_DIR = os.path.dirname(BENCHMARK_DIR)
+DEFAULT_OUTPUT = os.path.join(BENCHMARK_DIR, "tiny_qwen")
+
+SPECIAL_TOKENS = ["<|endoftext|>", "<|im_start|>", "<|im_end|>"]
+# 与Qwen3一致的ChatML格式（不含思考模式相关部分），可以按消息拆分增量编码
+CHAT_TEMPLATE = (
+    "{% for message in messages %}"
+    "<|im_start|>{{ message['role'] }}\n{{ message['content'] }}<|im_end|>\n"
+    "{% endfor %}"
+    "{% if add_generation_prompt %}<|im_start|>assistant\n{% endif %}"
+)
+
+
+def training_corpus():
+    """用仓库中的源码和文档训练分词器，覆盖系统提示里的中文"""
+    patterns = ["backend/*.py", "benchmark/*.py", "数据处理/*.txt", "../README.md"]
+    for pattern in patterns:
+        for path in glob.glob(os.path.join(REPO_CODE_DIR, pattern)):
+            with open(path, "r", encoding="utf-8") as f:
+                yield from f.read().splitlines()
+
+
+def build_tokenizer(vocab_size: int) -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(
+        vocab_size=vocab_size,
+        special_tokens=SPECIAL_TOKENS,
+        initial_alphabet=pre_tokenizers.ByteLevel.alphabet()
+    )
+    tokenizer.train_from_iterator(training_corpus(), trainer)
+
+    tokenizer = PreTrainedTokenizerFast(
+        tokenizer_object=tokenizer,
+        eos_token="<|im_end|>",
+        pad_token="<|endoftext|>"
+    )
+    tokenizer.chat_template = CHAT_TEMPLATE
+    return tokenizer
+
+
+def build_model(output_dir: str, hidden_size: int = 256, layers: int = 4, vocab_size: int = 2000, seed: int = 0):
+    """生成分词器和随机权重并保存到output_dir"""
+    tokenizer = build_tokenizer(vocab_size)
+    tokenizer.save_pretrained(output_dir)
+
+    torch.manual_seed(seed)
+    heads = max(hidden_size // 64, 1)
+    config = Qwen3Config(
+        vocab_size=len(tokenizer),
+        hidden_size=hidden_size,
+        intermediate_size=hidden_size * 3,
+        num_hidden_layers=layers,
+        num_attention_heads=heads,
+        num_key_value_heads=max(heads // 2, 1),
+        head_dim=hidden_size // heads,
+        max_position_embeddings=8192,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        tie_word_embeddings=True
+    )
+    Qwen3ForCausalLM(config).save_pretrained(output_dir)
+    print(f"小模型已保存到 {output_dir}（词表 {len(tokenizer)}，隐藏层 {hidden_size}，层数 {layers}）")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="生成离线压测用的随机Qwen3小模型")
+    parser.add_argument("output_dir", nargs="?", default=DEFAULT_OUTPUT)
+    parser.add_argument("--hidden-size", type=int, default=256)
+    parser.add_argument("--layers", type=int, default=4)
+    parser.add_argument("--vocab-size", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    build_model(args.output_dir, args.hidden_size, args.layers, args.vocab_size, args.seed)
@@ -0,0 +1,311 @@
+"""后端离线压测：启动code/backend/main.py（默认使用随机初始化的小模型），按给定并发发送
+/chat、/chat/simple和多轮会话请求，以JSON输出吞吐、延迟分位数和首token时间，便于不同
+提交之间对比。客户端只使用标准库。
+
+用法:
+    python run_benchmark.py --concurrency 8 --requests 64 --output result.json
+    python run_benchmark.py --env MAX_BATCH_SIZE=1 --env ENABLE_PREFIX_CACHE=false
+    python run_benchmark.py --url http://127.0.0.1:8000 --workloads chat
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import List, Optional
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "backend")
+WORKLOADS = ("chat", "simple", "session")
+
+QUESTIONS = [
+    "老师，斗气大陆将功法分为几个等级？",
+    "药老，异火榜上排名第一的是什么火？",
+    "老师，我什么时候才能突破斗者？",
+    "您当年是怎么被韩枫暗算的？",
+    "炼药师的等级是怎么划分的？",
+    "老师，佛怒火莲该怎么修炼？",
+    "乌坦城外的魔兽山脉里有什么宝物？",
+    "老师，您觉得纳兰嫣然怎么样？",
+]
+
+
+def percentile(values: List[float], q: float) -> Optional[float]:
+    """线性插值的分位数，q取0~100"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = (len(values) - 1) * q / 100
+    low = int(rank)
+    high = min(low + 1, len(values) - 1)
+    return round(values[low] + (values[high] - values[low]) * (rank - low), 4)
+
+
+def distribution(values: List[float]) -> dict:
+    return {
+        "mean": round(sum(values) / len(values), 4) if values else None,
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": round(max(values), 4) if values else None,
+    }
+
+
+def send(url: str, payload: dict, timeout: float) -> dict:
+    """发送一个请求；流式请求在客户端测首个文本增量到达的时间"""
+    data = json.dumps(payload).encode("utf-8")
+    request = urllib.request.Request(url, data=data, headers={"Content-Type": "application/json"})
+    result = {"ok": False, "ttft": None, "completion_tokens": None, "content": ""}
+    start_time = time.perf_counter()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            if not payload.get("stream"):
+                body = json.loads(response.read())
+                result["content"] = body.get("content") or body.get("response") or ""
+                result["ok"] = True
+            else:
+                chunks = []
+                for line in response:
+                    line = line.decode("utf-8").strip()
+                    if not line.startswith("data: "):
+                        continue
+                    event = json.loads(line[len("data: "):])
+                    if event["type"] == "delta":
+                        if result["ttft"] is None:
+                            result["ttft"] = time.perf_counter() - start_time
+                        chunks.append(event["content"])
+                    elif event["type"] == "done":
+                        result["completion_tokens"] = event.get("completion_tokens")
+                        result["ok"] = True
+                    elif event["type"] == "error":
+                        result["error"] = event.get("detail")
+                result["content"] = "".join(chunks)
+    except urllib.error.HTTPError as e:
+        result["error"] = f"HTTP {e.code}"
+    except Exception as e:
+        result["error"] = str(e)
+    result["latency"] = time.perf_counter() - start_time
+    return result
+
+
+class Runner:
+    def __init__(self, base_url: str, args):
+        self.base_url = base_url.rstrip("/")
+        self.args = args
+
+    def chat(self, index: int) -> List[dict]:
+        payload = {
+            "messages": [{"role": "user", "content": QUESTIONS[index % len(QUESTIONS)]}],
+            "max_tokens": self.args.max_tokens,
+            "stream": self.args.stream,
+        }
+        return [send(f"{self.base_url}/chat", payload, self.args.timeout)]
+
+    def simple(self, index: int) -> List[dict]:
+        payload = {
+            "message": QUESTIONS[index % len(QUESTIONS)],
+            "max_tokens": self.args.max_tokens,
+            "stream": self.args.stream,
+            "use_cache": self.args.use_response_cache,
+        }
+        return [send(f"{self.base_url}/chat/simple", payload, self.args.timeout)]
+
+    def session(self, index: int) -> List[dict]:
+        """一次多轮会话，每一轮都计为一个请求，后续轮次带上完整历史和会话ID"""
+        conversation_id = uuid.uuid4().hex
+        messages = []
+        results = []
+        for turn in range(self.args.turns):
+            messages.append({"role": "user", "content": QUESTIONS[(index + turn) % len(QUESTIONS)]})
+            payload = {
+                "messages": messages,
+                "max_tokens": self.args.max_tokens,
+                "stream": self.args.stream,
+                "conversation_id": conversation_id,
+            }
+            result = send(f"{self.base_url}/chat", payload, self.args.timeout)
+            results.append(result)
+            if not result["ok"]:
+                break
+            messages = messages + [{"role": "assistant", "content": result["content"]}]
+        return results
+
+    def run(self, workload: str) -> dict:
+        """以给定并发执行一组请求，汇总结果"""
+        fn = getattr(self, workload)
+        # 多轮会话按会话计数，使总请求数与其他负载相近
+        total = self.args.requests
+        if workload == "session":
+            total = max(total // self.args.turns, 1)
+
+        results = []
+        lock = threading.Lock()
+
+        def task(index: int):
+            outcome = fn(index)
+            with lock:
+                results.extend(outcome)
+
+        start_time = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.args.concurrency) as executor:
+            list(executor.map(task, range(total)))
+        duration = time.perf_counter() - start_time
+
+        succeeded = [r for r in results if r["ok"]]
+        completion_tokens = sum(r["completion_tokens"] or 0 for r in succeeded)
+        errors = {}
+        for r in results:
+            if not r["ok"]:
+                errors[r.get("error", "unknown")] = errors.get(r.get("error", "unknown"), 0) + 1
+        return {
+            "requests": len(results),
+            "succeeded": len(succeeded),
+            "errors": errors,
+            "duration": round(duration, 3),
+            "requests_per_second": round(len(succeeded) / duration, 3),
+            "output_tokens_per_second": round(completion_tokens / duration, 2) if completion_tokens else None,
+            "latency": distribution([r["latency"] for r in succeeded]),
+            "ttft": distribution([r["ttft"] for r in succeeded if r["ttft"] is not None]),
+        }
+
+
+def get_json(url: str, timeout: float = 5) -> Optional[dict]:
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as response:
+            return json.loads(response.read())
+    except Exception:
+        return None
+
+
+def wait_ready(base_url: str, timeout: float, server: Optional[subprocess.Popen] = None) -> dict:
+    """轮询就绪探针，返回就绪时的启动耗时"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if server is not None and server.poll() is not None:
+            raise RuntimeError(f"服务启动失败，退出码 {server.returncode}")
+        ready = get_json(f"{base_url}/health/ready")
+        if ready is not None:
+            return ready
+        time.sleep(0.2)
+    raise TimeoutError(f"服务在 {timeout} 秒内未就绪")
+
+
+def start_server(args, log_file) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        "MODEL_PATH": args.model_path,
+        "HOST": "127.0.0.1",
+        "PORT": str(args.port),
+        "LOG_LEVEL": "WARNING",
+    })
+    for item in args.env:
+        key, value = item.split("=", 1)
+        env[key] = value
+    return subprocess.Popen(
+        [sys.executable, "main.py"],
+        cwd=BACKEND_DIR,
+        env=env,
+        stdout=log_file,
+        stderr=subprocess.STDOUT
+    )
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARK_DIR, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="后端离线压测")
+    parser.add_argument("--workloads", default=",".join(WORKLOADS), help=f"逗号分隔，可选 {', '.join(WORKLOADS)}")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=32, help="每种负载的请求数")
+    parser.add_argument("--turns", type=int, default=4, help="多轮会话的轮数")
+    parser.add_argument("--max-tokens", type=int, default=32)
+    parser.add_argument("--no-stream", dest="stream", action="store_false", help="使用非流式接口（不测首token时间）")
+    parser.add_argument("--use-response-cache", action="store_true", help="/chat/simple允许命中回复缓存")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--url", help="压测已在运行的服务，不再自行启动")
+    parser.add_argument("--model-path", help="模型目录，缺省使用（必要时生成）随机小模型")
+    parser.add_argument("--port", type=int, default=18000)
+    parser.add_argument("--env", action="append", default=[], help="传给服务的环境变量，KEY=VALUE，可重复")
+    parser.add_argument("--startup-timeout", type=float, default=600)
+    parser.add_argument("--output", help="结果JSON的保存路径")
+    args = parser.parse_args()
+
+    workloads = [w.strip() for w in args.workloads.split(",") if w.strip()]
+    for workload in workloads:
+        if workload not in WORKLOADS:
+            parser.error(f"未知负载: {workload}")
+
+    server = None
+    log_path = os.path.join(BENCHMARK_DIR, "server.log")
+    log_file = None
+    base_url = args.url
+    if base_url is None:
+        if args.model_path is None:
+            from make_tiny_model import DEFAULT_OUTPUT, build_model
+            args.model_path = DEFAULT_OUTPUT
+            if not os.path.exists(os.path.join(DEFAULT_OUTPUT, "config.json")):
+                build_model(DEFAULT_OUTPUT)
+        base_url = f"http://127.0.0.1:{args.port}"
+        log_file = open(log_path, "w", encoding="utf-8")
+        server = start_server(args, log_file)
+
+    try:
+        ready = wait_ready(base_url, args.startup_timeout, server)
+        runner = Runner(base_url, args)
+        results = {}
+        for workload in workloads:
+            print(f"运行负载 {workload} ...", file=sys.stderr)
+            results[workload] = runner.run(workload)
+        health = get_json(f"{base_url}/health")
+    finally:
+        if server is not None:
+            server.terminate()
+            try:
+                server.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                server.kill()
+            log_file.close()
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "config": {
+            "model_path": args.model_path or args.url,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "turns": args.turns,
+            "max_tokens": args.max_tokens,
+            "stream": args.stream,
+            "server_env": args.env,
+        },
+        "startup_timings": ready.get("startup_timings"),
+        "server": {
+            "precision": health.get("precision") if health else None,
+            "session_cache": health.get("session_cache") if health else None,
+            "response_cache": health.get("response_cache") if health else None,
+        },
+        "workloads": results,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+"""增量构建Chroma向量库：按内容寻址的段落ID，只编码新增段落，删除已不存在的段落
+
+对应RAG.ipynb中的embed_chunks和save_embeddings，切分见chunker.py。每个段落的ID由来源
+文件名和段落内容的哈希组成，重新清洗了几个章节后再次运行，只有这些章节中变化的段落需要
+重新编码；内容未变、只是位置变了的段落只更新元数据中的偏移。旧版按0、1、2……编号的段落
+会被当作已不存在而删除。
+
+用法:
+    python build_index.py --data-dir /root/yaolao/data --embedding-model Qwen/Qwen3-Embedding-0.6B
+    python build_index.py --data-dir ./data --embedding-model Qwen/Qwen3-Embedding-0.6B --max-tokens 384 --dry-run
+"""
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+from typing import Dict, Iterator, List, Tuple
+
+from chunker import Chunker
+
+RAG_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_DB_PATH = os.path.join(RAG_DIR, "data.db")
+
+_DATA_FILE = re.compile(r"^data_(\d+)\.txt$")
+
+
+def list_data_files(data_dir: str) -> List[Tuple[int, str]]:
+    """按章节号排序的(章节号, 文件名)，只包括data_N.txt"""
+    files = []
+    with os.scandir(data_dir) as entries:
+        for entry in entries:
+            match = _DATA_FILE.match(entry.name)
+            if entry.is_file() and match:
+                files.append((int(match.group(1)), entry.name))
+    return sorted(files)
+
+
+def chunk_id(source: str, chunk: str) -> str:
+    """来源文件名 + 内容哈希，同一内容在不同次构建中得到相同的ID"""
+    return f"{source}:{hashlib.sha1(chunk.encode('utf-8')).hexdigest()[:16]}"
+
+
+def iter_chunks(data_dir: str, chunker: Chunker) -> Iterator[Tuple[str, str, dict]]:
+    """逐个文件流式切分，产出(段落ID, 段落, 元数据)；同一文件中内容重复的段落只保留一个"""
+    for chapter, name in list_data_files(data_dir):
+        seen = set()
+        for chunk, metadata in chunker.chunk_file(os.path.join(data_dir, name), chapter):
+            if not chunk.strip():
+                continue
+            id_ = chunk_id(name, chunk)
+            if id_ in seen:
+                continue
+            seen.add(id_)
+            metadata["source"] = name
+            yield id_, chunk, metadata
+
+
+def existing_metadata(collection, page_size: int = 10000) -> Dict[str, dict]:
+    """分页读取集合中已有的全部ID及元数据（不读取向量和文本）"""
+    metadatas = {}
+    offset = 0
+    while True:
+        page = collection.get(include=["metadatas"], limit=page_size, offset=offset)
+        metadatas.update(zip(page["ids"], page["metadatas"]))
+        if len(page["ids"]) < page_size:
+            return metadatas
+        offset += page_size
+
+
+class IndexBuilder:
+    """攒够一批新增段落后编码并写入集合，内存中只保留一批段落"""
+    def __init__(self, collection, model, batch_size: int = 64, dry_run: bool = False):
+        self.collection = collection
+        self.model = model
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.pending = []
+        self.added = 0
+        self.embed_time = 0.0
+
+    def add(self, id_: str, chunk: str, metadata: dict):
+        self.pending.append((id_, chunk, metadata))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        ids, chunks, metadatas = zip(*self.pending)
+        self.pending = []
+        if not self.dry_run:
+            start_time = time.perf_counter()
+            embeddings = self.model.encode(list(chunks), batch_size=self.batch_size, show_progress_bar=False)
+            self.embed_time += time.perf_counter() - start_time
+            self.collection.add(
+                ids=list(ids),
+                documents=list(chunks),
+                embeddings=embeddings.tolist(),
+                metadatas=list(metadatas)
+            )
+            print(f"已写入 {self.added + len(ids)} 个新段落", file=sys.stderr)
+        self.added += len(ids)
+
+
+def delete_ids(collection, ids: List[str], batch_size: int = 1000):
+    for i in range(0, len(ids), batch_size):
+        collection.delete(ids=ids[i:i + batch_size])
+
+
+def update_metadata(collection, items: List[Tuple[str, dict]], batch_size: int = 1000):
+    for i in range(0, len(items), batch_size):
+        ids, metadatas = zip(*items[i:i + batch_size])
+        collection.update(ids=list(ids), metadatas=list(metadatas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="增量构建Chroma向量库")
+    parser.add_argument("--data-dir", required=True, help="data_N.txt所在目录")
+    parser.add_argument("--db-path", default=DEFAULT_DB_PATH)
+    parser.add_argument("--collection", default="my_collection")
+    parser.add_argument("--embedding-model", required=True, help="嵌入模型，须与服务端RAG_EMBEDDING_MODEL一致")
+    parser.add_argument("--max-tokens", type=int, default=256, help="每个段落的最大token数")
+    parser.add_argument("--overlap-tokens", type=int, default=32, help="相邻段落重叠的token数")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--keep-stale", action="store_true", help="不删除已不存在的段落")
+    parser.add_argument("--dry-run", action="store_true", help="只统计需要新增和删除的段落，不编码、不写入")
+    args = parser.parse_args()
+
+    import chromadb
+
+    client = chromadb.PersistentClient(path=args.db_path)
+    collection = client.get_or_create_collection(name=args.collection)
+    old_metadata = existing_metadata(collection)
+
+    # 切分用嵌入模型自己的分词器计数，试运行时只加载分词器
+    model = None
+    if args.dry_run:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.embedding_model)
+    else:
+        from sentence_transformers import SentenceTransformer
+        model = SentenceTransformer(args.embedding_model, device=args.device)
+        tokenizer = model.tokenizer
+        if model.max_seq_length and args.max_tokens > model.max_seq_length:
+            print(f"警告: --max-tokens {args.max_tokens} 超过嵌入模型的最大长度 {model.max_seq_length}", file=sys.stderr)
+    chunker = Chunker(
+        args.max_tokens,
+        args.overlap_tokens,
+        lambda text: len(tokenizer(text, add_special_tokens=False)["input_ids"])
+    )
+
+    start_time = time.perf_counter()
+    builder = IndexBuilder(collection, model, args.batch_size, args.dry_run)
+    current_ids = set()
+    moved = []
+    for id_, chunk, metadata in iter_chunks(args.data_dir, chunker):
+        current_ids.add(id_)
+        if id_ not in old_metadata:
+            builder.add(id_, chunk, metadata)
+        elif old_metadata[id_] != metadata:
+            moved.append((id_, metadata))
+    builder.flush()
+
+    stale_ids = sorted(old_metadata.keys() - current_ids)
+    if not args.dry_run:
+        update_metadata(collection, moved)
+        if stale_ids and not args.keep_stale:
+            delete_ids(collection, stale_ids)
+
+    report = {
+        "collection": args.collection,
+        "chunks": len(current_ids),
+        "unchanged": len(current_ids & old_metadata.keys()) - len(moved),
+        "moved": len(moved),
+        "added": builder.added,
+        "deleted": 0 if args.keep_stale else len(stale_ids),
+        "dry_run": args.dry_run,
+        "embed_seconds": round(builder.embed_time, 3),
+        "total_seconds": round(time.perf_counter() - start_time, 3),
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
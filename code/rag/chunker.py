@@ -0,0 +1,109 @@
+"""按token数切分章节：逐行读取文件，在句子边界处切分，相邻段落之间有重叠
+
+替代RAG.ipynb中的split_chapter_chunks（整章远超嵌入模型的有效窗口）和split_into_chunks
+（固定5行，不考虑长度）。每个段落都是原文的一个连续片段，附带章节号和在文件中的字符偏移，
+编码开销按段落的token数有上限、可预估。
+"""
+import re
+from typing import Callable, Iterator, List, Optional, Tuple
+
+# 句末标点（可连续出现）及其后的右引号、右括号
+_SENTENCE = re.compile(r"[^。！？!?…；;\n]*(?:[。！？!?…；;]+[”’\"』」）)]*|\n|$)")
+
+
+def split_sentences(text: str) -> List[str]:
+    """按句末标点和换行切分，拼接起来等于原文；换行符附在前一句末尾"""
+    sentences = []
+    for match in _SENTENCE.finditer(text):
+        sentence = match.group(0)
+        if not sentence:
+            continue
+        if sentence == "\n" and sentences:
+            sentences[-1] += sentence
+        else:
+            sentences.append(sentence)
+    return sentences
+
+
+def iter_lines(path: str, skip_head: int = 2, skip_tail: int = 1) -> Iterator[Tuple[int, str]]:
+    """逐行读取，产出(行首字符偏移, 行)；跳过开头skip_head行和最后skip_tail行（标题、广告等）"""
+    pending = []
+    offset = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for index, line in enumerate(f):
+            if index >= skip_head:
+                pending.append((offset, line))
+                if len(pending) > skip_tail:
+                    yield pending.pop(0)
+            offset += len(line)
+
+
+class Chunker:
+    """把句子依次装入段落，超过max_tokens时切出一个段落，下一段落以前一段落末尾
+    不超过overlap_tokens的若干句开头；单句超过max_tokens时按字符硬切
+
+    count_tokens用嵌入模型的分词器计数才能准确控制长度，未提供时按字符数计。
+    """
+    def __init__(
+        self,
+        max_tokens: int = 256,
+        overlap_tokens: int = 32,
+        count_tokens: Optional[Callable[[str], int]] = None
+    ):
+        if overlap_tokens >= max_tokens:
+            raise ValueError("overlap_tokens必须小于max_tokens")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count_tokens = count_tokens or len
+
+    def _pieces(self, offset: int, sentence: str) -> Iterator[Tuple[int, str, int]]:
+        """(偏移, 句子, token数)，过长的句子按token数比例切成长度相近的若干段"""
+        tokens = self.count_tokens(sentence)
+        if tokens <= self.max_tokens:
+            yield offset, sentence, tokens
+            return
+        parts = -(-tokens // self.max_tokens)
+        size = -(-len(sentence) // parts)
+        for start in range(0, len(sentence), size):
+            piece = sentence[start:start + size]
+            yield offset + start, piece, self.count_tokens(piece)
+
+    def _overlap(self, window: List[Tuple[int, str, int]]) -> List[Tuple[int, str, int]]:
+        kept = []
+        total = 0
+        for item in reversed(window):
+            total += item[2]
+            if total > self.overlap_tokens:
+                break
+            kept.append(item)
+        return kept[::-1]
+
+    def chunk_file(self, path: str, chapter: int) -> Iterator[Tuple[str, dict]]:
+        """产出(段落, 元数据)，元数据包括章节号和段落在文件中的[start, end)字符偏移"""
+        window = []
+        tokens = 0
+        emitted_end = 0
+        for line_offset, line in iter_lines(path):
+            offset = line_offset
+            for sentence in split_sentences(line):
+                for piece in self._pieces(offset, sentence):
+                    if window and tokens + piece[2] > self.max_tokens:
+                        chunk = self._emit(window, chapter)
+                        emitted_end = chunk[1]["end"]
+                        yield chunk
+                        window = self._overlap(window)
+                        tokens = sum(item[2] for item in window)
+                        # 重叠部分加上这一句仍超长时，缩短重叠
+                        while window and tokens + piece[2] > self.max_tokens:
+                            tokens -= window.pop(0)[2]
+                    window.append(piece)
+                    tokens += piece[2]
+                offset += len(sentence)
+        # 只剩重叠部分时不再单独成段
+        if window and window[-1][0] + len(window[-1][1]) > emitted_end:
+            yield self._emit(window, chapter)
+
+    def _emit(self, window: List[Tuple[int, str, int]], chapter: int) -> Tuple[str, dict]:
+        start = window[0][0]
+        end = window[-1][0] + len(window[-1][1])
+        return "".join(item[1] for item in window), {"chapter": chapter, "start": start, "end": end}